@@ -0,0 +1,29 @@
+from fastapi import APIRouter, HTTPException
+
+from app.dedup import DedupNotFoundError, dedup_registry
+from app.metrics import InstrumentedRoute
+from app.models import DedupRequest, DedupResponse
+
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+@router.post("", response_model=DedupResponse)
+def create_dedup(request: DedupRequest):
+    try:
+        key, state = dedup_registry.create(request.bounded, request.capacity)
+        return DedupResponse(dedupId=key, bounded=state.bounded, transactionCount=state.count)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/{dedup_id}", response_model=DedupResponse)
+def get_dedup(dedup_id: str):
+    try:
+        state = dedup_registry.get(dedup_id)
+    except DedupNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return DedupResponse(dedupId=dedup_id, bounded=state.bounded, transactionCount=state.count)
+
+@router.delete("/{dedup_id}", status_code=204)
+def delete_dedup(dedup_id: str):
+    if not dedup_registry.delete(dedup_id):
+        raise HTTPException(status_code=404, detail=f"dedup state {dedup_id} not found")
@@ -0,0 +1,81 @@
+from typing import Literal
+
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from app.jobs import JOB_KINDS, JobLimitError, JobNotFoundError, job_queue
+from app.metrics import InstrumentedRoute
+from app.models import JobResponse
+from app.plans import PlanNotFoundError
+
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+# the longest long poll of GET /jobs/{job_id}
+MAX_WAIT_SECONDS = 60
+
+JOB_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"type": "object"}}},
+    }
+}
+
+@router.post("/{kind}", response_model=JobResponse, status_code=202, openapi_extra=JOB_OPENAPI_EXTRA)
+async def submit_job(kind: Literal["filter", "nps", "index", "batch", "sweep", "trajectory", "simulate"], request: Request, response: Response,
+                     tenant: str = Header("default", alias="X-Tenant-Id")):
+    """
+    Queues the body of a :filter or returns:{nps,index,batch,sweep,trajectory,simulate} request and answers
+    at once with the job id. The same payload submitted again is the same job (200 instead of 202).
+    The job store is queried in a thread, it may be a file shared with other workers.
+    """
+    payload = await request.body()
+    try:
+        model = JOB_KINDS[kind].model_validate_json(payload)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)])
+    try:
+        key, queued = await run_in_threadpool(job_queue.submit, tenant, kind, model, payload)
+        if not queued:
+            response.status_code = 200
+        return JobResponse(**await run_in_threadpool(job_queue.store.get, key, tenant))
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except JobLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, wait: float = Query(0, ge=0, le=MAX_WAIT_SECONDS),
+                  tenant: str = Header("default", alias="X-Tenant-Id")):
+    """
+    The status of a job; with wait, a long poll answering as soon as the job is finished or after wait seconds.
+    """
+    try:
+        return JobResponse(**await job_queue.wait(job_id, tenant, wait))
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.get("/{job_id}/result")
+def get_job_result(job_id: str, tenant: str = Header("default", alias="X-Tenant-Id")):
+    try:
+        status = job_queue.store.get(job_id, tenant)
+        if status["status"] == "failed":
+            raise HTTPException(status_code=status["statusCode"], detail=status["error"])
+        if status["status"] != "done":
+            raise HTTPException(status_code=409, detail=f"job {job_id} is {status['status']}")
+        return Response(job_queue.store.result(job_id, tenant), media_type="application/json")
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.delete("/{job_id}", status_code=204)
+def delete_job(job_id: str, tenant: str = Header("default", alias="X-Tenant-Id")):
+    try:
+        status = job_queue.store.get(job_id, tenant)
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if not job_queue.store.delete(job_id, tenant):
+        raise HTTPException(status_code=409, detail=f"job {job_id} is {status['status']}, it cannot be deleted")
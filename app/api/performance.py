@@ -1,27 +1,47 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from ..cache import result_cache
+from ..metrics import InstrumentedRoute, registry
 from ..models import PerformanceResponse
-import time
-import psutil
-import threading
 
 
-router = APIRouter()
+router = APIRouter(route_class=InstrumentedRoute)
 
-@router.get("", response_model=PerformanceResponse)
-def get_performance_metrics():
-    start_time = time.perf_counter()
+@router.get("", response_model=PerformanceResponse, response_model_exclude_none=True)
+def get_performance_metrics(detailed: bool = False):
+    # RSS and thread count come from the background sampler; sample now if it is not running
+    if registry.rss_bytes == 0:
+        registry.sample()
 
-    # Memory usage (current process)
-    process = psutil.Process()
-    memory_usage_mb = process.memory_info().rss / (1024 * 1024)
-
-    # Active thread count
-    thread_count = threading.active_count()
-
-    response_time_ms = (time.perf_counter() - start_time) * 1000
+    # mean latency of the requests served so far by this worker
+    response_time_ms = registry.mean_latency_seconds() * 1000
 
+    routes, stages = registry.snapshot() if detailed else (None, None)
+    cache = result_cache.stats() if detailed and result_cache is not None else None
     return PerformanceResponse(
         response_time_ms=round(response_time_ms, 2),
-        memory_usage_mb=round(memory_usage_mb, 2),
-        thread_count=thread_count
+        memory_usage_mb=round(registry.rss_bytes / (1024 * 1024), 2),
+        thread_count=registry.thread_count,
+        routes=routes,
+        stages=stages,
+        cache=cache
     )
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_prometheus_metrics():
+    if registry.rss_bytes == 0:
+        registry.sample()
+    text = registry.prometheus_text()
+    if result_cache is not None:
+        stats = result_cache.stats()
+        text += (
+            "# HELP blk_cache_hits_total Result cache hits.\n# TYPE blk_cache_hits_total counter\n"
+            f"blk_cache_hits_total {stats['hits']}\n"
+            "# HELP blk_cache_misses_total Result cache misses.\n# TYPE blk_cache_misses_total counter\n"
+            f"blk_cache_misses_total {stats['misses']}\n"
+            "# HELP blk_cache_evictions_total Result cache evictions.\n# TYPE blk_cache_evictions_total counter\n"
+            f"blk_cache_evictions_total {stats['evictions']}\n"
+            "# HELP blk_cache_bytes Bytes held by the in memory result cache.\n# TYPE blk_cache_bytes gauge\n"
+            f"blk_cache_bytes {stats['bytes']}\n"
+        )
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, HTTPException
+
+from app.metrics import InstrumentedRoute
+from app.models import RulePlanRequest, RulePlanResponse
+from app.plans import PlanNotFoundError, plan_registry
+
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+@router.post("", response_model=RulePlanResponse)
+def register_plan(request: RulePlanRequest):
+    try:
+        key, plan = plan_registry.register(request)
+        return RulePlanResponse(planId=key, q=len(plan.q), p=len(plan.p), k=len(plan.k))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/{plan_id}", response_model=RulePlanResponse)
+def get_plan(plan_id: str):
+    try:
+        plan = plan_registry.get(plan_id)
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return RulePlanResponse(planId=plan_id, q=len(plan.q), p=len(plan.p), k=len(plan.k))
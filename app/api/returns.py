@@ -1,39 +1,199 @@
-import math
+from fastapi import APIRouter, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Literal
 
-from fastapi import APIRouter, HTTPException
+from app.models import (ReturnBatchRequest, ReturnBatchResponse, ReturnNpsIndexRequest, ReturnSimulationRequest,
+                        ReturnSimulationResponse, ReturnSweepRequest, ReturnSweepResponse, ReturnTrajectoryRequest,
+                        ReturnTrajectoryResponse)
+from app.bulk import stream_bulk_returns
+from app.cache import cache_lookup, cache_store
+from app.executor import PoolSaturatedError, run_pipeline_async
+from app.external import project_chunks
+from app.metrics import InstrumentedRoute
+from app.plans import PlanNotFoundError, resolve_plan
+from app.responses import FastJSONResponse, simulation_body, sweep_body, trajectory_body
+from app.simulation import simulate_growth_async, simulation_params, simulation_seed
+from app.streaming import NDJSON_MEDIA_TYPE, NDJSON_OPENAPI_EXTRA, spool_request_body
+from app.uploads import UploadFormatError, iter_transactions, parse_periods, upload_error, upload_request
+from app.utils import investment_projection_batch, investment_projection_sweep, projection_pipeline, projection_summary
 
-from app.models import ReturnNpsIndexRequest
-from app.utils import investment_projection_engine
 
+router = APIRouter(route_class=InstrumentedRoute)
 
-router = APIRouter()
+async def run_projection(pipeline, request, upload=None):
+    """
+    Runs the projection pipeline of a returns request. With an upload, the transactions are read from its file
+    chunk by chunk and projected out of core (see external.project_chunks) instead of taken from request.transaction.
+    """
+    if upload is None:
+        return await run_pipeline_async(pipeline, request.transaction)
+    try:
+        return await run_in_threadpool(project_chunks, pipeline, iter_transactions(upload.file))
+    except UploadFormatError as e:
+        raise upload_error(e)
 
-@router.post(":nps")
-def calculate_nps_index(request: ReturnNpsIndexRequest):
+async def projection_body(request: ReturnNpsIndexRequest, mode: str, upload=None):
+    """
+    Totals and K period projections of a returns:nps / returns:index request, from one pipeline pass.
+    """
+    pipeline = projection_pipeline(request, resolve_plan(request), mode=mode)
+    result = await run_projection(pipeline, request, upload)
+    return projection_summary(request, pipeline.plan.k, result, mode)
+
+async def nps_index_response(request: ReturnNpsIndexRequest, mode: str, upload=None):
     try:
-        total_transaction_amount = 0
-        total_ceiling_amount = 0
-        for transaction in request.transaction:
-            if transaction.amount < 0:
-                continue
-            total_transaction_amount += transaction.amount
-            total_ceiling_amount += math.ceil(transaction.amount / 100) * 100
-        result = investment_projection_engine(payload=request, mode="nps")
-        return {"totalTransactionAmount": total_transaction_amount, "totalCeilingAmount": total_ceiling_amount, "savingsByDates": result}
+        if upload is not None:
+            # out of core uploads are not hashed for the cache, that would mean reading them twice
+            return FastJSONResponse(await projection_body(request, mode, upload))
+        key, cached = await cache_lookup(mode, request, sort_transactions=True)
+        if cached is not None:
+            return cached
+        return await cache_store(key, FastJSONResponse(await projection_body(request, mode)))
+    except RequestValidationError:
+        raise
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         return HTTPException(status_code=400, detail=str(e))
-    
-@router.post(":index")
-def calculate_performance_index(request: ReturnNpsIndexRequest):
+
+async def batch_response(request: ReturnBatchRequest, upload=None):
+    try:
+        pipeline = projection_pipeline(request, resolve_plan(request))
+        result = await run_projection(pipeline, request, upload)
+        projections = investment_projection_batch(request, result.k_sums, pipeline.plan.k)
+        return ReturnBatchResponse(
+            totalTransactionAmount=result.total_transaction_amount,
+            totalCeilingAmount=result.total_ceiling_amount,
+            projections=projections
+        )
+    except RequestValidationError:
+        raise
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        return HTTPException(status_code=400, detail=str(e))
+
+async def sweep_response(request: ReturnSweepRequest, upload=None):
     try:
-        total_transaction_amount = 0
-        total_ceiling_amount = 0
-        for transaction in request.transaction:
-            if transaction.amount < 0:
-                continue
-            total_transaction_amount += transaction.amount
-            total_ceiling_amount += math.ceil(transaction.amount / 100) * 100
-        result = investment_projection_engine(payload=request, mode="index")
-        return {"totalTransactionAmount": total_transaction_amount, "totalCeilingAmount": total_ceiling_amount, "savingsByDates": result}
+        pipeline = projection_pipeline(request, resolve_plan(request))
+        request.check_cells(len(pipeline.plan.k))
+        result = await run_projection(pipeline, request, upload)
+        scenarios, profit_rows, tax_rows = await run_in_threadpool(investment_projection_sweep, request, result.k_sums)
+        totals = (result.total_transaction_amount, result.total_ceiling_amount)
+        return FastJSONResponse(sweep_body(totals, pipeline.plan.k, result.k_sums, scenarios, profit_rows, tax_rows))
+    except RequestValidationError:
+        raise
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
-        return HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        return HTTPException(status_code=400, detail=str(e))
+
+async def trajectory_response(request: ReturnTrajectoryRequest):
+    try:
+        pipeline = projection_pipeline(request, resolve_plan(request))
+        request.check_cells(len(pipeline.plan.k))
+        result = await run_projection(pipeline, request)
+        return FastJSONResponse(await run_in_threadpool(trajectory_body, request, pipeline.plan.k, result))
+    except RequestValidationError:
+        raise
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        return HTTPException(status_code=400, detail=str(e))
+
+async def simulation_response(request: ReturnSimulationRequest):
+    try:
+        pipeline = projection_pipeline(request, resolve_plan(request))
+        result = await run_projection(pipeline, request)
+        seed = simulation_seed(request)
+        _, _, years, mu, sigma = simulation_params(request)
+        growth = await simulate_growth_async(seed, request.paths, years, mu, sigma)
+        return FastJSONResponse(await run_in_threadpool(simulation_body, request, pipeline.plan.k, result, seed, growth))
+    except RequestValidationError:
+        raise
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        return HTTPException(status_code=400, detail=str(e))
+
+@router.post(":nps")
+async def calculate_nps_index(request: ReturnNpsIndexRequest):
+    return await nps_index_response(request, "nps")
+
+@router.post(":index")
+async def calculate_performance_index(request: ReturnNpsIndexRequest):
+    return await nps_index_response(request, "index")
+
+@router.post(":batch", response_model=ReturnBatchResponse)
+async def calculate_batch(request: ReturnBatchRequest):
+    return await batch_response(request)
+
+@router.post(":sweep", response_model=ReturnSweepResponse)
+async def calculate_sweep(request: ReturnSweepRequest):
+    return await sweep_response(request)
+
+@router.post(":trajectory", response_model=ReturnTrajectoryResponse)
+async def calculate_trajectory(request: ReturnTrajectoryRequest):
+    return await trajectory_response(request)
+
+@router.post(":simulate", response_model=ReturnSimulationResponse)
+async def calculate_simulation(request: ReturnSimulationRequest):
+    return await simulation_response(request)
+
+@router.post(":bulk", openapi_extra=NDJSON_OPENAPI_EXTRA)
+async def calculate_bulk(request: Request, mode: Literal["nps", "index"] = "nps"):
+    """
+    returns:nps / returns:index for many portfolios, one request per NDJSON line; see bulk.stream_bulk_returns.
+    """
+    body = await spool_request_body(request)
+    return StreamingResponse(stream_bulk_returns(body, mode), media_type=NDJSON_MEDIA_TYPE)
+
+
+
+# the same endpoints for a CSV or binary columnar transaction file (see app.uploads), with the rest of the
+# request as a JSON form field. With outOfCore=true the file is projected chunk by chunk instead of being
+# loaded whole, so its size is not bounded by memory.
+
+async def upload_arguments(model, file: UploadFile, periods: str, out_of_core: bool):
+    """
+    The request of an upload and, out of core, the upload its transactions are streamed from.
+    """
+    if out_of_core:
+        return parse_periods(model, periods), file
+    return await upload_request(model, file, periods), None
+
+@router.post(":npsUpload")
+async def calculate_nps_index_upload(file: UploadFile = File(...), periods: str = Form(...),
+                                     out_of_core: bool = Query(False, alias="outOfCore")):
+    request, upload = await upload_arguments(ReturnNpsIndexRequest, file, periods, out_of_core)
+    return await nps_index_response(request, "nps", upload)
+
+@router.post(":indexUpload")
+async def calculate_performance_index_upload(file: UploadFile = File(...), periods: str = Form(...),
+                                             out_of_core: bool = Query(False, alias="outOfCore")):
+    request, upload = await upload_arguments(ReturnNpsIndexRequest, file, periods, out_of_core)
+    return await nps_index_response(request, "index", upload)
+
+@router.post(":batchUpload", response_model=ReturnBatchResponse)
+async def calculate_batch_upload(file: UploadFile = File(...), periods: str = Form(...),
+                                 out_of_core: bool = Query(False, alias="outOfCore")):
+    request, upload = await upload_arguments(ReturnBatchRequest, file, periods, out_of_core)
+    return await batch_response(request, upload)
+
+@router.post(":sweepUpload", response_model=ReturnSweepResponse)
+async def calculate_sweep_upload(file: UploadFile = File(...), periods: str = Form(...),
+                                 out_of_core: bool = Query(False, alias="outOfCore")):
+    request, upload = await upload_arguments(ReturnSweepRequest, file, periods, out_of_core)
+    return await sweep_response(request, upload)
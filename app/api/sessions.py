@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Body, HTTPException
+from typing import Literal
+
+from app.metrics import InstrumentedRoute
+from app.batch import TransactionBatch
+from app.models import ReturnNpsIndexRequest, SessionResponse
+from app.plans import PlanNotFoundError, resolve_plan
+from app.responses import FastJSONResponse
+from app.sessions import session_store
+
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+def _get_session(session_id: str):
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"session {session_id} not found")
+    return session
+
+@router.post("", response_model=SessionResponse)
+def create_session(request: ReturnNpsIndexRequest):
+    try:
+        session = session_store.create(request, resolve_plan(request))
+        return SessionResponse(id=session.id, transactionCount=session.transaction_count)
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/{session_id}/transactions", response_model=SessionResponse)
+def append_session_transactions(session_id: str, request: TransactionBatch = Body()):
+    session = _get_session(session_id)
+    try:
+        session_store.add_transactions(session, request)
+        return SessionResponse(id=session.id, transactionCount=session.transaction_count)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/{session_id}/returns")
+def get_session_returns(session_id: str, mode: Literal["nps", "index"] = "nps"):
+    session = _get_session(session_id)
+    try:
+        return FastJSONResponse(session.returns(mode))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.delete("/{session_id}", status_code=204)
+def delete_session(session_id: str):
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"session {session_id} not found")
@@ -1,18 +1,30 @@
-from bisect import bisect_left, bisect_right
-import math
-
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from typing import List
-from ..models import (TransactionInvalidResponse, TransactionParseRequest, TransactionParseResponse, 
-                      TransactionValidateRequest, TransactionFilterRequest, FilteredTransactionResponse)
-from ..utils import apply_p_rule, apply_q_rule, calculate_ceiling_and_remanent
+from ..cache import cache_lookup, cache_store
+from ..dedup import DedupNotFoundError, resolve_dedup
+from ..executor import PoolSaturatedError, run_pipeline_async
+from ..metrics import InstrumentedRoute
+from ..plans import PlanNotFoundError, resolve_plan
+from ..models import (TransactionParseRequest, TransactionParseResponse,
+                      TransactionValidateRequest, TransactionFilterRequest)
+from ..responses import FastJSONResponse, filtered_rows, parse_rows
+from ..uploads import iter_transactions, parse_periods, read_upload, upload_request
+from ..streaming import (NDJSON_MEDIA_TYPE, NDJSON_OPENAPI_EXTRA, spool_request_body,
+                         stream_filter, stream_filter_external, stream_parse, stream_validate)
+from ..utils import (FILTER_STAGES, VALIDATE_STAGES, TransactionPipeline, calculate_ceiling_and_remanent,
+                     filtered_transaction_models)
 
 
-router = APIRouter()
+router = APIRouter(route_class=InstrumentedRoute)
 
 @router.post(":parse", response_model=List[TransactionParseResponse])
-def parse_transactions(transactions: List[TransactionParseRequest]):
+def parse_transactions(transactions: List[TransactionParseRequest], fast: bool = False):
     try:
+        if fast:
+            return FastJSONResponse(parse_rows(transactions))
+
         result = []
 
         for transaction in transactions:
@@ -31,82 +43,90 @@ def parse_transactions(transactions: List[TransactionParseRequest]):
     except Exception as e:
         return HTTPException(status_code=400, detail=str(e))
 
+def _resolve_dedup(dedup_id):
+    try:
+        return resolve_dedup(dedup_id)
+    except DedupNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
 @router.post(":validate")
-def validate_transactions(request: TransactionValidateRequest):
+def validate_transactions(request: TransactionValidateRequest, dedup_id: str | None = Query(None, alias="dedupId")):
+    dedup = _resolve_dedup(dedup_id)
     try:
-        valid = []
-        invalid = []
-        seen_before = {}
-        for transaction in request.transaction:
-            if transaction.amount<0:
-                invalid.append(TransactionInvalidResponse(
-                        date=transaction.date,
-                        amount=transaction.amount,
-                        message="negative amounts are not allowed"
-                    ))
-            elif seen_before.get(transaction.date) == transaction.amount:
-                invalid.append(TransactionInvalidResponse(
-                        date=transaction.date,
-                        amount=transaction.amount,
-                        message="Duplicate transactions"
-                    ))
-            else:
-                seen_before[transaction.date] = transaction.amount
-                valid.append(transaction)
-        return {"valid": valid, "invalid": invalid}
+        result = TransactionPipeline(VALIDATE_STAGES).run(request.transaction, dedup)
+        return {"valid": result.transactions, "invalid": result.invalid}
     except Exception as e:
         return HTTPException(status_code=400, detail=str(e))
 
 @router.post(":filter")
-def filter_transactions(request: TransactionFilterRequest):
+async def filter_transactions(request: TransactionFilterRequest, fast: bool = False,
+                              dedup_id: str | None = Query(None, alias="dedupId")):
+    dedup = _resolve_dedup(dedup_id)
     try:
-        valid = []
-        invalid = []
-        seen_before = {}
-        for transaction in request.transaction:
-            if transaction.amount<0:
-                invalid.append(TransactionInvalidResponse(
-                        date=transaction.date,
-                        amount=transaction.amount,
-                        message="negative amounts are not allowed"
-                    ))
-            elif seen_before.get(transaction.date) == transaction.amount:
-                invalid.append(TransactionInvalidResponse(
-                        date=transaction.date,
-                        amount=transaction.amount,
-                        message="Duplicate transactions"
-                    ))
-            else:
-                seen_before[transaction.date] = transaction.amount
-                valid.append(transaction)
-        transactions_sorted = sorted(valid, key=lambda t: t.date)
-
-        ceil_values = []
-        remanents = []
-
-        for txn in transactions_sorted:
-            ceil_val = math.ceil(txn.amount / 100) * 100
-            ceil_values.append(ceil_val)
-            remanents.append(ceil_val - txn.amount)
-        q_periods = request.q
-        p_periods = request.p
-        remanents = apply_q_rule(transactions_sorted, remanents, q_periods)
-
-        remanents = apply_p_rule(transactions_sorted, remanents, p_periods)
-
-        k_periods = request.k
-        validate_transactions = []
-        for i, txn in enumerate(transactions_sorted):
-            in_k_period = any(k.start <= txn.date <= k.end for k in k_periods)
-            if remanents[i] == 0:
-                continue
-            validate_transactions.append(FilteredTransactionResponse(
-                date=txn.date,
-                amount=txn.amount,
-                ceiling=ceil_values[i],
-                remanent=remanents[i],
-                inKPeriod=in_k_period
-            ))
-        return {"valid": validate_transactions, "invalid": invalid}
+        # with a shared dedup state the result depends on the previous requests, so it is not cached;
+        # the fast and model serializations are cached apart, so a difference between them never crosses over
+        kind = "filter:fast" if fast else "filter"
+        key, cached = await cache_lookup(kind, request, sort_transactions=False) if dedup is None else (None, None)
+        if cached is not None:
+            return cached
+        pipeline = TransactionPipeline(FILTER_STAGES, resolve_plan(request))
+        result = await run_pipeline_async(pipeline, request.transaction, dedup)
+        rows = await run_in_threadpool(result.filter_rows)
+        if fast:
+            return await cache_store(key, FastJSONResponse({"valid": filtered_rows(rows), "invalid": result.invalid}))
+
+        validate_transactions = await run_in_threadpool(filtered_transaction_models, rows)
+        return await cache_store(key, FastJSONResponse({"valid": validate_transactions, "invalid": result.invalid}))
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
-        return HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        return HTTPException(status_code=400, detail=str(e))
+
+@router.post(":parseStream", openapi_extra=NDJSON_OPENAPI_EXTRA)
+async def parse_transactions_stream(request: Request):
+    body = await spool_request_body(request)
+    return StreamingResponse(stream_parse(body), media_type=NDJSON_MEDIA_TYPE)
+
+@router.post(":validateStream", openapi_extra=NDJSON_OPENAPI_EXTRA)
+async def validate_transactions_stream(request: Request, dedup_id: str | None = Query(None, alias="dedupId")):
+    dedup = _resolve_dedup(dedup_id)
+    body = await spool_request_body(request)
+    return StreamingResponse(stream_validate(body, dedup), media_type=NDJSON_MEDIA_TYPE)
+
+@router.post(":filterStream", openapi_extra=NDJSON_OPENAPI_EXTRA)
+async def filter_transactions_stream(request: Request, dedup_id: str | None = Query(None, alias="dedupId")):
+    dedup = _resolve_dedup(dedup_id)
+    body = await spool_request_body(request)
+    return StreamingResponse(stream_filter(body, dedup), media_type=NDJSON_MEDIA_TYPE)
+
+@router.post(":parseUpload", response_model=List[TransactionParseResponse])
+async def parse_transactions_upload(file: UploadFile = File(...)):
+    """
+    :parse for a CSV or binary columnar file, see app.uploads.
+    """
+    transactions = await read_upload(file)
+    try:
+        return FastJSONResponse(await run_in_threadpool(parse_rows, transactions))
+    except Exception as e:
+        return HTTPException(status_code=400, detail=str(e))
+
+@router.post(":filterUpload")
+async def filter_transactions_upload(file: UploadFile = File(...), periods: str = Form(...), fast: bool = False,
+                                     out_of_core: bool = Query(False, alias="outOfCore"),
+                                     dedup_id: str | None = Query(None, alias="dedupId")):
+    """
+    :filter for a CSV or binary columnar file, with the periods and the wage as a JSON form field.
+    With outOfCore=true the file is sorted externally and the result streamed as NDJSON, see stream_filter_external.
+    """
+    if not out_of_core:
+        return await filter_transactions(await upload_request(TransactionFilterRequest, file, periods), fast, dedup_id)
+    dedup = _resolve_dedup(dedup_id)
+    request = parse_periods(TransactionFilterRequest, periods)
+    try:
+        plan = resolve_plan(request)
+    except PlanNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    chunks = iter_transactions(file.file)
+    return StreamingResponse(stream_filter_external(chunks, plan, dedup), media_type=NDJSON_MEDIA_TYPE)
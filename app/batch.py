@@ -0,0 +1,187 @@
+from array import array
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from pydantic_core import core_schema
+
+from app import columnar
+from app.columnar import EPOCH, to_epoch
+from app.dedup import DedupState
+from app.dates import format_datetime, parse_datetime
+
+DATE_ERROR = 'date must be in format "YYYY-MM-DD HH:mm:ss"'
+
+
+class TransactionRow(NamedTuple):
+    date: datetime
+    amount: float
+
+
+def from_epoch(epoch: int) -> datetime:
+    return EPOCH + timedelta(seconds=epoch)
+
+
+def _epoch_of(value) -> int:
+    if isinstance(value, datetime):
+        return to_epoch(value)
+    if isinstance(value, str):
+        try:
+            return to_epoch(parse_datetime(value))
+        except ValueError:
+            pass
+    raise ValueError(DATE_ERROR)
+
+
+def _amount_of(value) -> float:
+    if isinstance(value, bool):
+        raise ValueError("amount must be a number")
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        return float(value)
+    raise ValueError("amount must be a number")
+
+
+class TransactionBatch:
+    """
+    Compact column store of transactions: epoch seconds in an array('q') and amounts in an array('d'),
+    16 bytes per row instead of a Pydantic model, a datetime and a float. Request models validate their
+    "transaction" list straight into it (see __get_pydantic_core_schema__) and the engine works on the columns;
+    rows are only materialized, as TransactionRow tuples, when iterating.
+    """
+
+    __slots__ = ("epochs", "amounts")
+
+    def __init__(self, epochs=None, amounts=None):
+        self.epochs = epochs if epochs is not None else array("q")
+        self.amounts = amounts if amounts is not None else array("d")
+
+    @classmethod
+    def from_transactions(cls, transactions):
+        """
+        This function packs objects with a date and an amount (models, rows or dicts) into a batch.
+        """
+        epochs = array("q")
+        amounts = array("d")
+        for i, transaction in enumerate(transactions):
+            try:
+                if isinstance(transaction, dict):
+                    date, amount = transaction["date"], transaction["amount"]
+                else:
+                    date, amount = transaction.date, transaction.amount
+                epochs.append(_epoch_of(date))
+                amounts.append(_amount_of(amount))
+            except (KeyError, AttributeError) as e:
+                raise ValueError(f"transaction {i}: missing {e}")
+            except (ValueError, OverflowError) as e:
+                raise ValueError(f"transaction {i}: {e}")
+        return cls(epochs, amounts)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        This function packs validated {"date": datetime, "amount": float} rows into a batch.
+        """
+        return cls(array("q", [to_epoch(row["date"]) for row in rows]), array("d", [row["amount"] for row in rows]))
+
+    @classmethod
+    def validate(cls, value, handler=None):
+        """
+        Wrap validator of the core schema: a batch passes through, a list of objects is packed directly and a list
+        of dicts (parsed JSON) goes through the row schema first, so errors point at the failing row and field.
+        """
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, (list, tuple)) and value and not isinstance(value[0], dict):
+            return cls.from_transactions(value)
+        if handler is None:
+            return cls.from_transactions(value)
+        return cls.from_rows(handler(value))
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source_type, handler):
+        from app.models import CustomDateTime
+
+        row_schema = core_schema.typed_dict_schema({
+            "date": core_schema.typed_dict_field(handler.generate_schema(CustomDateTime)),
+            "amount": core_schema.typed_dict_field(core_schema.float_schema()),
+        })
+        return core_schema.no_info_wrap_validator_function(
+            cls.validate,
+            core_schema.list_schema(row_schema),
+            serialization=core_schema.plain_serializer_function_ser_schema(cls.to_rows),
+        )
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __iter__(self):
+        for epoch, amount in zip(self.epochs, self.amounts):
+            yield TransactionRow(from_epoch(epoch), amount)
+
+    def __eq__(self, other):
+        return isinstance(other, TransactionBatch) and self.epochs == other.epochs and self.amounts == other.amounts
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.epochs) * self.epochs.itemsize + len(self.amounts) * self.amounts.itemsize
+
+    def to_rows(self):
+        return [{"date": format_datetime(from_epoch(epoch)), "amount": amount} for epoch, amount in zip(self.epochs, self.amounts)]
+
+    def columns(self):
+        """
+        The batch as (epochs int64, amounts float64) numpy arrays sharing its memory.
+        """
+        return columnar.np.frombuffer(self.epochs, dtype=columnar.np.int64), columnar.np.frombuffer(self.amounts, dtype=columnar.np.float64)
+
+    def sorted(self) -> "TransactionBatch":
+        """
+        A copy of the batch sorted by date, keeping the arrival order of equal dates.
+        """
+        if columnar.HAS_NUMPY:
+            epochs, amounts = self.columns()
+            order = columnar.np.argsort(epochs, kind="stable")
+            return TransactionBatch(array("q", epochs[order].tobytes()), array("d", amounts[order].tobytes()))
+        order = sorted(range(len(self.epochs)), key=self.epochs.__getitem__)
+        return TransactionBatch(array("q", [self.epochs[i] for i in order]), array("d", [self.amounts[i] for i in order]))
+
+    def split_valid_invalid(self, dedup=None):
+        """
+        Batch version of utils.split_valid_invalid: returns the valid rows as a batch (arrival order kept) and
+        the rejected ones as TransactionInvalidResponse models. dedup is the DedupState to share across chunks.
+        """
+        from app.models import TransactionInvalidResponse
+
+        if dedup is None:
+            dedup = DedupState()
+        candidates = [i for i, amount in enumerate(self.amounts) if amount >= 0]
+        duplicates = dedup.check(array("q", [self.epochs[i] for i in candidates]), array("d", [self.amounts[i] for i in candidates]))
+        rejected = dict(zip(candidates, duplicates))
+
+        epochs = array("q")
+        amounts = array("d")
+        invalid = []
+        for i, (epoch, amount) in enumerate(zip(self.epochs, self.amounts)):
+            duplicate = rejected.get(i)
+            if duplicate is None:
+                invalid.append(TransactionInvalidResponse(
+                    date=from_epoch(epoch), amount=amount, message="negative amounts are not allowed"
+                ))
+            elif duplicate:
+                invalid.append(TransactionInvalidResponse(
+                    date=from_epoch(epoch), amount=amount, message="Duplicate transactions"
+                ))
+            else:
+                epochs.append(epoch)
+                amounts.append(amount)
+        return TransactionBatch(epochs, amounts), invalid
+
+    def canonical_bytes(self, sort: bool) -> bytes:
+        """
+        The rows as bytes for content hashing, optionally in (date, amount) order.
+        """
+        if not sort:
+            return self.epochs.tobytes() + self.amounts.tobytes()
+        pairs = sorted(zip(self.epochs, self.amounts))
+        return array("q", [p[0] for p in pairs]).tobytes() + array("d", [p[1] for p in pairs]).tobytes()
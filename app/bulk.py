@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+import re
+
+from pydantic import ValidationError
+from pydantic_core import to_json
+from starlette.concurrency import run_in_threadpool
+
+from app.executor import PoolSaturatedError, compute_pool
+from app.models import ReturnBulkItem, RulePlanRequest
+from app.plans import PlanNotFoundError, plan_body, plan_registry
+from app.streaming import error_line, iter_lines
+from app.utils import projection_pipeline, projection_summary, rule_plan
+
+# portfolios validated and projected together, in one process pool job
+BULK_GROUP_SIZE = int(os.getenv("BLK_BULK_GROUP_SIZE", "256"))
+
+_PLAN_ID = re.compile(rb'"planId"\s*:\s*"([^"\\]*)"')
+
+
+def _item_id(line: bytes):
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return None
+    return data.get("id") if isinstance(data, dict) else None
+
+
+def portfolio_line(line_number: int, line: bytes, mode: str, plans: dict) -> bytes:
+    """
+    This function validates and projects one portfolio of a bulk request and returns its NDJSON output line:
+    the returns:nps / returns:index response with the line number and id of the portfolio, or its error and the
+    HTTP status the single portfolio endpoint would have answered.
+    """
+    item = {"line": line_number}
+    try:
+        request = ReturnBulkItem.model_validate_json(line)
+        item["id"] = request.id
+        if request.planId is None:
+            plan = rule_plan(request)
+        elif request.planId in plans:
+            plan = plans[request.planId]
+        else:
+            raise PlanNotFoundError(f"plan {request.planId} not found, register it again with POST /plans")
+        pipeline = projection_pipeline(request, plan, mode=mode)
+        result = pipeline.run(request.transaction)
+        return to_json({**item, **projection_summary(request, pipeline.plan.k, result, mode)}) + b"\n"
+    except ValidationError as e:
+        if "id" not in item:
+            item["id"] = _item_id(line)
+        # the input of the errors is left out, it can be the whole portfolio
+        return to_json({**item, "status": 422, "error": json.loads(e.json(include_url=False, include_input=False))}) + b"\n"
+    except PlanNotFoundError as e:
+        return to_json({**item, "status": 404, "error": str(e)}) + b"\n"
+    except Exception as e:
+        return to_json({**item, "status": 400, "error": str(e)}) + b"\n"
+
+
+def project_portfolios(lines, mode: str, plans: dict) -> bytes:
+    """
+    This function projects a group of (line number, JSON line) portfolios. It is the process pool job of a bulk
+    request: the lines and the plan bodies (plan id -> POST /plans body) go in and the NDJSON output comes back as
+    bytes, so no Pydantic object crosses processes. The plans are registered in the registry of the process, so the
+    groups a worker projects next do not compile them again.
+    """
+    plans = {key: plan_registry.register(RulePlanRequest.model_validate_json(body))[1] for key, body in plans.items()}
+    return b"".join(portfolio_line(line_number, line, mode, plans) for line_number, line in lines)
+
+
+def iter_groups(lines, group_size: int):
+    """
+    This function groups the NDJSON lines of a bulk request by group_size, with the bodies of the registered plans
+    the group refers to: the workers have their own plan registry, so the plans are resolved here and sent along.
+    """
+    group, plans = [], {}
+    for line_number, line in lines:
+        match = _PLAN_ID.search(line)
+        if match is not None and match.group(1).decode() not in plans:
+            key = match.group(1).decode()
+            try:
+                plans[key] = plan_body(plan_registry.get(key))
+            except PlanNotFoundError:
+                # reported by the worker, with the rest of the errors of the portfolio
+                pass
+        group.append((line_number, line))
+        if len(group) >= group_size:
+            yield group, plans
+            group, plans = [], {}
+    if group:
+        yield group, plans
+
+
+async def _project_group(group, plans, mode: str, offload: bool) -> bytes:
+    if not offload:
+        return await run_in_threadpool(project_portfolios, group, mode, plans)
+    try:
+        return await compute_pool.submit(project_portfolios, group, mode, plans)
+    except PoolSaturatedError as e:
+        # the 429 the single portfolio endpoint would answer, for every portfolio of the group, to be retried
+        return b"".join(
+            to_json({"line": line_number, "id": _item_id(line), "status": 429, "error": str(e)}) + b"\n"
+            for line_number, line in group
+        )
+
+
+async def stream_bulk_returns(body, mode: str):
+    """
+    Bulk version of returns:nps / returns:index: one portfolio (a returns request with an optional id) per input line,
+    one result or error line per portfolio out. Groups of BULK_GROUP_SIZE portfolios are projected in parallel in the
+    process pool, at most one per worker at a time so the pool queue has room for other requests, and every group is
+    written as soon as it completes, so the output lines are not in input order (their "line" field gives it). The
+    portfolios of a group the saturated pool rejects get a 429 line each. A bulk of a single group is projected in a
+    thread.
+    """
+    groups = iter_groups(iter_lines(body), BULK_GROUP_SIZE)
+    limit = max(compute_pool.workers, 1)
+    pending = set()
+    try:
+        group = await run_in_threadpool(next, groups, None)
+        offload = False
+        while group is not None or pending:
+            while group is not None and len(pending) < limit:
+                following = await run_in_threadpool(next, groups, None)
+                offload = offload or (compute_pool.workers > 0 and following is not None)
+                pending.add(asyncio.ensure_future(_project_group(*group, mode, offload)))
+                group = following
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    except Exception as e:
+        yield error_line(e)
+    finally:
+        for task in pending:
+            task.cancel()
+        groups.close()
@@ -0,0 +1,210 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.responses import Response
+from pydantic_core import to_json
+from starlette.concurrency import run_in_threadpool
+
+CACHE_ENABLED = os.getenv("BLK_CACHE_ENABLED", "1") != "0"
+CACHE_MAX_ENTRIES = int(os.getenv("BLK_CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_BYTES = int(os.getenv("BLK_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_TTL_SECONDS = float(os.getenv("BLK_CACHE_TTL_SECONDS", "3600"))
+# optional SQLite file so cached results survive worker restarts
+CACHE_PATH = os.getenv("BLK_CACHE_PATH")
+
+
+def _periods(periods, value_attr=None):
+    if value_attr is None:
+        return [[period.start, period.end] for period in periods]
+    return [[period.start, period.end, getattr(period, value_attr)] for period in periods]
+
+
+def request_key(kind: str, request, sort_transactions: bool) -> str:
+    """
+    This function returns a content hash of a validated request. The returns endpoints sort the transactions
+    before using them, so their key sorts them too; :filter keeps the arrival order because its duplicate
+    detection and invalid list depend on it. The periods always keep their order (it decides Q ties and the
+    order of the K results).
+    """
+    canonical = [
+        kind,
+        _periods(request.q, "fixed"),
+        _periods(request.p, "extra"),
+        _periods(request.k),
+        # plan ids are content hashes of their periods
+        getattr(request, "planId", None),
+        request.wage,
+        getattr(request, "age", None),
+        getattr(request, "inflation", None),
+        getattr(request, "compounding", None),
+        getattr(request, "asOf", None),
+    ]
+    digest = hashlib.blake2b(to_json(canonical), digest_size=20)
+    # the transactions are hashed straight from their columns
+    digest.update(request.transaction.canonical_bytes(sort_transactions))
+    return digest.hexdigest()
+
+
+class SqliteStore:
+    """
+    On disk backend of the result cache: one row per key with its expiry and last access time.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+
+    def get(self, key: str, now: float):
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            if row[1] <= now:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None, None
+            self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+
+    def put(self, key: str, value: bytes, expires: float, now: float):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires, now),
+            )
+            self._db.execute("DELETE FROM results WHERE expires <= ?", (now,))
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            # drop the least recently used rows until the file holds at most max_bytes of results
+            while total > self.max_bytes:
+                row = self._db.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 1").fetchone()
+                if row is None:
+                    break
+                self._db.execute("DELETE FROM results WHERE key = ?", (row[0],))
+                total -= row[1]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM results")
+
+
+class ResultCache:
+    """
+    LRU cache of serialized responses with a TTL and both an entry count and a byte cap.
+    With a path, entries are also written through to SQLite and read back on a memory miss.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = SqliteStore(path, max_bytes) if path else None
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(key)
+        if self._disk is not None:
+            value, expires = self._disk.get(key, now)
+            if value is not None:
+                with self._lock:
+                    self.hits += 1
+                    self._insert(key, value, expires)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: bytes):
+        now = time.time()
+        expires = now + self.ttl_seconds
+        if len(value) <= self.max_bytes:
+            with self._lock:
+                self._insert(key, value, expires)
+        if self._disk is not None:
+            self._disk.put(key, value, expires, now)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _insert(self, key, value, expires):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires)
+        self.bytes += len(value)
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.bytes -= len(value)
+
+
+result_cache = ResultCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL_SECONDS, CACHE_PATH) if CACHE_ENABLED else None
+
+
+async def _cache_call(func, *args):
+    # the SQLite backend queries and writes under a lock, so it runs off the event loop; the memory one is a dict lookup
+    if result_cache._disk is not None:
+        return await run_in_threadpool(func, *args)
+    return func(*args)
+
+
+async def cache_lookup(kind: str, request, sort_transactions: bool):
+    """
+    This function returns the cache key of a request and the cached response for it, if any.
+    The key is None when the cache is disabled.
+    """
+    if result_cache is None:
+        return None, None
+    key = await run_in_threadpool(request_key, kind, request, sort_transactions)
+    body = await _cache_call(result_cache.get, key)
+    if body is None:
+        return key, None
+    return key, Response(body, media_type="application/json", headers={"X-Cache": "hit"})
+
+
+async def cache_store(key, response):
+    """
+    This function stores the pre-serialized body of a FastJSONResponse under key and returns the response.
+    """
+    if key is not None:
+        await _cache_call(result_cache.put, key, response.body)
+        response.headers["X-Cache"] = "miss"
+    return response
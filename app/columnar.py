@@ -0,0 +1,273 @@
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional, utils falls back to pure python
+    np = None
+
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+
+from app.metrics import stage
+
+EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+# decimals of the K window sums: they are money amounts, and a difference of two prefix sums carries
+# cancellation error (100.00000000000001 for 100) that must not reach the responses
+AMOUNT_DECIMALS = 2
+
+HAS_NUMPY = np is not None
+
+
+def to_epoch(date: datetime) -> int:
+    return (date - EPOCH) // ONE_SECOND
+
+
+def to_columns(transactions):
+    """
+    This function converts a list of transactions (already sorted by date) into
+    an int64 array of epoch seconds and a float64 array of amounts.
+    """
+    epochs = dates_to_epochs([txn.date for txn in transactions])
+    amounts = np.fromiter((txn.amount for txn in transactions), dtype=np.float64, count=len(transactions))
+    return epochs, amounts
+
+
+def dates_to_epochs(dates):
+    """
+    This function converts a list of naive datetimes into an int64 array of epoch seconds.
+    Plain timedelta arithmetic is several times faster than numpy's datetime64 conversion of datetime objects.
+    """
+    return np.fromiter(((date - EPOCH) // ONE_SECOND for date in dates), dtype=np.int64, count=len(dates))
+
+
+def ceiling_and_remanent(amounts):
+    """
+    Vectorized version of calculate_ceiling_and_remanent: rounds every amount up to the next 100.
+    """
+    ceilings = np.ceil(amounts / 100) * 100
+    return ceilings, ceilings - amounts
+
+
+def period_columns(periods, value_attr=None):
+    """
+    This function flattens Q/P/K periods into (starts, ends) epoch arrays, plus a float64 array of
+    the value_attr field ("fixed" or "extra") when given. The result is cheap to pickle.
+    """
+    starts = dates_to_epochs([period.start for period in periods])
+    ends = dates_to_epochs([period.end for period in periods])
+    if value_attr is None:
+        return starts, ends
+    values = np.array([getattr(period, value_attr) for period in periods], dtype=np.float64)
+    return starts, ends, values
+
+
+def q_segments(starts, ends, fixed):
+    """
+    This function resolves possibly overlapping Q periods (epoch seconds, end inclusive) into a map of disjoint
+    segments: segment i covers [bounds[i], bounds[i + 1]) and its effective fixed value is values[i], or None
+    where no Q period is active. Where periods overlap, the one with the latest start wins, and among equal starts
+    the one listed last. A sweep over the sorted boundaries with a heap of the active periods builds the map in
+    O(q log q), so resolving n transactions against it is O(n log q) whatever the overlap.
+    Plain python on purpose: it is shared by the numpy and the pure python engines.
+    """
+    # rank = position in the (stable) order by start, the higher rank wins
+    order = sorted(range(len(starts)), key=lambda i: starts[i])
+    events = sorted(
+        [(int(starts[i]), rank, i) for rank, i in enumerate(order) if starts[i] <= ends[i]]
+        + [(int(ends[i]) + 1, -1, i) for i in order if starts[i] <= ends[i]]
+    )
+
+    bounds = []
+    values = []
+    active = []
+    ended = set()
+    e = 0
+    n = len(events)
+    while e < n:
+        point = events[e][0]
+        while e < n and events[e][0] == point:
+            _, rank, i = events[e]
+            if rank < 0:
+                ended.add(i)
+            else:
+                heappush(active, (-rank, i))
+            e += 1
+        # drop the ended periods lazily, only when they reach the top
+        while active and active[0][1] in ended:
+            heappop(active)
+        value = fixed[active[0][1]] if active else None
+        if values and values[-1] == value:
+            continue
+        bounds.append(point)
+        values.append(value)
+    return bounds, values
+
+
+def segment_columns(bounds, values):
+    """
+    This function packs a q_segments map into (bounds int64, fixed float64, covered bool) arrays.
+    """
+    return (
+        np.array(bounds, dtype=np.int64),
+        np.array([0.0 if value is None else value for value in values], dtype=np.float64),
+        np.array([value is not None for value in values], dtype=bool),
+    )
+
+
+def step_columns(bounds, values):
+    """
+    This function packs a step function (values[i] applies from bounds[i]) into (bounds int64, values float64) arrays.
+    """
+    return np.array(bounds, dtype=np.int64), np.array(values, dtype=np.float64)
+
+
+def apply_q_rule(epochs, remanents, q_segment_columns):
+    """
+    Vectorized Q rule over the segment map of a utils.QPeriodMap: every transaction takes the fixed value
+    of its segment, found with a single searchsorted.
+    """
+    bounds, fixed, covered = q_segment_columns
+    if len(bounds) == 0 or len(epochs) == 0:
+        return remanents
+    idx = np.searchsorted(bounds, epochs, side="right") - 1
+    has_start = idx >= 0
+    safe_idx = np.where(has_start, idx, 0)
+    mask = has_start & covered[safe_idx]
+    remanents[mask] = fixed[safe_idx[mask]]
+    return remanents
+
+
+def apply_p_rule(epochs, remanents, p_step_columns):
+    """
+    Vectorized P rule over the step function of a utils.PExtraSteps: every transaction gets the running
+    extra of the last step starting on or before it.
+    """
+    bounds, values = p_step_columns
+    if len(bounds) == 0 or len(epochs) == 0:
+        return remanents
+    idx = np.searchsorted(bounds, epochs, side="right") - 1
+    remanents += np.where(idx >= 0, values[np.maximum(idx, 0)], 0.0)
+    return remanents
+
+
+def k_window_sums(epochs, remanents, k_columns):
+    """
+    This function returns the sum of remanents inside every K period using a prefix sum
+    over the sorted remanents and a binary search for each window boundary.
+    """
+    k_starts, k_ends = k_columns
+    prefix = np.concatenate(([0.0], np.cumsum(remanents)))
+    left = np.searchsorted(epochs, k_starts, side="left")
+    right = np.maximum(np.searchsorted(epochs, k_ends, side="right"), left)
+    return prefix[right] - prefix[left]
+
+
+def k_membership(epochs, merged_k_columns):
+    """
+    This function flags the transactions that fall inside at least one K period, given the
+    sorted and merged K intervals of a KPeriodIndex.
+    """
+    starts, ends = merged_k_columns
+    if len(starts) == 0 or len(epochs) == 0:
+        return np.zeros(len(epochs), dtype=bool)
+    idx = np.searchsorted(starts, epochs, side="right") - 1
+    return (idx >= 0) & (epochs <= ends[np.maximum(idx, 0)])
+
+
+def remanent_columns(epochs, amounts, q_columns, p_columns):
+    """
+    This function computes the ceilings and the remanents after the Q and P rules for sorted epoch/amount arrays.
+    q_columns and p_columns are the compiled columns of a QPeriodMap and a PExtraSteps (see utils.RulePlan).
+    """
+    with stage("ceiling"):
+        ceilings, remanents = ceiling_and_remanent(amounts)
+    with stage("q_rule"):
+        remanents = apply_q_rule(epochs, remanents, q_columns)
+    with stage("p_rule"):
+        remanents = apply_p_rule(epochs, remanents, p_columns)
+    return ceilings, remanents
+
+
+def pipeline_columns(epochs, amounts, q_columns, p_columns, merged_k_columns, k_columns, totals: bool):
+    """
+    Columnar pass of a utils.TransactionPipeline over sorted epoch/amount arrays: ceilings and remanents after
+    the Q and P rules, then, when their columns are given, the K membership flags (merged_k_columns) and the
+    K window sums (k_columns), and the totals of the non negative transactions when totals is set.
+    Returns (ceilings, remanents, in_k_periods, totals, k_sums) with None for the parts not asked for.
+    """
+    ceilings, remanents = remanent_columns(epochs, amounts, q_columns, p_columns)
+    in_k_periods = k_sums = total = None
+    with stage("k_aggregation"):
+        if merged_k_columns is not None:
+            in_k_periods = k_membership(epochs, merged_k_columns)
+        if k_columns is not None:
+            k_sums = np.round(k_window_sums(epochs, remanents, k_columns), AMOUNT_DECIMALS)
+    if totals:
+        positive = amounts >= 0
+        total = (float(amounts[positive].sum()), int(ceilings[positive].sum())) if positive.any() else (0, 0)
+    return ceilings, remanents, in_k_periods, total, k_sums
+
+
+def calculate_tax_array(incomes, slabs):
+    """
+    Vectorized calculate_tax over a table of (threshold, rate) slabs: every slab contributes its rate times the
+    part of the income between its threshold and the next one, highest slab first like the python version.
+    """
+    incomes = np.asarray(incomes, dtype=np.float64)
+    tax = np.zeros(incomes.shape)
+    upper = None
+    for threshold, rate in reversed(slabs):
+        taxable = incomes - threshold
+        if upper is not None:
+            taxable = np.minimum(taxable, upper - threshold)
+        tax = tax + np.maximum(taxable, 0) * rate
+        upper = threshold
+    return tax
+
+
+def sweep_matrix(invested, is_nps, rates, years, inflations, wages, tax_slabs):
+    """
+    This function evaluates S scenarios against K period investments at once. The per scenario growth/inflation
+    factor is an (S,) vector and profit is its outer product with the (K,) invested amounts; the tax benefit is
+    computed with calculate_tax_array over the (S, K) grid of eligible amounts. Returns (S, K) profit and tax matrices.
+    """
+    invested = np.asarray(invested, dtype=np.float64)
+    years = np.asarray(years, dtype=np.float64)
+    factors = (1 + np.asarray(rates)) ** years / (1 + np.asarray(inflations) / 100) ** years
+    profit = np.outer(factors, invested) - invested
+
+    wages = np.asarray(wages, dtype=np.float64)[:, None]
+    eligible = np.minimum(invested[None, :], np.minimum(wages * 0.10, 200000))
+    tax_benefit = calculate_tax_array(wages, tax_slabs) - calculate_tax_array(wages - eligible, tax_slabs)
+    tax_benefit = np.where(np.asarray(is_nps)[:, None], tax_benefit, 0.0)
+    return np.round(profit, 2), np.round(tax_benefit, 2)
+
+
+def trajectory_factors(rate: float, inflation: float, years: int, steps_per_year: int):
+    """
+    This function returns the growth (1 + rate) ** t and inflation (1 + inflation / 100) ** t factors of every step
+    t = 1 / steps_per_year ... years, as (years * steps_per_year,) arrays.
+    """
+    times = np.arange(1, years * steps_per_year + 1, dtype=np.float64) / steps_per_year
+    return (1 + rate) ** times, (1 + inflation / 100) ** times
+
+
+def trajectory_matrix(invested, growth, discount):
+    """
+    This function projects K period investments along a trajectory with one outer product: (K, T) nominal values
+    and the same divided by the inflation factors.
+    """
+    nominal = np.outer(np.asarray(invested, dtype=np.float64), growth)
+    return np.round(nominal, 2), np.round(nominal / discount, 2)
+
+
+def lognormal_growth(seed: int, block: int, paths: int, years: int, mu: float, sigma: float):
+    """
+    This function simulates the growth factor over years of paths return paths, with yearly log returns drawn from
+    N(mu, sigma) by a generator seeded with (seed, block), as a (paths,) array. The log returns are drawn and summed
+    one year at a time, so a block holds two (paths,) arrays whatever the number of years.
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(block,)))
+    log_growth = np.zeros(paths)
+    for _ in range(years):
+        log_growth += rng.normal(mu, sigma, size=paths)
+    return np.exp(log_growth)
@@ -0,0 +1,34 @@
+from datetime import datetime
+from functools import lru_cache
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# batch files repeat the same timestamps a lot, so parsed values are cached
+PARSE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_datetime(value: str) -> datetime:
+    """
+    This function parses a "YYYY-MM-DD HH:mm:ss" string. Once the fixed width layout is verified the string is
+    handed to the C implemented fromisoformat, anything else goes through strptime so the accepted inputs stay the same.
+    """
+    if (
+        len(value) == 19
+        and value[4] == "-" and value[7] == "-" and value[10] == " "
+        and value[13] == ":" and value[16] == ":"
+        and value.isascii()
+        and (value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]).isdigit()
+    ):
+        return datetime.fromisoformat(value)
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def format_datetime(value: datetime) -> str:
+    """
+    This function formats a datetime as "YYYY-MM-DD HH:mm:ss". isoformat is implemented in C and much
+    faster than strftime; it gives the same output for naive datetimes from year 1000 onwards.
+    """
+    if value.tzinfo is None and value.year >= 1000:
+        return value.isoformat(" ", "seconds")
+    return value.strftime(DATE_FORMAT)
@@ -0,0 +1,290 @@
+import math
+import os
+import sqlite3
+import threading
+import uuid
+from array import array
+from collections import OrderedDict
+
+from app import columnar
+
+# dedup states kept per worker; the least recently used ones are dropped beyond this
+DEDUP_MAX_ENTRIES = int(os.getenv("BLK_DEDUP_MAX_ENTRIES", "256"))
+# memory-bounded mode: distinct transactions the Bloom filter is sized for (at a 1% false positive rate),
+# and keys kept in memory before they are spilled to a temporary SQLite file
+DEDUP_BLOOM_CAPACITY = int(os.getenv("BLK_DEDUP_BLOOM_CAPACITY", "10000000"))
+DEDUP_MEMORY_KEYS = int(os.getenv("BLK_DEDUP_MEMORY_KEYS", "1000000"))
+# largest capacity a client may ask for: the Bloom filter takes about 1.2 bytes per unit of capacity
+DEDUP_MAX_CAPACITY = int(os.getenv("BLK_DEDUP_MAX_CAPACITY", "100000000"))
+
+MASK64 = (1 << 64) - 1
+# bit pattern of -0.0, which is the same amount as 0.0
+NEGATIVE_ZERO = 1 << 63
+
+
+class DedupNotFoundError(Exception):
+    pass
+
+
+def _amount_bits(amounts) -> array:
+    bits = array("Q")
+    bits.frombytes(amounts.tobytes() if hasattr(amounts, "tobytes") else array("d", amounts).tobytes())
+    return bits
+
+
+def transaction_keys(epochs, amounts):
+    """
+    This function returns the exact integer key of every (epoch, amount) pair: the epoch in the high bits and the
+    IEEE bits of the amount in the low 64, which takes far less memory than a (datetime, float) tuple.
+    """
+    return [
+        (epoch << 64) | (bits if bits != NEGATIVE_ZERO else 0)
+        for epoch, bits in zip(epochs, _amount_bits(amounts))
+    ]
+
+
+def _mix64(value: int) -> int:
+    # splitmix64 finalizer
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def key_hashes(epochs, amounts):
+    """
+    This function returns a well mixed 64 bit hash of every (epoch, amount) pair, for the Bloom filter:
+    a uint64 numpy array when numpy is available, a list of ints otherwise (the values are the same).
+    """
+    if columnar.HAS_NUMPY:
+        np = columnar.np
+        bits = np.frombuffer(_amount_bits(amounts), dtype=np.uint64)
+        bits = np.where(bits == NEGATIVE_ZERO, np.uint64(0), bits)
+        value = np.asarray(epochs, dtype=np.int64).view(np.uint64) * np.uint64(0x9E3779B97F4A7C15) ^ bits
+        value = (value ^ (value >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        value = (value ^ (value >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return value ^ (value >> np.uint64(31))
+    return [
+        _mix64((((epoch & MASK64) * 0x9E3779B97F4A7C15) & MASK64) ^ (bits if bits != NEGATIVE_ZERO else 0))
+        for epoch, bits in zip(epochs, _amount_bits(amounts))
+    ]
+
+
+class BloomFilter:
+    """
+    Bloom filter over 64 bit hashes, sized for capacity items at error_rate false positives. The probe positions
+    come from the two halves of the hash (double hashing).
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / max(capacity, 1) * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: int):
+        low, high = value & 0xFFFFFFFF, (value >> 32) | 1
+        return [(low + i * high) % self.size for i in range(self.hashes)]
+
+    def _position_matrix(self, hashes):
+        np = columnar.np
+        low = hashes & np.uint64(0xFFFFFFFF)
+        high = (hashes >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (low[:, None] + steps[None, :] * high[:, None]) % np.uint64(self.size)
+
+    def contains_many(self, hashes):
+        """
+        Whether every hash may have been added (a list of bools).
+        """
+        if columnar.HAS_NUMPY and not isinstance(hashes, list):
+            np = columnar.np
+            positions = self._position_matrix(hashes)
+            bits = np.frombuffer(self.bits, dtype=np.uint8)
+            probed = bits[positions >> np.uint64(3)] & (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+            return (probed != 0).all(axis=1).tolist()
+        return [all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(h)) for h in hashes]
+
+    def add_many(self, hashes):
+        if columnar.HAS_NUMPY and not isinstance(hashes, list):
+            np = columnar.np
+            positions = self._position_matrix(hashes).ravel()
+            bits = np.frombuffer(self.bits, dtype=np.uint8)
+            np.bitwise_or.at(bits, positions >> np.uint64(3), np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+            return
+        for h in hashes:
+            for p in self._positions(h):
+                self.bits[p >> 3] |= 1 << (p & 7)
+
+
+class SpillSet:
+    """
+    Exact set of transaction keys, kept in memory up to max_keys and spilled beyond that to a private temporary
+    SQLite database (deleted when closed).
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._keys = set()
+        self._db = None
+
+    def __contains__(self, key: int) -> bool:
+        if key in self._keys:
+            return True
+        if self._db is None:
+            return False
+        return self._db.execute("SELECT 1 FROM keys WHERE epoch = ? AND bits = ?", self._row(key)).fetchone() is not None
+
+    def update(self, keys):
+        self._keys.update(keys)
+        if len(self._keys) > self.max_keys:
+            if self._db is None:
+                # an empty file name is a private on-disk database, removed on close
+                self._db = sqlite3.connect("", check_same_thread=False)
+                self._db.execute("CREATE TABLE keys (epoch INTEGER, bits INTEGER, PRIMARY KEY (epoch, bits)) WITHOUT ROWID")
+            with self._db:
+                self._db.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?)", map(self._row, self._keys))
+            self._keys = set()
+
+    @staticmethod
+    def _row(key: int):
+        # SQLite integers are signed 64 bit
+        bits = key & MASK64
+        return key >> 64, bits - (1 << 64) if bits >= NEGATIVE_ZERO else bits
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self._keys = set()
+
+
+class DedupState:
+    """
+    Duplicate detection state shared across chunks (and, registered in dedup_registry, across requests): a
+    transaction is a duplicate when a valid transaction with the same date and amount was seen before it.
+    The exact integer keys of the seen transactions are kept in a set.
+    """
+
+    bounded = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self._keys = set()
+
+    def check(self, epochs, amounts):
+        """
+        This function flags, in order, which of the given (non negative) transactions are duplicates of an
+        earlier one, in this call or a previous one, and records the others.
+        """
+        with self.lock:
+            seen = self._keys
+            flags = []
+            for key in transaction_keys(epochs, amounts):
+                if key in seen:
+                    flags.append(True)
+                else:
+                    seen.add(key)
+                    flags.append(False)
+            self.count = len(seen)
+            return flags
+
+    def forget_before(self, epoch: int):
+        """
+        This function drops the keys dated before epoch, for callers whose input is sorted by date.
+        """
+        with self.lock:
+            self._keys = {key for key in self._keys if key >> 64 >= epoch}
+            self.count = len(self._keys)
+
+    def close(self):
+        self._keys = set()
+
+
+class BoundedDedupState(DedupState):
+    """
+    Memory-bounded DedupState for very large inputs. A Bloom filter answers most lookups in memory; only the
+    transactions it reports as possibly seen are confirmed against the exact SpillSet, whose keys go to disk
+    beyond memory_keys. The answers are exact, the Bloom filter and the spill only trade memory for speed.
+    """
+
+    bounded = True
+
+    def __init__(self, capacity: int = None, memory_keys: int = None):
+        super().__init__()
+        self.bloom = BloomFilter(DEDUP_BLOOM_CAPACITY if capacity is None else capacity)
+        self.spill = SpillSet(DEDUP_MEMORY_KEYS if memory_keys is None else memory_keys)
+
+    def check(self, epochs, amounts):
+        with self.lock:
+            hashes = key_hashes(epochs, amounts)
+            maybe = self.bloom.contains_many(hashes)
+            chunk = set()
+            flags = []
+            for key, maybe_seen in zip(transaction_keys(epochs, amounts), maybe):
+                if key in chunk or (maybe_seen and key in self.spill):
+                    flags.append(True)
+                else:
+                    chunk.add(key)
+                    flags.append(False)
+            if columnar.HAS_NUMPY and not isinstance(hashes, list):
+                self.bloom.add_many(hashes[~columnar.np.array(flags, dtype=bool)])
+            else:
+                self.bloom.add_many([h for h, duplicate in zip(hashes, flags) if not duplicate])
+            self.spill.update(chunk)
+            self.count += len(chunk)
+            return flags
+
+    def forget_before(self, epoch: int):
+        # a Bloom filter cannot forget, the bounded state simply keeps everything
+        pass
+
+    def close(self):
+        self.spill.close()
+
+
+class DedupRegistry:
+    """
+    LRU store of the dedup states shared across requests, by id.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, bounded: bool = False, capacity: int = None):
+        key = uuid.uuid4().hex
+        state = BoundedDedupState(capacity) if bounded else DedupState()
+        with self._lock:
+            self._states[key] = state
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)[1].close()
+        return key, state
+
+    def get(self, key: str) -> DedupState:
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                raise DedupNotFoundError(f"dedup state {key} not found, create one with POST /dedup")
+            self._states.move_to_end(key)
+            return state
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            state = self._states.pop(key, None)
+        if state is None:
+            return False
+        state.close()
+        return True
+
+
+dedup_registry = DedupRegistry(DEDUP_MAX_ENTRIES)
+
+
+def resolve_dedup(dedup_id):
+    """
+    This function returns the registered dedup state of a dedupId, or None (a fresh state per request) without one.
+    """
+    if dedup_id is None:
+        return None
+    return dedup_registry.get(dedup_id)
@@ -0,0 +1,76 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+from app import columnar
+from app.metrics import stage
+
+# payloads with at least this many transactions are computed in the process pool
+OFFLOAD_THRESHOLD = int(os.getenv("BLK_OFFLOAD_THRESHOLD", "50000"))
+POOL_WORKERS = int(os.getenv("BLK_POOL_WORKERS", str(os.cpu_count() or 1)))
+# maximum number of jobs running or waiting in the pool before requests are rejected with 429
+POOL_QUEUE_DEPTH = int(os.getenv("BLK_POOL_QUEUE_DEPTH", str(2 * POOL_WORKERS)))
+
+
+class PoolSaturatedError(Exception):
+    pass
+
+
+class ComputePool:
+    """
+    Lazily started process pool for the CPU bound columnar engine, with a bounded queue.
+    Only module level functions taking compact numpy arrays (or, for bulk returns, raw JSON lines and plan
+    bodies) are submitted, so no Pydantic objects are pickled across processes.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, threshold: int):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.threshold = threshold
+        self.pending = 0
+        self._executor = None
+
+    def should_offload(self, rows: int) -> bool:
+        return columnar.HAS_NUMPY and self.workers > 0 and rows >= self.threshold
+
+    async def submit(self, func, *args):
+        # pending is only touched from the event loop, so no lock is needed
+        if self.pending >= self.queue_depth:
+            raise PoolSaturatedError("compute pool is saturated, retry later")
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self.pending += 1
+        try:
+            with stage("pool"):
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+compute_pool = ComputePool(POOL_WORKERS, POOL_QUEUE_DEPTH, OFFLOAD_THRESHOLD)
+
+
+async def run_pipeline_async(pipeline, transactions, dedup=None):
+    """
+    Async version of TransactionPipeline.run: runs in the thread pool for small payloads, and above the
+    offload threshold sends only the fused columnar pass, as compact arrays, to the process pool.
+    """
+    if not (pipeline.use_numpy and compute_pool.should_offload(len(transactions))):
+        return await run_in_threadpool(pipeline.run, transactions, dedup)
+
+    result = await run_in_threadpool(pipeline.prepare, transactions, dedup)
+    if not pipeline.computes or not result.transactions:
+        return result
+    inputs = await run_in_threadpool(pipeline.inputs, result)
+    columns = await compute_pool.submit(columnar.pipeline_columns, *inputs)
+    return await run_in_threadpool(pipeline.finish, result, columns)
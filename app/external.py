@@ -0,0 +1,169 @@
+import heapq
+import mmap
+import os
+import tempfile
+from array import array
+from operator import itemgetter
+
+from app import columnar
+from app.batch import TransactionBatch
+from app.metrics import stage
+
+# rows sorted in memory before being spilled to disk as one run
+EXTERNAL_RUN_ROWS = int(os.getenv("BLK_EXTERNAL_RUN_ROWS", "1000000"))
+# directory of the spilled runs, the system temporary directory by default
+EXTERNAL_TMP_DIR = os.getenv("BLK_EXTERNAL_TMP_DIR")
+# rows per chunk handed to the pipeline stages
+EXTERNAL_CHUNK_ROWS = 65536
+
+
+class SortedRun:
+    """
+    One spilled run: the epochs then the amounts of rows sorted by date, in a temporary file read back through mmap.
+    """
+
+    def __init__(self, batch: TransactionBatch, directory=None):
+        self.rows = len(batch)
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.write(batch.epochs.tobytes())
+        self._file.write(batch.amounts.tobytes())
+        self._file.flush()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+        if columnar.HAS_NUMPY:
+            self.epochs = columnar.np.frombuffer(self._map, dtype=columnar.np.int64, count=self.rows)
+            self.amounts = columnar.np.frombuffer(self._map, dtype=columnar.np.float64, offset=self.rows * 8)
+        else:
+            view = memoryview(self._map)
+            self._views = [view, view[:self.rows * 8], view[self.rows * 8:]]
+            self.epochs = self._views[1].cast("q")
+            self.amounts = self._views[2].cast("d")
+            self._views += [self.epochs, self.amounts]
+
+    def close(self):
+        self.epochs = self.amounts = None
+        # the buffer exports must be released before the map can be closed
+        for view in reversed(self._views):
+            view.release()
+        self._map.close()
+        self._file.close()
+
+
+class ExternalSorter:
+    """
+    Stable out of core sort of transactions by date. Rows are buffered up to run_rows, and every full buffer is
+    sorted and spilled to a memory-mapped run file; merged() then k-way merges the runs, so memory stays bounded by
+    the buffer whatever the total row count. Equal dates keep their arrival order, like TransactionBatch.sorted.
+    """
+
+    def __init__(self, run_rows: int = None, directory=None):
+        self.run_rows = EXTERNAL_RUN_ROWS if run_rows is None else run_rows
+        self.directory = EXTERNAL_TMP_DIR if directory is None else directory
+        self.runs = []
+        self.rows = 0
+        self._buffer = TransactionBatch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, batch: TransactionBatch):
+        self.rows += len(batch)
+        self._buffer.epochs.extend(batch.epochs)
+        self._buffer.amounts.extend(batch.amounts)
+        if len(self._buffer) >= self.run_rows:
+            self._spill()
+
+    def _spill(self):
+        with stage("spill"):
+            self.runs.append(SortedRun(self._buffer.sorted(), self.directory))
+        self._buffer = TransactionBatch()
+
+    def merged(self, chunk_rows: int = EXTERNAL_CHUNK_ROWS):
+        """
+        This function yields the sorted rows as TransactionBatch chunks of about chunk_rows rows.
+        Without any spilled run the buffer is simply sorted in memory.
+        """
+        if not self.runs:
+            buffer = self._buffer.sorted()
+            for start in range(0, len(buffer), chunk_rows):
+                yield TransactionBatch(buffer.epochs[start:start + chunk_rows], buffer.amounts[start:start + chunk_rows])
+            return
+        if len(self._buffer):
+            self._spill()
+        if columnar.HAS_NUMPY:
+            yield from self._merge_blocks(chunk_rows)
+        else:
+            yield from self._merge_rows(chunk_rows)
+
+    def _merge_rows(self, chunk_rows):
+        # heapq.merge is stable, and the runs are in arrival order
+        rows = heapq.merge(*[zip(run.epochs, run.amounts) for run in self.runs], key=itemgetter(0))
+        chunk = TransactionBatch()
+        for epoch, amount in rows:
+            chunk.epochs.append(epoch)
+            chunk.amounts.append(amount)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = TransactionBatch()
+        if len(chunk):
+            yield chunk
+
+    def _merge_blocks(self, chunk_rows):
+        """
+        Vectorized k-way merge. Every run exposes a block of its next rows; the smallest (last date, run index) of
+        the blocks is a cutoff below which no row can still come from a later block, so every row up to it is taken
+        from all the blocks, stably sorted (ties keep the run order, i.e. the arrival order) and emitted.
+        The cutoff run always empties its block, so each round emits at least one block.
+        """
+        np = columnar.np
+        block = max(1024, chunk_rows // len(self.runs))
+        positions = [0] * len(self.runs)
+        while True:
+            active = [i for i, run in enumerate(self.runs) if positions[i] < run.rows]
+            if not active:
+                return
+            ends = {i: min(positions[i] + block, self.runs[i].rows) for i in active}
+            bounded = [(self.runs[i].epochs[ends[i] - 1], i) for i in active if ends[i] < self.runs[i].rows]
+            cut_epoch, cut_run = min(bounded) if bounded else (None, None)
+            epochs, amounts = [], []
+            for i in active:
+                run = self.runs[i]
+                if cut_epoch is None:
+                    end = ends[i]
+                else:
+                    side = "right" if i <= cut_run else "left"
+                    end = positions[i] + int(np.searchsorted(run.epochs[positions[i]:ends[i]], cut_epoch, side=side))
+                epochs.append(run.epochs[positions[i]:end])
+                amounts.append(run.amounts[positions[i]:end])
+                positions[i] = end
+            epochs = np.concatenate(epochs)
+            amounts = np.concatenate(amounts)
+            order = np.argsort(epochs, kind="stable")
+            yield TransactionBatch(array("q", epochs[order].tobytes()), array("d", amounts[order].tobytes()))
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self._buffer = TransactionBatch()
+
+
+def project_chunks(pipeline, batches):
+    """
+    This function runs a projection pipeline over an iterable of TransactionBatch chunks and adds up the results.
+    The totals and every K window sum (compounded or not) are sums over the transactions, so any split of them gives the same result
+    and the chunks need not be sorted across each other; only one chunk is in memory at a time.
+    """
+    total = pipeline.prepare(TransactionBatch())
+    for batch in batches:
+        result = pipeline.run(batch)
+        total.total_transaction_amount += result.total_transaction_amount
+        total.total_ceiling_amount += result.total_ceiling_amount
+        if total.k_sums is not None:
+            total.k_sums = [round(a + b, columnar.AMOUNT_DECIMALS) for a, b in zip(total.k_sums, result.k_sums)]
+        if total.k_values is not None:
+            total.k_values = [a + b for a, b in zip(total.k_values, result.k_values)]
+    return total
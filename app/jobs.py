@@ -0,0 +1,363 @@
+import asyncio
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from pydantic_core import to_json
+from starlette.concurrency import run_in_threadpool
+
+from app.batch import TransactionBatch
+from app.external import project_chunks
+from app.models import (ReturnBatchRequest, ReturnBatchResponse, ReturnNpsIndexRequest, ReturnSimulationRequest,
+                        ReturnSweepRequest, ReturnTrajectoryRequest, RulePlanRequest, TransactionFilterRequest)
+from app.plans import PlanNotFoundError, plan_body, plan_registry, resolve_plan
+from app.responses import filtered_rows, simulation_body, sweep_body, trajectory_body
+from app.simulation import path_blocks, simulate_growth, simulation_params, simulation_seed
+from app.utils import (FILTER_STAGES, VALIDATE_STAGES, TransactionPipeline, investment_projection_batch,
+                       investment_projection_sweep, projection_pipeline, projection_summary)
+
+# optional SQLite file so jobs and their results survive worker restarts (and are shared by the workers using it)
+JOB_PATH = os.getenv("BLK_JOB_PATH")
+# jobs computed at the same time by one worker process
+JOB_WORKERS = int(os.getenv("BLK_JOB_WORKERS", "2"))
+# per tenant: jobs running at the same time, and jobs queued or running before submissions get 429
+JOB_TENANT_CONCURRENCY = int(os.getenv("BLK_JOB_TENANT_CONCURRENCY", "1"))
+JOB_TENANT_MAX_JOBS = int(os.getenv("BLK_JOB_TENANT_MAX_JOBS", "100"))
+# finished jobs and their results are deleted after this
+JOB_TTL_SECONDS = float(os.getenv("BLK_JOB_TTL_SECONDS", "86400"))
+# how often idle workers look for jobs submitted through another process
+JOB_POLL_SECONDS = 1.0
+# transactions computed between two progress updates of a running job
+JOB_CHUNK_ROWS = int(os.getenv("BLK_JOB_CHUNK_ROWS", "100000"))
+
+JOB_KINDS = {
+    "filter": TransactionFilterRequest,
+    "nps": ReturnNpsIndexRequest,
+    "index": ReturnNpsIndexRequest,
+    "batch": ReturnBatchRequest,
+    "sweep": ReturnSweepRequest,
+    "trajectory": ReturnTrajectoryRequest,
+    "simulate": ReturnSimulationRequest,
+}
+
+
+class JobNotFoundError(Exception):
+    pass
+
+
+class JobLimitError(Exception):
+    pass
+
+
+def job_id(tenant: str, kind: str, request) -> str:
+    """
+    This function returns the id of a job: a content hash of the tenant, the kind and the validated request, so the
+    same payload submitted again by the same tenant is the same job. The returns kinds sort the transactions first,
+    like the result cache does.
+    """
+    digest = hashlib.blake2b(to_json([tenant, kind]), digest_size=20)
+    digest.update(request.model_dump_json(exclude={"transaction"}).encode())
+    digest.update(request.transaction.canonical_bytes(kind != "filter"))
+    return digest.hexdigest()
+
+
+def _chunks(batch: TransactionBatch, progress=None):
+    """
+    This function slices a batch into chunks of JOB_CHUNK_ROWS transactions and reports the transactions done to
+    progress as each chunk is consumed.
+    """
+    for start in range(0, len(batch), JOB_CHUNK_ROWS):
+        end = min(start + JOB_CHUNK_ROWS, len(batch))
+        yield TransactionBatch(batch.epochs[start:end], batch.amounts[start:end])
+        if progress is not None:
+            progress(end)
+
+
+def job_body(kind: str, request, progress=None):
+    """
+    This function computes the response body of a job, the same as the endpoint of its kind would return. The
+    transactions go through the engine by chunks of JOB_CHUNK_ROWS, and progress (if given) is called with the
+    transactions done after each: the projections are sums over the transactions (see external.project_chunks),
+    and the filter rules only depend on the date of each transaction once validation has run over all of them.
+    """
+    plan = resolve_plan(request)
+    if kind == "filter":
+        validated = TransactionPipeline(VALIDATE_STAGES).run(request.transaction)
+        rules = TransactionPipeline([name for name in FILTER_STAGES if name != "validate"], plan)
+        valid = validated.transactions.sorted()
+        if progress is not None:
+            # the rejected transactions are done once validation has run
+            rejected, report = len(request.transaction) - len(valid), progress
+            progress = lambda rows: report(rejected + rows)
+        rows = []
+        for chunk in _chunks(valid, progress):
+            rows.extend(rules.run(chunk).filter_rows())
+        return {"valid": filtered_rows(rows), "invalid": validated.invalid}
+    pipeline = projection_pipeline(request, plan, mode=kind if kind in ("nps", "index") else None)
+    if kind in ("sweep", "trajectory"):
+        request.check_cells(len(pipeline.plan.k))
+    result = project_chunks(pipeline, _chunks(request.transaction, progress))
+    if kind == "batch":
+        return ReturnBatchResponse(
+            totalTransactionAmount=result.total_transaction_amount,
+            totalCeilingAmount=result.total_ceiling_amount,
+            projections=investment_projection_batch(request, result.k_sums, pipeline.plan.k)
+        )
+    if kind == "sweep":
+        scenarios, profit_rows, tax_rows = investment_projection_sweep(request, result.k_sums)
+        totals = (result.total_transaction_amount, result.total_ceiling_amount)
+        return sweep_body(totals, pipeline.plan.k, result.k_sums, scenarios, profit_rows, tax_rows)
+    if kind == "trajectory":
+        return trajectory_body(request, pipeline.plan.k, result)
+    if kind == "simulate":
+        seed = simulation_seed(request)
+        _, _, years, mu, sigma = simulation_params(request)
+        growth = simulate_growth(seed, path_blocks(request.paths), years, mu, sigma)
+        return simulation_body(request, pipeline.plan.k, result, seed, growth)
+    return projection_summary(request, pipeline.plan.k, result, kind)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """
+    SQLite table of the jobs: the raw payload (with the periods of its plan, for a planId request), the status and
+    progress and, once finished, the serialized result or the error. Without a path the database is in memory and private to the process. Jobs are claimed with a conditional
+    UPDATE, so several workers sharing the file never run the same job twice.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, tenant TEXT NOT NULL, kind TEXT NOT NULL, payload BLOB NOT NULL, status TEXT NOT NULL, "
+            "submitted REAL NOT NULL, started REAL, finished REAL, owner INTEGER, result BLOB, error TEXT, status_code INTEGER, "
+            "plan BLOB, rows_total INTEGER NOT NULL DEFAULT 0, rows_done INTEGER NOT NULL DEFAULT 0)"
+        )
+        # job files written before the plan and progress columns
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column in ("plan BLOB", "rows_total INTEGER NOT NULL DEFAULT 0", "rows_done INTEGER NOT NULL DEFAULT 0"):
+            if column.split()[0] not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted)")
+        # jobs left running by a process that is gone (a restart) are queued again
+        with self._lock:
+            for job, owner in self._db.execute("SELECT id, owner FROM jobs WHERE status = 'running'").fetchall():
+                if owner is None or not _process_alive(owner):
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'queued', started = NULL, owner = NULL, rows_done = 0 WHERE id = ?", (job,)
+                    )
+
+    def submit(self, key: str, tenant: str, kind: str, payload: bytes, plan, rows: int, max_jobs: int, now: float) -> bool:
+        """
+        This function queues a job of rows transactions unless it already exists, and returns whether it was queued.
+        plan is the plan_body of the planId of the payload, if any. A failed job is queued again. Raises JobLimitError
+        when the tenant has max_jobs jobs queued or running.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished <= ?", (now - JOB_TTL_SECONDS,))
+            row = self._db.execute("SELECT status FROM jobs WHERE id = ?", (key,)).fetchone()
+            if row is not None and row[0] != "failed":
+                return False
+            active = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE tenant = ? AND status IN ('queued', 'running')", (tenant,)
+            ).fetchone()[0]
+            if active >= max_jobs:
+                raise JobLimitError(f"tenant {tenant} has {active} jobs queued or running, retry later")
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, tenant, kind, payload, plan, rows_total, status, submitted) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                (key, tenant, kind, payload, plan, rows, now),
+            )
+            return True
+
+    def claim(self, concurrency: int, now: float):
+        """
+        This function marks the oldest queued job whose tenant runs fewer than concurrency jobs as running by this
+        process, and returns its (id, kind, payload, plan), or None.
+        """
+        with self._lock:
+            running = dict(self._db.execute(
+                "SELECT tenant, COUNT(*) FROM jobs WHERE status = 'running' GROUP BY tenant"
+            ).fetchall())
+            for key, tenant in self._db.execute("SELECT id, tenant FROM jobs WHERE status = 'queued' ORDER BY submitted").fetchall():
+                if running.get(tenant, 0) >= concurrency:
+                    continue
+                claimed = self._db.execute(
+                    "UPDATE jobs SET status = 'running', started = ?, owner = ? WHERE id = ? AND status = 'queued'",
+                    (now, os.getpid(), key),
+                ).rowcount
+                if claimed:
+                    return self._db.execute("SELECT id, kind, payload, plan FROM jobs WHERE id = ?", (key,)).fetchone()
+            return None
+
+    def progress(self, key: str, rows: int):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET rows_done = ? WHERE id = ?", (rows, key))
+
+    def finish(self, key: str, result: bytes = None, error: str = None, status_code: int = None, now: float = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, finished = ?, result = ?, error = ?, status_code = ?, payload = ?, plan = NULL, "
+                "rows_done = CASE WHEN ? IS NULL THEN rows_total ELSE rows_done END WHERE id = ?",
+                ("done" if error is None else "failed", now, result, error, status_code, b"", error, key),
+            )
+
+    def get(self, key: str, tenant: str):
+        """
+        The status of a job of the tenant as a dict, with its position among the queued jobs and its progress.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kind, status, submitted, started, finished, error, status_code, rows_total, rows_done "
+                "FROM jobs WHERE id = ? AND tenant = ?",
+                (key, tenant),
+            ).fetchone()
+            if row is None:
+                raise JobNotFoundError(f"job {key} not found")
+            kind, status, submitted, started, finished, error, status_code, rows_total, rows_done = row
+            position = None
+            if status == "queued":
+                position = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND submitted < ?", (submitted,)
+                ).fetchone()[0]
+        return {
+            "jobId": key, "kind": kind, "status": status, "position": position, "submittedAt": submitted,
+            "startedAt": started, "finishedAt": finished, "error": error, "statusCode": status_code,
+            "rowsTotal": rows_total, "rowsDone": rows_done,
+        }
+
+    def result(self, key: str, tenant: str):
+        with self._lock:
+            row = self._db.execute("SELECT result FROM jobs WHERE id = ? AND tenant = ?", (key, tenant)).fetchone()
+        if row is None:
+            raise JobNotFoundError(f"job {key} not found")
+        return row[0]
+
+    def delete(self, key: str, tenant: str) -> bool:
+        """
+        This function deletes a queued or finished job; a running one is left alone (returns False).
+        """
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM jobs WHERE id = ? AND tenant = ? AND status != 'running'", (key, tenant)
+            ).rowcount > 0
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs")
+
+
+class JobQueue:
+    """
+    In process worker pool of the job API: worker threads claim queued jobs from the JobStore (within the
+    per tenant concurrency limit), compute them with job_body and store the serialized result. Started lazily
+    by the first submission, or with the app.
+    """
+
+    def __init__(self, store: JobStore, workers: int, tenant_concurrency: int, tenant_max_jobs: int):
+        self.store = store
+        self.workers = workers
+        self.tenant_concurrency = tenant_concurrency
+        self.tenant_max_jobs = tenant_max_jobs
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        with self._wakeup:
+            if self._threads or self.workers <= 0:
+                return
+            self._stopping = False
+            # daemon threads, an idle worker must not keep the interpreter from exiting
+            self._threads = [
+                threading.Thread(target=self._work, name=f"job-{i}", daemon=True) for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def shutdown(self):
+        with self._wakeup:
+            threads, self._threads = self._threads, []
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in threads:
+            thread.join()
+
+    def submit(self, tenant: str, kind: str, request, payload: bytes):
+        """
+        This function queues a validated request and returns (job id, whether it was queued); an identical job of
+        the tenant that is queued, running or done is returned instead. The plan of a planId request is resolved here
+        and stored with the job, since the process that runs it may not have it registered.
+        Raises PlanNotFoundError for an unknown planId.
+        """
+        key = job_id(tenant, kind, request)
+        plan_id = getattr(request, "planId", None)
+        plan = plan_body(plan_registry.get(plan_id)) if plan_id is not None else None
+        queued = self.store.submit(key, tenant, kind, payload, plan, len(request.transaction), self.tenant_max_jobs, time.time())
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return key, queued
+
+    def _work(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            job = self.store.claim(self.tenant_concurrency, time.time())
+            if job is None:
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(JOB_POLL_SECONDS)
+                continue
+            self._run(*job)
+            with self._wakeup:
+                # a finished job may let a job of the same tenant start
+                self._wakeup.notify()
+
+    def _run(self, key: str, kind: str, payload: bytes, plan):
+        try:
+            if plan is not None:
+                # same periods, same plan id: the planId of the payload resolves in this process too
+                plan_registry.register(RulePlanRequest.model_validate_json(plan))
+            request = JOB_KINDS[kind].model_validate_json(payload)
+            result = job_body(kind, request, functools.partial(self.store.progress, key))
+            self.store.finish(key, result=to_json(result), now=time.time())
+        except PlanNotFoundError as e:
+            self.store.finish(key, error=str(e), status_code=404, now=time.time())
+        except Exception as e:
+            self.store.finish(key, error=str(e), status_code=400, now=time.time())
+
+    async def wait(self, key: str, tenant: str, timeout: float):
+        """
+        This function returns the status of a job once it is finished, or after timeout seconds. The store is polled
+        with a growing interval, each query in a thread so the event loop never waits on SQLite, and jobs run by
+        another process are seen too.
+        """
+        deadline = time.monotonic() + timeout
+        interval = 0.02
+        while True:
+            status = await run_in_threadpool(self.store.get, key, tenant)
+            remaining = deadline - time.monotonic()
+            if status["status"] in ("done", "failed") or remaining <= 0:
+                return status
+            await asyncio.sleep(min(remaining, interval))
+            interval = min(interval * 2, JOB_POLL_SECONDS)
+
+
+job_queue = JobQueue(JobStore(JOB_PATH), JOB_WORKERS, JOB_TENANT_CONCURRENCY, JOB_TENANT_MAX_JOBS)
@@ -1,8 +1,27 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from .executor import compute_pool
+from .jobs import job_queue
+from .metrics import METRICS_ENABLED, MetricsMiddleware, registry
 from .routers import api_router
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if METRICS_ENABLED:
+        registry.start_sampler()
+    # resume the jobs queued before a restart
+    job_queue.start()
+    yield
+    registry.stop_sampler()
+    job_queue.shutdown()
+    compute_pool.shutdown()
+
 def create_app():
-    app = FastAPI(app_name="FastAPI app for Black Rock", version="1.0.0")
+    app = FastAPI(app_name="FastAPI app for Black Rock", version="1.0.0", lifespan=lifespan)
     app.include_router(api_router, prefix="/api/blackrock/challenge/v1")
+    if METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
     return app
 app = create_app()
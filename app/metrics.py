@@ -0,0 +1,347 @@
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+
+METRICS_ENABLED = os.getenv("BLK_METRICS_ENABLED", "1") != "0"
+# seconds between two background samples of the process RSS and thread count
+SAMPLE_INTERVAL = float(os.getenv("BLK_METRICS_SAMPLE_SECONDS", "5"))
+
+# latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the engine stages that are timed, in the order of a request; /performance lists them in this order
+STAGES = ("parse", "validate", "ceiling", "q_rule", "p_rule", "k_aggregation", "pool", "spill", "serialization")
+
+# per request scratch dict shared by the middleware, the route handler and the engine stages
+_request_metrics = ContextVar("request_metrics", default=None)
+
+_NULL_STAGE = nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """
+        Approximate percentile, interpolated linearly inside the bucket that holds it.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class RouteStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.rows = 0
+        self.max_rows = 0
+        self.errors = 0
+
+
+class MetricsRegistry:
+    """
+    In process store of the request and engine stage metrics, plus a background sampler
+    of the process RSS and thread count.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.stages = {}
+        self.rss_bytes = 0
+        self.thread_count = 0
+        self._process = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def record_request(self, route: str, seconds: float, request_bytes: int, response_bytes: int, rows: int, status: int):
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+            stats.latency.observe(seconds)
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            stats.rows += rows
+            stats.max_rows = max(stats.max_rows, rows)
+            if status >= 400:
+                stats.errors += 1
+
+    def record_stage(self, name: str, seconds: float):
+        if name not in STAGES:
+            raise ValueError(f"unknown stage: {name}")
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram()
+            histogram.observe(seconds)
+
+    def sample(self):
+        import psutil
+
+        if self._process is None:
+            self._process = psutil.Process()
+        self.rss_bytes = self._process.memory_info().rss
+        self.thread_count = threading.active_count()
+
+    def start_sampler(self):
+        if self._sampler is not None:
+            return
+        self._stop.clear()
+        self.sample()
+
+        def run():
+            while not self._stop.wait(SAMPLE_INTERVAL):
+                self.sample()
+
+        self._sampler = threading.Thread(target=run, name="metrics-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop_sampler(self):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def mean_latency_seconds(self) -> float:
+        with self._lock:
+            count = sum(stats.latency.count for stats in self.routes.values())
+            total = sum(stats.latency.sum for stats in self.routes.values())
+        return total / count if count else 0.0
+
+    def snapshot(self):
+        with self._lock:
+            routes = {
+                route: {
+                    "count": stats.latency.count,
+                    "errors": stats.errors,
+                    "p50_ms": round(stats.latency.percentile(0.50) * 1000, 3),
+                    "p95_ms": round(stats.latency.percentile(0.95) * 1000, 3),
+                    "p99_ms": round(stats.latency.percentile(0.99) * 1000, 3),
+                    "mean_ms": round(stats.latency.sum / stats.latency.count * 1000, 3),
+                    "request_bytes": stats.request_bytes,
+                    "response_bytes": stats.response_bytes,
+                    "rows": stats.rows,
+                    "max_rows": stats.max_rows,
+                }
+                for route, stats in self.routes.items()
+            }
+            stages = {
+                name: {
+                    "count": histogram.count,
+                    "total_ms": round(histogram.sum * 1000, 3),
+                    "p50_ms": round(histogram.percentile(0.50) * 1000, 3),
+                    "p95_ms": round(histogram.percentile(0.95) * 1000, 3),
+                    "p99_ms": round(histogram.percentile(0.99) * 1000, 3),
+                }
+                for name, histogram in sorted(self.stages.items(), key=lambda item: STAGES.index(item[0]))
+            }
+        return routes, stages
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP blk_request_duration_seconds Request latency by route.",
+            "# TYPE blk_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            for route, stats in sorted(self.routes.items()):
+                label = f'route="{route}"'
+                cumulative = 0
+                for bucket, bucket_count in zip(stats.latency.buckets, stats.latency.counts):
+                    cumulative += bucket_count
+                    lines.append(f'blk_request_duration_seconds_bucket{{{label},le="{bucket}"}} {cumulative}')
+                lines.append(f'blk_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats.latency.count}')
+                lines.append(f"blk_request_duration_seconds_sum{{{label}}} {stats.latency.sum}")
+                lines.append(f"blk_request_duration_seconds_count{{{label}}} {stats.latency.count}")
+            for name, help_text, attr in (
+                ("blk_request_bytes_total", "Request body bytes by route.", "request_bytes"),
+                ("blk_response_bytes_total", "Response body bytes by route.", "response_bytes"),
+                ("blk_rows_processed_total", "Transactions processed by route.", "rows"),
+                ("blk_request_errors_total", "Responses with a 4xx/5xx status by route.", "errors"),
+            ):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for route, stats in sorted(self.routes.items()):
+                    lines.append(f'{name}{{route="{route}"}} {getattr(stats, attr)}')
+            lines.append("# HELP blk_stage_duration_seconds Time spent in each engine stage.")
+            lines.append("# TYPE blk_stage_duration_seconds summary")
+            for name, histogram in sorted(self.stages.items()):
+                lines.append(f'blk_stage_duration_seconds_sum{{stage="{name}"}} {histogram.sum}')
+                lines.append(f'blk_stage_duration_seconds_count{{stage="{name}"}} {histogram.count}')
+        lines += [
+            "# HELP blk_process_resident_memory_bytes Resident memory of the worker process.",
+            "# TYPE blk_process_resident_memory_bytes gauge",
+            f"blk_process_resident_memory_bytes {self.rss_bytes}",
+            "# HELP blk_process_threads Active threads of the worker process.",
+            "# TYPE blk_process_threads gauge",
+            f"blk_process_threads {self.thread_count}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def _timed_stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.record_stage(name, time.perf_counter() - start)
+
+
+def stage(name: str):
+    """
+    Context manager timing one engine stage. Outside of an instrumented request (or with metrics disabled)
+    it is a shared no-op context, so the engine pays almost nothing for it.
+    """
+    if _request_metrics.get() is None:
+        return _NULL_STAGE
+    return _timed_stage(name)
+
+
+def _count_rows(values) -> int:
+    rows = 0
+    for value in values:
+        if isinstance(value, list):
+            rows += len(value)
+        else:
+            transactions = getattr(value, "transaction", None)
+            # a list of transactions or a TransactionBatch
+            if isinstance(transactions, list) or hasattr(transactions, "epochs"):
+                rows += len(transactions)
+    return rows
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, request/response body sizes and rows processed per route.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_metrics = {"request_bytes": 0, "response_bytes": 0, "rows": 0, "status": 500}
+        token = _request_metrics.set(request_metrics)
+        start = time.perf_counter()
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                request_metrics["request_bytes"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                request_metrics["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                request_metrics["response_bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            _request_metrics.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            registry.record_request(
+                f"{scope['method']} {path}",
+                time.perf_counter() - start,
+                request_metrics["request_bytes"],
+                request_metrics["response_bytes"],
+                request_metrics["rows"],
+                request_metrics["status"],
+            )
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    APIRoute recording the "parse" stage (body read, JSON decoding and request validation, i.e. everything
+    before the endpoint runs), the "serialization" stage (everything after it) and the rows in the request.
+    """
+
+    def __init__(self, path, endpoint, **kwargs):
+        # include_router rebuilds the route (router -> api_router -> app) with the already wrapped endpoint
+        if METRICS_ENABLED and not getattr(endpoint, "_instrumented", False):
+            endpoint = self._wrap_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def _wrap_endpoint(endpoint):
+        def before(kwargs):
+            request_metrics = _request_metrics.get()
+            if request_metrics is not None:
+                request_metrics["endpoint_start"] = time.perf_counter()
+                request_metrics["rows"] += _count_rows(kwargs.values())
+
+        def after():
+            request_metrics = _request_metrics.get()
+            if request_metrics is not None:
+                request_metrics["endpoint_end"] = time.perf_counter()
+
+        if inspect.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def wrapper(*args, **kwargs):
+                before(kwargs)
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    after()
+        else:
+            @functools.wraps(endpoint)
+            def wrapper(*args, **kwargs):
+                before(kwargs)
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    after()
+        wrapper._instrumented = True
+        return wrapper
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        if not METRICS_ENABLED:
+            return handler
+
+        async def instrumented_handler(request):
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                request_metrics = _request_metrics.get()
+                if request_metrics is not None and "endpoint_start" in request_metrics:
+                    registry.record_stage("parse", request_metrics["endpoint_start"] - start)
+                    registry.record_stage("serialization", time.perf_counter() - request_metrics["endpoint_end"])
+
+        return instrumented_handler
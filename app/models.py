@@ -1,11 +1,25 @@
 from datetime import datetime
-from pydantic import BaseModel, field_serializer, field_validator
+from typing import Annotated, Literal
+from pydantic import BaseModel, Field, field_serializer, field_validator, model_validator
 
-from datetime import datetime
 from pydantic import GetCoreSchemaHandler
 from pydantic.json_schema import JsonSchemaValue
 from pydantic_core import core_schema
 
+from app.batch import TransactionBatch
+from app.dedup import DEDUP_MAX_CAPACITY
+from app.dates import DATE_FORMAT, format_datetime, parse_datetime
+
+# upper bound of scenarios x K periods for a single sweep request
+MAX_SWEEP_CELLS = 5000000
+# upper bound of K periods x steps for a single trajectory request
+MAX_TRAJECTORY_CELLS = 5000000
+# upper bound of the return paths of a single simulation request
+MAX_SIMULATION_PATHS = 1000000
+# ages are bounded so the horizon to retirement (60 - age years) stays within a lifetime
+MAX_AGE = 120
+Age = Annotated[int, Field(ge=0, le=MAX_AGE)]
+
 
 class CustomDateTime:
     @classmethod
@@ -25,7 +39,9 @@ class CustomDateTime:
         if isinstance(value, datetime):
             return value
         try:
-            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            if isinstance(value, str):
+                return parse_datetime(value)
+            return datetime.strptime(value, DATE_FORMAT)
         except ValueError:
             raise ValueError('date must be in format "YYYY-MM-DD HH:mm:ss"')
 
@@ -40,7 +56,7 @@ class TransactionInvalidResponse(BaseModel):
     
     @field_serializer("date")
     def serialize_datetime(self, value: datetime):
-        return value.strftime("%Y-%m-%d %H:%M:%S")
+        return format_datetime(value)
 
 
 class TransactionParseResponse(TransactionParseRequest):
@@ -49,7 +65,7 @@ class TransactionParseResponse(TransactionParseRequest):
 
     @field_serializer("date")
     def serialize_datetime(self, value: datetime):
-        return value.strftime("%Y-%m-%d %H:%M:%S")
+        return format_datetime(value)
 
 class TransactionValidateRequest(BaseModel):
     wage: float
@@ -64,20 +80,67 @@ class TransactionPPeriodRequest(TransactionKPeriodRequest):
 class TransactionQPeriodRequest(TransactionKPeriodRequest):
     fixed: float
 
-class TransactionFilterRequest(BaseModel):
+class RulePlanRequest(BaseModel):
     q: list[TransactionQPeriodRequest]
     p: list[TransactionPPeriodRequest]
     k: list[TransactionKPeriodRequest]
+
+class RulePlanResponse(BaseModel):
+    planId: str
+    q: int
+    p: int
+    k: int
+
+class DedupRequest(BaseModel):
+    # memory-bounded mode (Bloom filter and spill set) for very large inputs
+    bounded: bool = False
+    # distinct transactions the Bloom filter of a bounded state is sized for
+    capacity: int | None = Field(None, gt=0, le=DEDUP_MAX_CAPACITY)
+
+class DedupResponse(BaseModel):
+    dedupId: str
+    bounded: bool
+    transactionCount: int
+
+class TransactionPeriodsRequest(BaseModel):
+    # either the q/p/k periods inline or the id of a plan registered with POST /plans
+    q: list[TransactionQPeriodRequest] = []
+    p: list[TransactionPPeriodRequest] = []
+    k: list[TransactionKPeriodRequest] = []
+    planId: str | None = None
     wage: float
-    transaction: list[TransactionParseRequest]
+
+    @model_validator(mode="before")
+    @classmethod
+    def check_periods_or_plan(cls, data):
+        if isinstance(data, dict):
+            if data.get("planId") is None:
+                missing = [name for name in ("q", "p", "k") if name not in data]
+                if missing:
+                    raise ValueError(f"{', '.join(missing)} required when no planId is given")
+            elif any(data.get(name) for name in ("q", "p", "k")):
+                raise ValueError("q, p and k must be omitted when a planId is given")
+        return data
+
+class TransactionFilterRequest(TransactionPeriodsRequest):
+    # validated straight into compact columns, see TransactionBatch
+    transaction: TransactionBatch
 
 
 class FilteredTransactionResponse(TransactionParseResponse):
     inKPeriod: bool
     
 class ReturnNpsIndexRequest(TransactionFilterRequest):
-    age : int
+    age : Age
     inflation: float
+    # "transaction" compounds every remanent from its own date to retirement instead of 60 - age years per K period
+    compounding: Literal["period", "transaction"] = "period"
+    # the date the age refers to, for "transaction" compounding; defaults to the end of the last K period
+    asOf: CustomDateTime | None = None
+
+class ReturnBulkItem(ReturnNpsIndexRequest):
+    # echoed back with the result of the portfolio, so the caller can match it
+    id: str | int | None = None
 
 class ReturnNpsIndexResponse(BaseModel):
     start: datetime
@@ -87,13 +150,196 @@ class ReturnNpsIndexResponse(BaseModel):
     taxBenefit: float
     @field_serializer("start")
     def serialize_start_datetime(self, value: datetime):
-        return value.strftime("%Y-%m-%d %H:%M:%S")
+        return format_datetime(value)
 
     @field_serializer("end")
     def serialize_end_datetime(self, value: datetime):
-        return value.strftime("%Y-%m-%d %H:%M:%S")
+        return format_datetime(value)
+
+class ReturnScenario(BaseModel):
+    mode: Literal["nps", "index"]
+    age: Age
+    inflation: float
+    rate: float | None = None
+
+class ReturnBatchRequest(TransactionFilterRequest):
+    scenarios: list[ReturnScenario]
+
+class ReturnScenarioResponse(BaseModel):
+    mode: str
+    age: int
+    inflation: float
+    rate: float
+    savingsByDates: list[ReturnNpsIndexResponse]
+
+class ReturnBatchResponse(BaseModel):
+    totalTransactionAmount: float
+    totalCeilingAmount: float
+    projections: list[ReturnScenarioResponse]
+
+class ReturnSweepRequest(TransactionFilterRequest):
+    modes: list[Literal["nps", "index"]] = ["nps"]
+    ages: list[Age]
+    inflations: list[float]
+    # defaults to [wage]
+    wages: list[float] | None = None
+
+    @model_validator(mode="after")
+    def check_grid_size(self):
+        self.check_cells(len(self.k))
+        return self
+
+    def check_cells(self, k_count: int):
+        wages = len(self.wages) if self.wages is not None else 1
+        cells = len(self.modes) * len(self.ages) * len(self.inflations) * wages * max(k_count, 1)
+        if cells > MAX_SWEEP_CELLS:
+            raise ValueError(f"sweep grid too large: {cells} cells, at most {MAX_SWEEP_CELLS} allowed")
+
+class ReturnSweepPeriod(BaseModel):
+    start: datetime
+    end: datetime
+    amount: float
+
+    @field_serializer("start", "end")
+    def serialize_datetime(self, value: datetime):
+        return format_datetime(value)
+
+class ReturnSweepScenario(BaseModel):
+    mode: str
+    age: int
+    inflation: float
+    wage: float
+
+class ReturnSweepResponse(BaseModel):
+    totalTransactionAmount: float
+    totalCeilingAmount: float
+    periods: list[ReturnSweepPeriod]
+    scenarios: list[ReturnSweepScenario]
+    # one row per scenario, one column per K period; null when the scenario age is 60 or above
+    profit: list[list[float] | None]
+    taxBenefit: list[list[float] | None]
+
+class JobResponse(BaseModel):
+    jobId: str
+    kind: str
+    status: Literal["queued", "running", "done", "failed"]
+    # queued jobs ahead of this one
+    position: int | None = None
+    # unix timestamps
+    submittedAt: float
+    startedAt: float | None = None
+    finishedAt: float | None = None
+    # the error and HTTP status of a failed job
+    error: str | None = None
+    statusCode: int | None = None
+    # transactions of the job and, while it runs, how many went through the engine so far
+    rowsTotal: int = 0
+    rowsDone: int = 0
+
+class ReturnTrajectoryRequest(ReturnNpsIndexRequest):
+    mode: Literal["nps", "index"] = "nps"
+    step: Literal["year", "month"] = "year"
+    # overrides the rate of the mode
+    rate: float | None = None
+
+    @model_validator(mode="after")
+    def check_trajectory_size(self):
+        if self.compounding != "period":
+            raise ValueError("trajectories only support period compounding")
+        self.check_cells(len(self.k))
+        return self
+
+    def check_cells(self, k_count: int):
+        steps = max(60 - self.age, 0) * (12 if self.step == "month" else 1)
+        cells = steps * max(k_count, 1)
+        if cells > MAX_TRAJECTORY_CELLS:
+            raise ValueError(f"trajectory too large: {cells} cells, at most {MAX_TRAJECTORY_CELLS} allowed")
+
+class ReturnTrajectoryResponse(BaseModel):
+    totalTransactionAmount: float
+    totalCeilingAmount: float
+    mode: str
+    rate: float
+    step: str
+    periods: list[ReturnSweepPeriod]
+    # time of every step in years from now
+    times: list[float]
+    # one row per K period, one column per step
+    nominal: list[list[float]]
+    real: list[list[float]]
+
+class ReturnSimulationRequest(ReturnNpsIndexRequest):
+    mode: Literal["nps", "index"] = "nps"
+    paths: int = Field(10000, gt=0, le=MAX_SIMULATION_PATHS)
+    # a random seed is drawn (and returned) when not given
+    seed: int | None = Field(None, ge=0)
+    # yearly return mean and volatility, default to the rate of the mode and BLK_SIMULATION_<MODE>_VOLATILITY
+    mean: float | None = Field(None, gt=-1)
+    volatility: float | None = Field(None, ge=0)
+    percentiles: list[float] = Field([5, 25, 50, 75, 95], min_length=1)
+
+    @model_validator(mode="after")
+    def check_simulation(self):
+        if self.compounding != "period":
+            raise ValueError("simulations only support period compounding")
+        if any(q < 0 or q > 100 for q in self.percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+        return self
+
+class ReturnSimulationResponse(BaseModel):
+    totalTransactionAmount: float
+    totalCeilingAmount: float
+    mode: str
+    mean: float
+    volatility: float
+    paths: int
+    seed: int
+    percentiles: list[float]
+    # empty, like savingsByDates of returns:nps, when the age is 60 or above
+    periods: list[ReturnSweepPeriod]
+    # one row per K period, one column per percentile
+    realValue: list[list[float]]
+    profit: list[list[float]]
+    expectedRealValue: list[float]
+    taxBenefit: list[float]
+    # share of the paths that lose value after inflation
+    lossProbability: float
+
+class SessionResponse(BaseModel):
+    id: str
+    transactionCount: int
+
+class RouteMetrics(BaseModel):
+    count: int
+    errors: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    mean_ms: float
+    request_bytes: int
+    response_bytes: int
+    rows: int
+    max_rows: int
+
+class StageMetrics(BaseModel):
+    count: int
+    total_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+class CacheMetrics(BaseModel):
+    entries: int
+    bytes: int
+    hits: int
+    misses: int
+    evictions: int
 
 class PerformanceResponse(BaseModel):
     response_time_ms: float
     memory_usage_mb: float
-    thread_count: int
\ No newline at end of file
+    thread_count: int
+    # only returned with ?detailed=true
+    routes: dict[str, RouteMetrics] | None = None
+    stages: dict[str, StageMetrics] | None = None
+    cache: CacheMetrics | None = None
\ No newline at end of file
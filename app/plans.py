@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from pydantic_core import to_json
+
+from app.dates import format_datetime
+from app.utils import RulePlan, rule_plan
+
+# compiled plans kept per worker; the least recently used ones are dropped beyond this
+PLAN_MAX_ENTRIES = int(os.getenv("BLK_PLAN_MAX_ENTRIES", "1024"))
+
+
+class PlanNotFoundError(Exception):
+    pass
+
+
+def plan_id(request) -> str:
+    """
+    This function returns the content hash of a q/p/k period set, so registering the same set twice
+    (or on another worker) gives the same plan id.
+    """
+    canonical = [
+        [[q.start, q.end, q.fixed] for q in request.q],
+        [[p.start, p.end, p.extra] for p in request.p],
+        [[k.start, k.end] for k in request.k],
+    ]
+    return hashlib.blake2b(to_json(canonical), digest_size=16).hexdigest()
+
+
+def plan_body(plan: RulePlan) -> bytes:
+    """
+    This function serializes the periods of a plan as a POST /plans body, so a process that does not have the
+    plan registered can register it again, under the same plan id.
+    """
+    def period(item, value_attr=None):
+        body = {"start": format_datetime(item.start), "end": format_datetime(item.end)}
+        if value_attr is not None:
+            body[value_attr] = getattr(item, value_attr)
+        return body
+
+    return to_json({
+        "q": [period(q, "fixed") for q in plan.q],
+        "p": [period(p, "extra") for p in plan.p],
+        "k": [period(k) for k in plan.k],
+    })
+
+
+class PlanRegistry:
+    """
+    LRU store of compiled RulePlans by plan id.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, request):
+        """
+        This function compiles the periods of a RulePlanRequest, unless a plan with the same content
+        is already registered, and returns (plan id, plan).
+        """
+        key = plan_id(request)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return key, plan
+        plan = RulePlan(request.q, request.p, request.k)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+        return key, plan
+
+    def get(self, key: str) -> RulePlan:
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is None:
+                raise PlanNotFoundError(f"plan {key} not found, register it again with POST /plans")
+            self._plans.move_to_end(key)
+            return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+plan_registry = PlanRegistry(PLAN_MAX_ENTRIES)
+
+
+def resolve_plan(request) -> RulePlan:
+    """
+    This function returns the RulePlan of a request: the registered one its planId refers to,
+    or the periods inlined in the request compiled on the fly.
+    """
+    if getattr(request, "planId", None) is not None:
+        return plan_registry.get(request.planId)
+    return rule_plan(request)
@@ -0,0 +1,129 @@
+from fastapi.responses import Response
+from pydantic_core import to_json
+
+from app.dates import format_datetime
+from app.simulation import simulation_bands, simulation_params
+from app.utils import (TRAJECTORY_STEPS, calculate_tax, calculate_tax_many, compute_remanents, investment_trajectory,
+                       mode_rate)
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response serialized straight to bytes by pydantic-core, without going through
+    the response_model validation and jsonable_encoder of the endpoint.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return to_json(content)
+
+
+def parse_rows(transactions):
+    """
+    This function builds the :parse response rows as plain dicts, with the ceilings and remanents
+    computed in one vectorized pass and the dates pre-formatted.
+    """
+    ceilings, remanents = compute_remanents(transactions, [], [])
+    return [
+        {"date": format_datetime(txn.date), "amount": txn.amount, "ceiling": float(ceiling), "remanent": remanent}
+        for txn, ceiling, remanent in zip(transactions, ceilings, remanents)
+    ]
+
+
+def filtered_rows(rows):
+    """
+    This function turns the (date, amount, ceiling, remanent, inKPeriod) tuples of utils.filter_rows into
+    FilteredTransactionResponse shaped dicts.
+    """
+    return [
+        {"date": format_datetime(date), "amount": amount, "ceiling": float(ceiling), "remanent": remanent, "inKPeriod": in_k_period}
+        for date, amount, ceiling, remanent, in_k_period in rows
+    ]
+
+
+def sweep_body(totals, k_periods, invested_per_k, scenarios, profit_rows, tax_rows):
+    """
+    This function lays out a sweep result as compact columnar JSON: the K periods and scenarios once,
+    then the profit and tax benefit matrices (scenario x K period).
+    """
+    total_transaction_amount, total_ceiling_amount = totals
+    return {
+        "totalTransactionAmount": total_transaction_amount,
+        "totalCeilingAmount": total_ceiling_amount,
+        "periods": [
+            {"start": format_datetime(k.start), "end": format_datetime(k.end), "amount": invested}
+            for k, invested in zip(k_periods, invested_per_k)
+        ],
+        "scenarios": [
+            {"mode": mode, "age": age, "inflation": inflation, "wage": wage}
+            for mode, age, inflation, wage in scenarios
+        ],
+        "profit": profit_rows,
+        "taxBenefit": tax_rows,
+    }
+
+
+def trajectory_body(request, k_periods, result):
+    """
+    This function computes the trajectory of a returns:trajectory request from its projection pipeline result and lays
+    it out as compact columnar JSON: the K periods and the step times (in years) once, then the nominal and inflation
+    adjusted value matrices (K period x step).
+    """
+    rate = mode_rate(request.mode) if request.rate is None else request.rate
+    years = max(60 - request.age, 0)
+    steps_per_year = TRAJECTORY_STEPS[request.step]
+    nominal, real = investment_trajectory(result.k_sums, rate, request.inflation, years, request.step)
+    return {
+        "totalTransactionAmount": result.total_transaction_amount,
+        "totalCeilingAmount": result.total_ceiling_amount,
+        "mode": request.mode,
+        "rate": rate,
+        "step": request.step,
+        "periods": [
+            {"start": format_datetime(k.start), "end": format_datetime(k.end), "amount": invested}
+            for k, invested in zip(k_periods, result.k_sums)
+        ],
+        "times": [t / steps_per_year for t in range(1, years * steps_per_year + 1)],
+        "nominal": nominal,
+        "real": real,
+    }
+
+
+def simulation_body(request, k_periods, result, seed: int, growth):
+    """
+    This function lays out the percentile bands of a returns:simulate request as compact columnar JSON: the K periods
+    and the percentiles once, then the real value and profit matrices (K period x percentile). growth is the growth
+    factor to retirement of every simulated path (simulation.simulate_growth). At 60 or above nothing is projected,
+    as in returns:nps: the periods and bands are empty.
+    """
+    mean, volatility, years, _, _ = simulation_params(request)
+    periods, real, profit, expected, tax_benefit, loss_probability = [], [], [], [], [], 0.0
+    if years > 0:
+        discount = (1 + request.inflation / 100) ** years
+        real, profit, expected, loss_probability = simulation_bands(result.k_sums, growth, discount, request.percentiles)
+        if request.mode == "nps":
+            tax_before = calculate_tax(request.wage)
+            tax_after = calculate_tax_many([request.wage - min(invested, request.wage * 0.10, 200000) for invested in result.k_sums])
+            tax_benefit = [round(tax_before - tax, 2) for tax in tax_after]
+        else:
+            tax_benefit = [0.0] * len(result.k_sums)
+        periods = [
+            {"start": format_datetime(k.start), "end": format_datetime(k.end), "amount": invested}
+            for k, invested in zip(k_periods, result.k_sums)
+        ]
+    return {
+        "totalTransactionAmount": result.total_transaction_amount,
+        "totalCeilingAmount": result.total_ceiling_amount,
+        "mode": request.mode,
+        "mean": mean,
+        "volatility": volatility,
+        "paths": request.paths,
+        "seed": seed,
+        "percentiles": request.percentiles,
+        "periods": periods,
+        "realValue": real,
+        "profit": profit,
+        "expectedRealValue": expected,
+        "taxBenefit": tax_benefit,
+        "lossProbability": loss_probability,
+    }
@@ -2,7 +2,15 @@ from fastapi import APIRouter
 from app.api.transactions import router as transaction_router
 from app.api.performance import router as performance_router
 from app.api.returns import router as returns_router
+from app.api.sessions import router as sessions_router
+from app.api.plans import router as plans_router
+from app.api.dedup import router as dedup_router
+from app.api.jobs import router as jobs_router
 api_router = APIRouter()
 api_router.include_router(transaction_router, prefix="/transactions", tags=["Transactions"])
 api_router.include_router(performance_router, prefix="/performance", tags=["Performance"])
-api_router.include_router(returns_router, prefix="/returns", tags=["Returns"])
\ No newline at end of file
+api_router.include_router(returns_router, prefix="/returns", tags=["Returns"])
+api_router.include_router(sessions_router, prefix="/sessions", tags=["Sessions"])
+api_router.include_router(plans_router, prefix="/plans", tags=["Plans"])
+api_router.include_router(dedup_router, prefix="/dedup", tags=["Dedup"])
+api_router.include_router(jobs_router, prefix="/jobs", tags=["Jobs"])
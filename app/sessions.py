@@ -0,0 +1,208 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime
+
+from app.batch import TransactionBatch
+from app.columnar import AMOUNT_DECIMALS, to_epoch
+from app.dates import format_datetime
+from app.utils import RulePlan, build_projection_results, rule_plan
+
+# optional SQLite file so sessions survive worker restarts
+SESSION_PATH = os.getenv("BLK_SESSION_PATH")
+# sessions kept per worker; the least recently used ones are dropped beyond this (and reloaded from SQLite if set)
+SESSION_MAX_ENTRIES = int(os.getenv("BLK_SESSION_MAX_ENTRIES", "1024"))
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over a fixed number of slots: point add and prefix sum in O(log n).
+    """
+
+    def __init__(self, size: int):
+        self.tree = [0.0] * (size + 1)
+
+    def add(self, index: int, value: float):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += value
+            index += index & -index
+
+    def prefix_sum(self, count: int) -> float:
+        """
+        Sum of the first count slots.
+        """
+        total = 0.0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+
+class Session:
+    """
+    A portfolio whose K period investments are maintained incrementally. Time is cut into segments at every
+    K boundary, and a Fenwick tree holds the remanent total of each segment, so adding a transaction is
+    O(log k + log q + log p) however many were added before, and every K window sum is a difference of two
+    prefix sums. Only the count of the transactions is kept, not the transactions.
+    """
+
+    def __init__(self, session_id: str, request, plan: RulePlan = None):
+        if getattr(request, "compounding", "period") != "period":
+            raise ValueError("sessions only support period compounding")
+        self.id = session_id
+        # the configuration of the session, without the transactions it was created with
+        self.request = request.model_copy(update={"transaction": TransactionBatch()})
+        self.lock = threading.Lock()
+        self.plan = plan if plan is not None else rule_plan(request)
+        self.k_bounds = [(to_epoch(k.start), to_epoch(k.end) + 1) for k in self.plan.k]
+        self.boundaries = sorted({point for bounds in self.k_bounds for point in bounds})
+        self.segments = FenwickTree(len(self.boundaries) + 1)
+        self.transaction_count = 0
+        self.total_transaction_amount = 0
+        self.total_ceiling_amount = 0
+
+    def add_transactions(self, transactions):
+        transactions = TransactionBatch.validate(transactions)
+        with self.lock:
+            self.transaction_count += len(transactions)
+            for epoch, amount in zip(transactions.epochs, transactions.amounts):
+                self.segments.add(bisect_right(self.boundaries, epoch), self.remanent(epoch, amount))
+                if amount >= 0:
+                    self.total_transaction_amount += amount
+                    self.total_ceiling_amount += math.ceil(amount / 100) * 100
+
+    def remanent(self, epoch: int, amount: float) -> float:
+        """
+        The remanent of one transaction after the Q and P rules, looked up in the compiled plan in O(log q + log p).
+        """
+        remanent = math.ceil(amount / 100) * 100 - amount
+        fixed = self.plan.q_map.fixed_at(epoch)
+        if fixed is not None:
+            remanent = fixed
+        return remanent + self.plan.p_steps.extra_at(epoch)
+
+    def k_period_investments(self):
+        with self.lock:
+            sums = []
+            for start, end in self.k_bounds:
+                # a K period ending before it starts holds nothing
+                if end <= start:
+                    sums.append(0)
+                    continue
+                sums.append(round(
+                    self.segments.prefix_sum(bisect_left(self.boundaries, end) + 1)
+                    - self.segments.prefix_sum(bisect_left(self.boundaries, start) + 1),
+                    AMOUNT_DECIMALS,
+                ))
+            return sums
+
+    def returns(self, mode: str):
+        years = 60 - self.request.age
+        if years <= 0:
+            savings = []
+        else:
+            savings = build_projection_results(
+                self.plan.k, self.k_period_investments(), self.request.wage, self.request.inflation, years, mode
+            )
+        return {
+            "totalTransactionAmount": self.total_transaction_amount,
+            "totalCeilingAmount": self.total_ceiling_amount,
+            "savingsByDates": savings,
+        }
+
+
+class SessionStore:
+    """
+    In process LRU store of sessions, optionally backed by SQLite: the session configuration and its transactions
+    are written through, and a session missing from memory (evicted, or after a restart) is rebuilt from them.
+    Without SQLite an evicted session is gone.
+    """
+
+    def __init__(self, path=None, max_entries: int = SESSION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, config TEXT NOT NULL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS session_transactions (session_id TEXT NOT NULL, date TEXT NOT NULL, amount REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS session_transactions_id ON session_transactions (session_id)")
+
+    def create(self, request, plan: RulePlan = None) -> Session:
+        if plan is not None and request.planId is not None:
+            # store the periods themselves, the plan registry does not survive restarts
+            request = request.model_copy(update={"q": plan.q, "p": plan.p, "k": plan.k, "planId": None})
+        session = Session(uuid.uuid4().hex, request, plan)
+        if self._db is not None:
+            config = json.dumps(request.model_dump(exclude={"transaction"}), default=format_datetime)
+            with self._lock:
+                self._db.execute("INSERT INTO sessions (id, config) VALUES (?, ?)", (session.id, config))
+        self.add_transactions(session, request.transaction)
+        with self._lock:
+            self._remember(session)
+        return session
+
+    def get(self, session_id: str):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        if session is None and self._db is not None:
+            session = self._load(session_id)
+        return session
+
+    def _remember(self, session: Session) -> Session:
+        # called with the lock held; a session loaded concurrently by another request wins
+        session = self._sessions.setdefault(session.id, session)
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+        return session
+
+    def add_transactions(self, session: Session, transactions):
+        transactions = TransactionBatch.validate(transactions)
+        session.add_transactions(transactions)
+        if self._db is not None and transactions:
+            rows = [(session.id, format_datetime(date), amount) for date, amount in transactions]
+            with self._lock:
+                self._db.executemany("INSERT INTO session_transactions (session_id, date, amount) VALUES (?, ?, ?)", rows)
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+            if self._db is not None:
+                found = self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0 or found
+                self._db.execute("DELETE FROM session_transactions WHERE session_id = ?", (session_id,))
+        return found
+
+    def _load(self, session_id: str):
+        from app.models import ReturnNpsIndexRequest
+
+        with self._lock:
+            row = self._db.execute("SELECT config FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            rows = self._db.execute(
+                "SELECT date, amount FROM session_transactions WHERE session_id = ? ORDER BY rowid", (session_id,)
+            ).fetchall()
+        request = ReturnNpsIndexRequest.model_validate({**json.loads(row[0]), "transaction": []})
+        session = Session(session_id, request)
+        session.add_transactions(TransactionBatch(
+            array("q", [to_epoch(datetime.fromisoformat(date)) for date, _ in rows]), array("d", [amount for _, amount in rows])
+        ))
+        with self._lock:
+            return self._remember(session)
+
+
+session_store = SessionStore(SESSION_PATH)
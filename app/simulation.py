@@ -0,0 +1,153 @@
+import asyncio
+import math
+import os
+import random
+
+from starlette.concurrency import run_in_threadpool
+
+from app import columnar
+from app.executor import compute_pool
+from app.utils import mode_rate
+
+# paths simulated together by one generator; the returns of a block are summed year by year, so it holds a few
+# (paths,) arrays at a time
+SIMULATION_BLOCK_PATHS = 8192
+# paths per process pool job when a simulation is sharded
+SIMULATION_SHARD_PATHS = int(os.getenv("BLK_SIMULATION_SHARD_PATHS", "65536"))
+# yearly return volatility of each mode; the mean defaults to the fixed rate of the mode
+SIMULATION_VOLATILITY = {
+    "nps": float(os.getenv("BLK_SIMULATION_NPS_VOLATILITY", "0.06")),
+    "index": float(os.getenv("BLK_SIMULATION_INDEX_VOLATILITY", "0.16")),
+}
+
+
+def lognormal_params(mean: float, volatility: float):
+    """
+    This function returns the (mu, sigma) of the normal log return log(1 + r) of a yearly return r with the
+    given mean and standard deviation.
+    """
+    growth = 1 + mean
+    sigma2 = math.log(1 + volatility ** 2 / growth ** 2)
+    return math.log(growth) - sigma2 / 2, math.sqrt(sigma2)
+
+
+def simulation_params(request):
+    """
+    This function resolves the yearly return mean and volatility of a returns:simulate request, with the years to
+    retirement and the (mu, sigma) of the yearly log returns.
+    """
+    mean = mode_rate(request.mode) if request.mean is None else request.mean
+    volatility = SIMULATION_VOLATILITY[request.mode] if request.volatility is None else request.volatility
+    return mean, volatility, max(60 - request.age, 0), *lognormal_params(mean, volatility)
+
+
+def simulation_seed(request) -> int:
+    """
+    The seed of a simulation: the one of the request, or a random one returned with the result to reproduce it.
+    """
+    return request.seed if request.seed is not None else random.SystemRandom().randrange(2 ** 32)
+
+
+def path_blocks(paths: int):
+    """
+    The (block index, paths) of the blocks of a simulation.
+    """
+    return [(i, min(SIMULATION_BLOCK_PATHS, paths - start)) for i, start in enumerate(range(0, paths, SIMULATION_BLOCK_PATHS))]
+
+
+def shard_blocks(blocks):
+    """
+    This function groups blocks into process pool shards of about SIMULATION_SHARD_PATHS paths.
+    """
+    per_shard = max(1, SIMULATION_SHARD_PATHS // SIMULATION_BLOCK_PATHS)
+    return [blocks[i:i + per_shard] for i in range(0, len(blocks), per_shard)]
+
+
+def simulate_growth(seed: int, blocks, years: int, mu: float, sigma: float):
+    """
+    This function simulates the growth factor over years of every path of the given blocks, with independent
+    lognormal yearly returns. Every block draws from its own generator seeded with (seed, block index), so the
+    paths are the same however the blocks are sharded. Returns a float64 array with numpy, a list otherwise, empty
+    when there are no years to retirement (like returns:nps, nothing is projected then).
+    """
+    if years <= 0:
+        blocks = []
+    if columnar.HAS_NUMPY:
+        return columnar.np.concatenate(
+            [columnar.lognormal_growth(seed, block, paths, years, mu, sigma) for block, paths in blocks]
+        ) if blocks else columnar.np.empty(0)
+    growth = []
+    for block, paths in blocks:
+        rng = random.Random(f"{seed}/{block}")
+        growth.extend(math.exp(sum(rng.gauss(mu, sigma) for _ in range(years))) for _ in range(paths))
+    return growth
+
+
+async def simulate_growth_async(seed: int, paths: int, years: int, mu: float, sigma: float):
+    """
+    simulate_growth of all the paths of a simulation, sharded across the process pool when there is more than one
+    shard of SIMULATION_SHARD_PATHS paths (and a pool), in a thread otherwise. The paths are the same either way.
+    At most one shard per worker is in the pool at a time, so a simulation leaves room in the pool queue for other
+    requests; a saturated pool raises PoolSaturatedError (429) like the other offloaded endpoints.
+    """
+    shards = shard_blocks(path_blocks(paths))
+    if compute_pool.workers == 0 or len(shards) < 2 or years <= 0:
+        return await run_in_threadpool(simulate_growth, seed, path_blocks(paths), years, mu, sigma)
+    slots = asyncio.Semaphore(compute_pool.workers)
+
+    async def simulate_shard(blocks):
+        async with slots:
+            return await compute_pool.submit(simulate_growth, seed, blocks, years, mu, sigma)
+
+    tasks = [asyncio.ensure_future(simulate_shard(blocks)) for blocks in shards]
+    try:
+        parts = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    if columnar.HAS_NUMPY:
+        return columnar.np.concatenate(parts)
+    return [value for part in parts for value in part]
+
+
+def _percentiles(values, percentiles):
+    # linear interpolation between the closest ranks, like numpy.percentile
+    values = sorted(values)
+    result = []
+    for q in percentiles:
+        position = (len(values) - 1) * q / 100
+        low = math.floor(position)
+        high = min(low + 1, len(values) - 1)
+        result.append(values[low] + (values[high] - values[low]) * (position - low))
+    return result
+
+
+def simulation_bands(invested_per_k, growth, discount: float, percentiles):
+    """
+    This function returns the percentile bands of the real value and of the profit of every K period investment
+    over the simulated paths, their expected real value and the probability of a real loss.
+    The real value of a K period on a path is its investment times the real growth factor of the path, so the
+    percentiles of the (paths,) real growth factors are computed once and scaled by every investment (a negative
+    one reverses the order of the percentiles), instead of sorting a paths x K matrix.
+    """
+    if columnar.HAS_NUMPY:
+        real_growth = columnar.np.asarray(growth) / discount
+        low_to_high = columnar.np.percentile(real_growth, percentiles).tolist()
+        high_to_low = columnar.np.percentile(real_growth, [100 - q for q in percentiles]).tolist()
+        mean = float(real_growth.mean())
+        loss_probability = float((real_growth < 1).mean())
+    else:
+        real_growth = [value / discount for value in growth]
+        low_to_high = _percentiles(real_growth, percentiles)
+        high_to_low = _percentiles(real_growth, [100 - q for q in percentiles])
+        mean = sum(real_growth) / len(real_growth)
+        loss_probability = sum(value < 1 for value in real_growth) / len(real_growth)
+
+    real_rows, profit_rows = [], []
+    for invested in invested_per_k:
+        factors = low_to_high if invested >= 0 else high_to_low
+        real_rows.append([round(invested * factor, 2) for factor in factors])
+        profit_rows.append([round(invested * factor - invested, 2) for factor in factors])
+    expected = [round(invested * mean, 2) for invested in invested_per_k]
+    return real_rows, profit_rows, expected, loss_probability
@@ -0,0 +1,201 @@
+import json
+import tempfile
+
+from pydantic import TypeAdapter, ValidationError
+
+from app.columnar import to_epoch
+from app.dedup import BoundedDedupState, DedupState
+from app.external import ExternalSorter
+from app.models import TransactionParseRequest, TransactionParseResponse, TransactionPeriodsRequest
+from app.plans import resolve_plan
+from app.uploads import UploadFormatError
+from app.utils import (FILTER_STAGES, VALIDATE_STAGES, TransactionPipeline, calculate_ceiling_and_remanent,
+                       filtered_transaction_models)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# number of transactions validated and processed together
+STREAM_CHUNK_SIZE = 10000
+# request bodies above this size are spooled to a temporary file instead of memory
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+NDJSON_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {NDJSON_MEDIA_TYPE: {"schema": {"type": "string", "format": "binary"}}},
+    }
+}
+
+transaction_adapter = TypeAdapter(TransactionParseRequest)
+
+
+class NdjsonLineError(ValueError):
+    def __init__(self, line_number: int, message: str):
+        super().__init__(message)
+        self.line_number = line_number
+
+
+async def spool_request_body(request):
+    """
+    This function reads the request body incrementally into a spooled temporary file, so large uploads
+    are kept on disk rather than in memory. The body is fully received before the response starts streaming.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    async for data in request.stream():
+        body.write(data)
+    body.seek(0)
+    return body
+
+
+def iter_lines(body):
+    """
+    This function yields (line_number, text) for every non blank line of the spooled body and closes it at the end.
+    """
+    try:
+        for line_number, raw in enumerate(body, start=1):
+            line = raw.strip()
+            if line:
+                yield line_number, line
+    finally:
+        body.close()
+
+
+def iter_transaction_chunks(lines):
+    """
+    This function validates NDJSON transaction lines into TransactionParseRequest models, in chunks of STREAM_CHUNK_SIZE.
+    """
+    chunk = []
+    for line_number, line in lines:
+        try:
+            chunk.append(transaction_adapter.validate_json(line))
+        except ValidationError as e:
+            raise NdjsonLineError(line_number, str(e))
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def error_line(e: Exception) -> bytes:
+    error = {"error": str(e)}
+    if isinstance(e, NdjsonLineError):
+        error["line"] = e.line_number
+    elif isinstance(e, UploadFormatError):
+        error["row"] = e.row
+    return to_ndjson(error)
+
+
+def to_ndjson(item) -> bytes:
+    return json.dumps(item).encode() + b"\n"
+
+
+def model_line(key, model) -> bytes:
+    return b'{"' + key.encode() + b'":' + model.model_dump_json().encode() + b"}\n"
+
+
+def parse_response(transaction) -> TransactionParseResponse:
+    """
+    The TransactionParseResponse of a streamed transaction, with its ceiling and remanent and the response date format.
+    """
+    ceiling, remanent = calculate_ceiling_and_remanent(transaction.amount)
+    return TransactionParseResponse(
+        date=transaction.date,
+        amount=transaction.amount,
+        ceiling=ceiling,
+        remanent=remanent
+    )
+
+
+def stream_parse(body):
+    """
+    Streaming version of :parse, one TransactionParseResponse per output line.
+    """
+    try:
+        for chunk in iter_transaction_chunks(iter_lines(body)):
+            yield b"".join(parse_response(transaction).model_dump_json().encode() + b"\n" for transaction in chunk)
+    except Exception as e:
+        yield error_line(e)
+
+
+def stream_validate(body, dedup=None):
+    """
+    Streaming version of :validate. Every output line is either {"valid": {...}}, the TransactionParseResponse of the
+    transaction as :validate returns it, or {"invalid": {...}}. Duplicate detection is shared across chunks, and across requests when a registered dedup state is given.
+    """
+    pipeline = TransactionPipeline(VALIDATE_STAGES)
+    if dedup is None:
+        dedup = DedupState()
+    try:
+        for chunk in iter_transaction_chunks(iter_lines(body)):
+            result = pipeline.run(chunk, dedup)
+            yield b"".join([model_line("invalid", t) for t in result.invalid] + [model_line("valid", parse_response(t)) for t in result.transactions])
+    except Exception as e:
+        yield error_line(e)
+
+
+def stream_filter(body, dedup=None):
+    """
+    Streaming version of :filter. The first line holds the q, p, k periods (or a planId) and the wage, the following lines
+    the transactions, which must be sorted by date so every chunk can be processed on its own.
+    """
+    # a per request state only needs the keys of the last date, the input being sorted
+    shared = dedup is not None
+    if dedup is None:
+        dedup = DedupState()
+    lines = iter_lines(body)
+    try:
+        header = next(lines, None)
+        if header is None:
+            return
+        try:
+            periods = TransactionPeriodsRequest.model_validate_json(header[1])
+        except ValidationError as e:
+            raise NdjsonLineError(header[0], str(e))
+        # the plan is compiled once for the whole stream
+        pipeline = TransactionPipeline(FILTER_STAGES, resolve_plan(periods))
+
+        last_date = None
+        for chunk in iter_transaction_chunks(lines):
+            for transaction in chunk:
+                if last_date is not None and transaction.date < last_date:
+                    raise ValueError("transactions must be sorted by date for streaming filter")
+                last_date = transaction.date
+            result = pipeline.run(chunk, dedup)
+            if not shared:
+                dedup.forget_before(to_epoch(last_date))
+
+            filtered = filtered_transaction_models(result.filter_rows())
+            yield b"".join([model_line("invalid", t) for t in result.invalid] + [model_line("valid", t) for t in filtered])
+    except Exception as e:
+        yield error_line(e)
+
+
+def stream_filter_external(chunks, plan, dedup=None):
+    """
+    Out of core version of :filter for transaction chunks in any order (see app.uploads.iter_transactions).
+    Every chunk is validated in arrival order and its valid transactions are spilled to an ExternalSorter; the
+    merged, date ordered sequence then goes through the rule stages chunk by chunk. Duplicates are detected with a
+    memory-bounded BoundedDedupState unless a registered state is given. The output lines are those of
+    :filterStream, all the invalid ones first.
+    """
+    validate = TransactionPipeline(VALIDATE_STAGES)
+    rules = TransactionPipeline([name for name in FILTER_STAGES if name != "validate"], plan)
+    owned = dedup is None
+    if owned:
+        dedup = BoundedDedupState()
+    try:
+        with ExternalSorter() as sorter:
+            for chunk in chunks:
+                result = validate.run(chunk, dedup)
+                sorter.add(result.transactions)
+                if result.invalid:
+                    yield b"".join(model_line("invalid", t) for t in result.invalid)
+            for chunk in sorter.merged():
+                filtered = filtered_transaction_models(rules.run(chunk).filter_rows())
+                yield b"".join(model_line("valid", t) for t in filtered)
+    except Exception as e:
+        yield error_line(e)
+    finally:
+        if owned:
+            dedup.close()
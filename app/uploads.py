@@ -0,0 +1,250 @@
+import csv
+import io
+import json
+import math
+import struct
+import sys
+from array import array
+
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from app import columnar
+from app.batch import DATE_ERROR, TransactionBatch
+from app.columnar import to_epoch
+from app.dates import parse_datetime
+
+# rows parsed and appended to the columns together
+UPLOAD_CHUNK_ROWS = 10000
+
+# binary columnar upload: header (magic, version, row count), then row count int64 epoch seconds
+# and row count float64 amounts, all little endian
+COLUMNAR_MAGIC = b"BLKT"
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct("<4sIQ")
+
+# positions of the digits in "YYYY-MM-DD HH:mm:ss"
+_DATE_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+
+
+class UploadFormatError(ValueError):
+    def __init__(self, row: int, message: str):
+        super().__init__(message)
+        self.row = row
+
+
+def encode_columnar(batch: TransactionBatch) -> bytes:
+    """
+    This function serializes a batch to the binary columnar upload format.
+    """
+    epochs, amounts = batch.epochs, batch.amounts
+    if sys.byteorder == "big":
+        epochs, amounts = array("q", epochs), array("d", amounts)
+        epochs.byteswap()
+        amounts.byteswap()
+    return COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(batch)) + epochs.tobytes() + amounts.tobytes()
+
+
+def iter_columnar(file, chunk_rows: int = UPLOAD_CHUNK_ROWS):
+    """
+    This function reads a binary columnar upload as TransactionBatch chunks of chunk_rows rows.
+    """
+    header = file.read(COLUMNAR_HEADER.size)
+    if len(header) < COLUMNAR_HEADER.size:
+        raise UploadFormatError(0, "truncated header")
+    magic, version, rows = COLUMNAR_HEADER.unpack(header)
+    if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+        raise UploadFormatError(0, f"unsupported columnar format version {version}")
+    size = file.seek(0, io.SEEK_END) - COLUMNAR_HEADER.size
+    if size < rows * 16:
+        # row of the first incomplete value, in the amounts column if the epochs are complete
+        complete = size // 8 - rows if size >= rows * 8 else size // 8
+        raise UploadFormatError(complete + 1, f"truncated data, {rows} rows expected")
+    if size > rows * 16:
+        raise UploadFormatError(rows, f"unexpected data after {rows} rows")
+
+    for start in range(0, rows, chunk_rows):
+        count = min(chunk_rows, rows - start)
+        batch = TransactionBatch()
+        file.seek(COLUMNAR_HEADER.size + start * 8)
+        batch.epochs.frombytes(file.read(count * 8))
+        file.seek(COLUMNAR_HEADER.size + (rows + start) * 8)
+        batch.amounts.frombytes(file.read(count * 8))
+        if sys.byteorder == "big":
+            batch.epochs.byteswap()
+            batch.amounts.byteswap()
+        for i, amount in enumerate(batch.amounts):
+            if not math.isfinite(amount):
+                raise UploadFormatError(start + i + 1, "amount must be a finite number")
+        yield batch
+
+
+def _parse_cell_date(value: str) -> int:
+    try:
+        return to_epoch(parse_datetime(value.strip()))
+    except ValueError:
+        raise ValueError(DATE_ERROR)
+
+
+def _parse_cell_amount(value: str) -> float:
+    try:
+        amount = float(value)
+    except ValueError:
+        raise ValueError("amount must be a number")
+    if not math.isfinite(amount):
+        raise ValueError("amount must be a finite number")
+    return amount
+
+
+def _chunk_columns(dates, amounts):
+    """
+    This function converts the date and amount cells of a chunk with numpy. Dates are only accepted in the exact
+    "YYYY-MM-DD HH:mm:ss" layout; anything else raises ValueError.
+    """
+    np = columnar.np
+    dates = np.array(dates, dtype="U19")
+    chars = dates.view("U1").reshape(-1, 19)
+    if (
+        not (np.char.str_len(dates) == 19).all()
+        or not (chars[:, [4, 7]] == "-").all() or not (chars[:, 10] == " ").all() or not (chars[:, [13, 16]] == ":").all()
+        or not np.char.isdigit(chars[:, _DATE_DIGITS]).all()
+        # numpy has a year 0, datetime does not
+        or (chars[:, :4] == "0").all(axis=1).any()
+    ):
+        raise ValueError(DATE_ERROR)
+    epochs = dates.astype("datetime64[s]").astype(np.int64)
+    amounts = np.array(amounts).astype(np.float64)
+    if not np.isfinite(amounts).all():
+        raise ValueError("amount must be a finite number")
+    return array("q", epochs.tobytes()), array("d", amounts.tobytes())
+
+
+def _chunk_batch(chunk) -> TransactionBatch:
+    """
+    This function converts a chunk of (row number, date, amount) cells into a batch. The chunk is converted
+    as a whole (vectorized when numpy is available) and only searched row by row for the failing cell when that raises.
+    """
+    try:
+        if columnar.HAS_NUMPY and all(len(date) == 19 for _, date, _ in chunk):
+            epochs, amounts = _chunk_columns([date for _, date, _ in chunk], [amount for _, _, amount in chunk])
+        else:
+            epochs = array("q", [_parse_cell_date(date) for _, date, _ in chunk])
+            amounts = array("d", [_parse_cell_amount(amount) for _, _, amount in chunk])
+    except ValueError:
+        for row, date, amount in chunk:
+            try:
+                _parse_cell_date(date)
+                _parse_cell_amount(amount)
+            except ValueError as e:
+                raise UploadFormatError(row, str(e))
+        raise
+    return TransactionBatch(epochs, amounts)
+
+
+def iter_csv(file, chunk_rows: int = UPLOAD_CHUNK_ROWS):
+    """
+    This function reads a CSV upload as TransactionBatch chunks of chunk_rows rows. The columns are date and amount,
+    in that order, unless a header row names them (other columns are then ignored). Blank lines are skipped.
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    reader = csv.reader(text)
+    date_column, amount_column = 0, 1
+    chunk = []
+    try:
+        for row in reader:
+            if len(row) < 2 and not "".join(row).strip():
+                continue
+            names = [cell.strip().lower() for cell in row] if reader.line_num == 1 else ()
+            if "date" in names or "amount" in names:
+                if "date" not in names or "amount" not in names:
+                    raise UploadFormatError(1, "the header must name a date and an amount column")
+                date_column, amount_column = names.index("date"), names.index("amount")
+                continue
+            if len(row) <= max(date_column, amount_column):
+                raise UploadFormatError(reader.line_num, "expected a date and an amount")
+            chunk.append((reader.line_num, row[date_column], row[amount_column]))
+            if len(chunk) >= chunk_rows:
+                yield _chunk_batch(chunk)
+                chunk = []
+        if chunk:
+            yield _chunk_batch(chunk)
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise UploadFormatError(reader.line_num, str(e))
+    finally:
+        # the upload owns the file, do not let the wrapper close it
+        text.detach()
+
+
+def iter_transactions(file, chunk_rows: int = UPLOAD_CHUNK_ROWS):
+    """
+    This function reads an uploaded transaction file chunk by chunk, binary columnar if it starts with
+    COLUMNAR_MAGIC and CSV otherwise.
+    """
+    magic = file.read(len(COLUMNAR_MAGIC))
+    file.seek(0)
+    if magic == COLUMNAR_MAGIC:
+        return iter_columnar(file, chunk_rows)
+    return iter_csv(file, chunk_rows)
+
+
+def read_transactions(file) -> TransactionBatch:
+    """
+    This function reads a whole uploaded transaction file into one batch.
+    """
+    batch = TransactionBatch()
+    for chunk in iter_transactions(file):
+        batch.epochs.extend(chunk.epochs)
+        batch.amounts.extend(chunk.amounts)
+    return batch
+
+
+def upload_error(e: UploadFormatError) -> RequestValidationError:
+    """
+    This function reports a format error like a request validation error, located at the file part and the failing row.
+    """
+    return RequestValidationError([{"type": "value_error", "loc": ("body", "file", e.row), "msg": str(e), "input": None}])
+
+
+async def read_upload(upload) -> TransactionBatch:
+    """
+    This function parses a whole UploadFile in the thread pool.
+    """
+    try:
+        return await run_in_threadpool(read_transactions, upload.file)
+    except UploadFormatError as e:
+        raise upload_error(e)
+
+
+def parse_periods(model, periods: str, transactions=None):
+    """
+    This function validates the JSON periods part of an upload (q, p, k or planId, wage, age, inflation...)
+    into a request model, with the given transactions (none by default).
+    """
+    try:
+        data = json.loads(periods)
+    except ValueError as e:
+        raise RequestValidationError([
+            {"type": "json_invalid", "loc": ("body", "periods"), "msg": f"JSON decode error: {e}", "input": periods}
+        ])
+    if not isinstance(data, dict) or "transaction" in data:
+        raise RequestValidationError([
+            {"type": "value_error", "loc": ("body", "periods"), "msg": "periods must be a JSON object without transactions",
+             "input": None}
+        ])
+    try:
+        return model.model_validate({**data, "transaction": transactions if transactions is not None else TransactionBatch()})
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", "periods", *error["loc"])} for error in e.errors(include_url=False)
+        ])
+
+
+async def upload_request(model, upload, periods: str):
+    """
+    This function builds a request model from an upload: the transactions come from the file part and everything
+    else from the JSON periods part.
+    """
+    # bad periods are reported before the file is read
+    parse_periods(model, periods)
+    return parse_periods(model, periods, await read_upload(upload))
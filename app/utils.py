@@ -1,8 +1,20 @@
 from datetime import datetime
 import math
+import threading
+from array import array
 from bisect import bisect_left, bisect_right
-
-from app.models import ReturnNpsIndexResponse
+from collections import OrderedDict
+from functools import cached_property, lru_cache, update_wrapper
+from itertools import accumulate, product
+from typing import NamedTuple
+
+from app import columnar
+from app.batch import TransactionBatch, from_epoch
+from app.columnar import to_epoch
+from app.dedup import DedupState
+from app.metrics import stage
+from app.models import (FilteredTransactionResponse, ReturnNpsIndexResponse, ReturnScenarioResponse,
+                        TransactionInvalidResponse)
 
 def calculate_ceiling_and_remanent(amount: float):
     """
@@ -13,137 +25,822 @@ def calculate_ceiling_and_remanent(amount: float):
     return ceiling, remanent
 
 
+def split_valid_invalid(transactions, dedup=None):
+    """
+    This function separates negative and duplicate transactions from the valid ones. A transaction is a duplicate
+    of an earlier valid one with the same date and amount; dedup is the DedupState to share across chunks or requests.
+    """
+    with stage("validate"):
+        return _split_valid_invalid(transactions, DedupState() if dedup is None else dedup)
+
+
+def _split_valid_invalid(transactions, dedup):
+    candidates = [transaction for transaction in transactions if transaction.amount >= 0]
+    duplicates = iter(dedup.check(
+        array("q", [to_epoch(transaction.date) for transaction in candidates]),
+        array("d", [transaction.amount for transaction in candidates]),
+    ))
+    valid = []
+    invalid = []
+    for transaction in transactions:
+        if transaction.amount < 0:
+            invalid.append(TransactionInvalidResponse(
+                    date=transaction.date,
+                    amount=transaction.amount,
+                    message="negative amounts are not allowed"
+                ))
+        elif next(duplicates):
+            invalid.append(TransactionInvalidResponse(
+                    date=transaction.date,
+                    amount=transaction.amount,
+                    message="Duplicate transactions"
+                ))
+        else:
+            valid.append(transaction)
+    return valid, invalid
+
+
+class QPeriodMap:
+    """
+    Disjoint segment map of the effective fixed value of possibly overlapping Q periods (see columnar.q_segments
+    for the precedence rule), so the Q rule of a date is a single binary search (O(log q)).
+    """
+
+    def __init__(self, q_periods):
+        self.q_periods = list(q_periods)
+        self.bounds, self.values = columnar.q_segments(
+            [to_epoch(q.start) for q in self.q_periods],
+            [to_epoch(q.end) for q in self.q_periods],
+            [q.fixed for q in self.q_periods],
+        )
+
+    def fixed_at(self, epoch: int):
+        """
+        The fixed value applying at epoch, or None when no Q period covers it.
+        """
+        idx = bisect_right(self.bounds, epoch) - 1
+        return self.values[idx] if idx >= 0 else None
+
+    @cached_property
+    def columns(self):
+        """
+        The segment map as (bounds, fixed, covered) arrays for the columnar engine.
+        """
+        return columnar.segment_columns(self.bounds, self.values)
+
+
+class PExtraSteps:
+    """
+    The running extra of possibly overlapping P periods as a piecewise constant step function: values[i] applies
+    from bounds[i] (inclusive) to bounds[i + 1] (exclusive), and nothing applies before bounds[0]. A P extra counts
+    from its start (inclusive) to its end (exclusive). The steps are accumulated in event order once, so the python
+    and the numpy engines add exactly the same value to a transaction.
+    """
+
+    def __init__(self, p_periods):
+        self.p_periods = list(p_periods)
+        events = []
+        for p in self.p_periods:
+            events.append((to_epoch(p.start), p.extra))
+            events.append((to_epoch(p.end), -p.extra))
+        events.sort(key=lambda x: x[0])
+
+        self.bounds = []
+        self.values = []
+        running_extra = 0
+        for epoch, extra in events:
+            running_extra += extra
+            if self.bounds and self.bounds[-1] == epoch:
+                self.values[-1] = running_extra
+            else:
+                self.bounds.append(epoch)
+                self.values.append(running_extra)
+
+    def extra_at(self, epoch: int):
+        idx = bisect_right(self.bounds, epoch) - 1
+        return self.values[idx] if idx >= 0 else 0
+
+    @cached_property
+    def columns(self):
+        """
+        The steps as (bounds, values) arrays for the columnar engine.
+        """
+        return columnar.step_columns(self.bounds, self.values)
+
+
 def apply_q_rule(transactions, remanents, q_periods):
     """
     This function applies the Q rule to the remanents based on the provided Q periods.
-    It sorts the Q periods by their start date and uses binary search to find the applicable Q period for each transaction, updating the remanent to the fixed value if the transaction falls within a Q period.
+    Overlapping Q periods are first resolved into a QPeriodMap (q_periods can also be a prebuilt one), then the
+    remanent of every transaction inside a Q period is replaced by the fixed value of the period that wins there.
     """
-    q_sorted = sorted(q_periods, key=lambda q: q.start)
-    q_starts = [q.start for q in q_sorted]
+    q_map = q_periods if isinstance(q_periods, QPeriodMap) else QPeriodMap(q_periods)
+    if not q_map.bounds:
+        return remanents
 
     for i, txn in enumerate(transactions):
-        idx = bisect_right(q_starts, txn.date) - 1
-
-        if idx >= 0:
-            q = q_sorted[idx]
-            if q.start <= txn.date <= q.end:
-                remanents[i] = q.fixed
+        fixed = q_map.fixed_at(to_epoch(txn.date))
+        if fixed is not None:
+            remanents[i] = fixed
 
     return remanents
 
 
 def apply_p_rule(transactions, remanents, p_periods):
     """
-    This function applies the P rule to the remanents based on the provided P periods. 
-    It creates events for the start and end of each P period, sorts them, and then iterates through the transactions to adjust the remanents according to the running extra amount from the active P periods.
+    This function applies the P rule to the remanents based on the provided P periods.
+    The P periods are compiled into a PExtraSteps step function (p_periods can also be a prebuilt one), which is then
+    swept once along the transactions sorted by date, adding the running extra of the active P periods.
     """
-
-    # Create events
-    events = []
-    for p in p_periods:
-        events.append((p.start, p.extra))
-        events.append((p.end, -p.extra))
-
-    events.sort(key=lambda x: x[0])
+    p_steps = p_periods if isinstance(p_periods, PExtraSteps) else PExtraSteps(p_periods)
+    bounds, values = p_steps.bounds, p_steps.values
 
     running_extra = 0
-    event_index = 0
+    step_index = 0
 
     for i, txn in enumerate(transactions):
-        while event_index < len(events) and events[event_index][0] <= txn.date:
-            running_extra += events[event_index][1]
-            event_index += 1
+        epoch = to_epoch(txn.date)
+        while step_index < len(bounds) and bounds[step_index] <= epoch:
+            running_extra = values[step_index]
+            step_index += 1
 
         remanents[i] += running_extra
 
     return remanents
 
 
-def calculate_tax(income: float) -> float:
+# income tax slabs as (threshold, rate) pairs sorted by threshold: income above a threshold
+# (up to the next one) is taxed at its rate, income up to the first threshold is not taxed
+TAX_SLABS = (
+    (700000, 0.10),
+    (1000000, 0.15),
+    (1200000, 0.20),
+    (1500000, 0.30),
+)
+
+
+@lru_cache(maxsize=4096)
+def calculate_tax(income: float, slabs=TAX_SLABS) -> float:
     """
     Calculate tax based on the provided income slabs.
+    Results are cached since the same wages come back for every K period and scenario.
     """
     tax = 0
 
-    if income <= 700000:
+    if income <= slabs[0][0]:
         return 0
 
-    if income > 1500000:
-        tax += (income - 1500000) * 0.30
-        income = 1500000
+    for threshold, rate in reversed(slabs):
+        if income > threshold:
+            tax += (income - threshold) * rate
+            income = threshold
 
-    if income > 1200000:
-        tax += (income - 1200000) * 0.20
-        income = 1200000
+    return tax
 
-    if income > 1000000:
-        tax += (income - 1000000) * 0.15
-        income = 1000000
 
-    if income > 700000:
-        tax += (income - 700000) * 0.10
+def calculate_tax_many(incomes, slabs=TAX_SLABS):
+    """
+    This function calculates the tax of a list of incomes, vectorized with numpy when it is available.
+    """
+    if columnar.HAS_NUMPY:
+        return columnar.calculate_tax_array(incomes, slabs).tolist()
+    return [calculate_tax(income, slabs) for income in incomes]
 
-    return tax
+
+def compute_remanents(transactions, q_periods, p_periods):
+    """
+    This function computes the ceilings and the remanents (after the Q and P rules) for transactions sorted by date.
+    It uses the columnar numpy engine when numpy is available and falls back to the pure python rules otherwise.
+    q_periods and p_periods can also be a prebuilt QPeriodMap and PExtraSteps, and transactions a TransactionBatch.
+    """
+    if columnar.HAS_NUMPY:
+        q_map = q_periods if isinstance(q_periods, QPeriodMap) else QPeriodMap(q_periods)
+        p_steps = p_periods if isinstance(p_periods, PExtraSteps) else PExtraSteps(p_periods)
+        if isinstance(transactions, TransactionBatch):
+            epochs, amounts = transactions.columns()
+        else:
+            epochs, amounts = columnar.to_columns(transactions)
+        ceilings, remanents = columnar.remanent_columns(epochs, amounts, q_map.columns, p_steps.columns)
+        return ceilings.tolist(), remanents.tolist()
+
+    ceilings = []
+    remanents = []
+    with stage("ceiling"):
+        for txn in transactions:
+            ceiling, remanent = calculate_ceiling_and_remanent(txn.amount)
+            ceilings.append(ceiling)
+            remanents.append(remanent)
+    with stage("q_rule"):
+        remanents = apply_q_rule(transactions, remanents, q_periods)
+    with stage("p_rule"):
+        remanents = apply_p_rule(transactions, remanents, p_periods)
+    return ceilings, remanents
+
+
+class KPeriodIndex:
+    """
+    Interval index over K periods. The periods are sorted and overlapping ones merged once,
+    so membership of a date is a single binary search (O(log k)) instead of a scan over every K period.
+    It also computes the per K period window sums with a prefix sum so each window is O(log n).
+    """
+
+    def __init__(self, k_periods):
+        self.k_periods = list(k_periods)
+        self.starts = []
+        self.ends = []
+        for k in sorted((k for k in self.k_periods if k.start <= k.end), key=lambda k: k.start):
+            if self.ends and k.start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], k.end)
+            else:
+                self.starts.append(k.start)
+                self.ends.append(k.end)
+
+    def contains(self, date) -> bool:
+        idx = bisect_right(self.starts, date) - 1
+        return idx >= 0 and date <= self.ends[idx]
+
+    def membership(self, dates):
+        """
+        Membership flags for dates sorted ascending, found with a single sweep over the merged intervals.
+        """
+        flags = []
+        idx = 0
+        for date in dates:
+            while idx < len(self.ends) and self.ends[idx] < date:
+                idx += 1
+            flags.append(idx < len(self.starts) and self.starts[idx] <= date)
+        return flags
+
+    @cached_property
+    def _merged_columns(self):
+        return columnar.dates_to_epochs(self.starts), columnar.dates_to_epochs(self.ends)
+
+    def merged_columns(self):
+        """
+        The merged intervals as (starts, ends) epoch arrays for the columnar engine.
+        """
+        return self._merged_columns
+
+    @cached_property
+    def merged_epochs(self):
+        """
+        The merged intervals as (starts, ends) lists of epoch seconds.
+        """
+        return [to_epoch(start) for start in self.starts], [to_epoch(end) for end in self.ends]
+
+    @cached_property
+    def window_epochs(self):
+        """
+        The K periods, unmerged and in their original order, as (start, end) epoch seconds.
+        """
+        return [(to_epoch(k.start), to_epoch(k.end)) for k in self.k_periods]
+
+    @cached_property
+    def window_columns(self):
+        """
+        The K periods, unmerged and in their original order, as (starts, ends) epoch arrays for columnar.k_window_sums.
+        """
+        return columnar.period_columns(self.k_periods)
+
+    def window_sums(self, dates, values):
+        """
+        Sum of values whose (sorted) date falls inside each K period, in the original K period order.
+        """
+        prefix = [0, *accumulate(values)]
+        sums = []
+        for k in self.k_periods:
+            l = bisect_left(dates, k.start)
+            r = max(bisect_right(dates, k.end), l)
+            sums.append(round(prefix[r] - prefix[l], columnar.AMOUNT_DECIMALS))
+        return sums
+
+
+def k_period_membership(transactions, k_periods):
+    """
+    This function flags, for transactions sorted by date, whether each one falls inside at least one K period.
+    k_periods can also be a prebuilt KPeriodIndex, e.g. when the same K periods are reused across chunks.
+    """
+    k_index = k_periods if isinstance(k_periods, KPeriodIndex) else KPeriodIndex(k_periods)
+    with stage("k_aggregation"):
+        if columnar.HAS_NUMPY:
+            epochs = columnar.dates_to_epochs([txn.date for txn in transactions])
+            return columnar.k_membership(epochs, k_index.merged_columns()).tolist()
+        return k_index.membership([txn.date for txn in transactions])
 
 
-def investment_projection_engine(payload: dict, mode: str):
+class RulePlan:
     """
-    cal the projection of investments based on the remanents and the rules provided in the payload.
-    calculates the future value of investments at the end of K periods, adjusted for inflation, and computes the profit and tax benefits (if applicable).
+    A q/p/k period set compiled once: the Q periods into a QPeriodMap segment map, the P periods into a PExtraSteps
+    step function and the K periods into a KPeriodIndex. Every engine entry point accepts a plan instead of the raw
+    periods, so a set that is reused across requests (see app.plans) is never sorted or resolved again.
     """
 
-    wage = payload.wage
-    age = payload.age
-    inflation = payload.inflation
-    years = 60 - age
+    def __init__(self, q_periods, p_periods, k_periods):
+        self.q_map = QPeriodMap(q_periods)
+        self.p_steps = PExtraSteps(p_periods)
+        self.k_index = KPeriodIndex(k_periods)
+
+    @property
+    def q(self):
+        return self.q_map.q_periods
+
+    @property
+    def p(self):
+        return self.p_steps.p_periods
+
+    @property
+    def k(self):
+        return self.k_index.k_periods
+
+
+def rule_plan(payload):
+    """
+    This function compiles the periods inlined in a payload into a RulePlan.
+    """
+    return RulePlan(
+        payload.q if hasattr(payload, 'q') else [],
+        payload.p if hasattr(payload, 'p') else [],
+        payload.k if hasattr(payload, 'k') else [],
+    )
+
+
+PIPELINE_STAGES = ("validate", "ceiling", "q_rule", "p_rule", "k_membership", "totals", "k_aggregation")
+
+# the stages behind each endpoint
+VALIDATE_STAGES = ("validate",)
+FILTER_STAGES = ("validate", "ceiling", "q_rule", "p_rule", "k_membership")
+PROJECTION_STAGES = ("ceiling", "q_rule", "p_rule", "totals", "k_aggregation")
+
+
+class PipelineResult:
+    """
+    The buffer a TransactionPipeline works on and the columns its stages fill in. transactions holds the valid
+    transactions: a TransactionBatch sorted by date, unless the pipeline only validates (then they keep their
+    arrival order and type).
+    Columns of stages that did not run are None.
+    """
+
+    def __init__(self, transactions, invalid):
+        self.transactions = transactions
+        self.invalid = invalid
+        self.ceilings = None
+        self.remanents = None
+        self.in_k_periods = None
+        self.total_transaction_amount = 0
+        self.total_ceiling_amount = 0
+        self.k_sums = None
+        # inflation adjusted K window values at retirement, with compounding per transaction date
+        self.k_values = None
+
+    def filter_rows(self):
+        """
+        The transactions as (date, amount, ceiling, remanent, inKPeriod) tuples, dropping the zero remanents.
+        """
+        return [
+            (from_epoch(epoch), amount, ceiling, remanent, in_k_period)
+            for epoch, amount, ceiling, remanent, in_k_period
+            in zip(self.transactions.epochs, self.transactions.amounts, self.ceilings, self.remanents, self.in_k_periods)
+            if remanent != 0
+        ]
+
+
+class TransactionPipeline:
+    """
+    Fused transaction pipeline. The stages (a subset of PIPELINE_STAGES) are composed over a single buffer:
+    validation runs first in arrival order (duplicate detection depends on it), the buffer is then sorted once,
+    and ceiling, Q rule, P rule, K membership, totals and K aggregation are computed in one pass over it.
+    The pass is vectorized over epoch/amount columns with numpy (columnar.pipeline_columns) and made of one
+    python loop per stage otherwise; use_numpy overrides the choice.
+
+    prepare, inputs and finish split run so the pass itself can be sent to the process pool (see app.executor).
+    """
+
+    def __init__(self, stages, plan: RulePlan = None, use_numpy: bool = None):
+        unknown = set(stages) - set(PIPELINE_STAGES)
+        if unknown:
+            raise ValueError(f"unknown pipeline stages: {', '.join(sorted(unknown))}")
+        self.stages = frozenset(stages)
+        self.plan = plan if plan is not None else RulePlan([], [], [])
+        self.use_numpy = columnar.HAS_NUMPY if use_numpy is None else use_numpy
+        # a DailyCompounding also computes the K window values compounded per transaction date (k_values)
+        self.compounding = None
+
+    @property
+    def computes(self) -> bool:
+        return bool(self.stages - {"validate"})
+
+    def run(self, transactions, dedup=None) -> PipelineResult:
+        result = self.prepare(transactions, dedup)
+        if self.computes and result.transactions:
+            if self.use_numpy:
+                self.finish(result, columnar.pipeline_columns(*self.inputs(result)))
+            else:
+                self._python_pass(result)
+        return result
+
+    def prepare(self, transactions, dedup=None) -> PipelineResult:
+        """
+        This function validates the transactions (if the pipeline has a validate stage) and sorts the buffer.
+        dedup shares the duplicate detection state across chunks or requests, see split_valid_invalid.
+        Computing pipelines pack a list of transactions into a TransactionBatch first; a validate only
+        pipeline keeps the objects it was given.
+        """
+        invalid = []
+        if self.computes:
+            transactions = TransactionBatch.validate(transactions)
+        if "validate" in self.stages:
+            if isinstance(transactions, TransactionBatch):
+                with stage("validate"):
+                    transactions, invalid = transactions.split_valid_invalid(dedup)
+            else:
+                transactions, invalid = split_valid_invalid(transactions, dedup)
+        if self.computes:
+            transactions = transactions.sorted()
+        result = PipelineResult(transactions, invalid)
+        if self.computes:
+            result.ceilings = []
+            result.remanents = []
+            result.in_k_periods = [] if "k_membership" in self.stages else None
+            result.k_sums = [0] * len(self.plan.k) if "k_aggregation" in self.stages else None
+            if self.compounding is not None and result.k_sums is not None:
+                result.k_values = [0] * len(self.plan.k)
+        return result
+
+    def inputs(self, result: PipelineResult):
+        """
+        The compact arrays taken by columnar.pipeline_columns for a prepared buffer.
+        """
+        epochs, amounts = result.transactions.columns()
+        empty_q = columnar.segment_columns([], [])
+        empty_p = columnar.step_columns([], [])
+        return (
+            epochs,
+            amounts,
+            self.plan.q_map.columns if "q_rule" in self.stages else empty_q,
+            self.plan.p_steps.columns if "p_rule" in self.stages else empty_p,
+            self.plan.k_index.merged_columns() if "k_membership" in self.stages else None,
+            self.plan.k_index.window_columns if "k_aggregation" in self.stages else None,
+            "totals" in self.stages,
+        )
+
+    def finish(self, result: PipelineResult, columns):
+        """
+        This function stores the output of columnar.pipeline_columns in the result, as python lists.
+        """
+        ceilings, remanents, in_k_periods, totals, k_sums = columns
+        result.ceilings = ceilings.tolist()
+        result.remanents = remanents.tolist()
+        if in_k_periods is not None:
+            result.in_k_periods = in_k_periods.tolist()
+        if totals is not None:
+            result.total_transaction_amount, result.total_ceiling_amount = totals
+        if k_sums is not None:
+            result.k_sums = k_sums.tolist()
+        if result.k_values is not None:
+            epochs, _ = result.transactions.columns()
+            result.k_values = self.compounding.window_values_columns(self.plan.k_index, epochs, remanents)
+        return result
+
+    def _python_pass(self, result: PipelineResult):
+        """
+        Pure python version of columnar.pipeline_columns, one loop per stage over the sorted buffer, so the stages are
+        timed under the same names with or without numpy. The Q segments, P steps and merged K periods are sorted like
+        the buffer, so each is swept once.
+        """
+        stages = self.stages
+        epochs = result.transactions.epochs
+        amounts = result.transactions.amounts
+
+        with stage("ceiling"):
+            ceilings = [math.ceil(amount / 100) * 100 for amount in amounts]
+            remanents = [ceiling - amount for ceiling, amount in zip(ceilings, amounts)]
+        if "q_rule" in stages:
+            with stage("q_rule"):
+                bounds, values = self.plan.q_map.bounds, self.plan.q_map.values
+                fixed = None
+                qi = 0
+                for i, epoch in enumerate(epochs):
+                    while qi < len(bounds) and bounds[qi] <= epoch:
+                        fixed = values[qi]
+                        qi += 1
+                    if fixed is not None:
+                        remanents[i] = fixed
+        if "p_rule" in stages:
+            with stage("p_rule"):
+                bounds, values = self.plan.p_steps.bounds, self.plan.p_steps.values
+                extra = 0
+                pi = 0
+                for i, epoch in enumerate(epochs):
+                    while pi < len(bounds) and bounds[pi] <= epoch:
+                        extra = values[pi]
+                        pi += 1
+                    remanents[i] += extra
+        result.ceilings = ceilings
+        result.remanents = remanents
+
+        if "totals" in stages:
+            result.total_transaction_amount = sum(amount for amount in amounts if amount >= 0)
+            result.total_ceiling_amount = sum(ceiling for ceiling, amount in zip(ceilings, amounts) if amount >= 0)
+        with stage("k_aggregation"):
+            if "k_membership" in stages:
+                k_starts, k_ends = self.plan.k_index.merged_epochs
+                in_k_periods = result.in_k_periods
+                ki = 0
+                for epoch in epochs:
+                    while ki < len(k_ends) and k_ends[ki] < epoch:
+                        ki += 1
+                    in_k_periods.append(ki < len(k_starts) and k_starts[ki] <= epoch)
+            if result.k_sums is not None:
+                # running sum of the remanents, for the K window sums
+                prefix = [0, *accumulate(remanents)]
+                for i, (start, end) in enumerate(self.plan.k_index.window_epochs):
+                    left = bisect_left(epochs, start)
+                    right = max(bisect_right(epochs, end), left)
+                    result.k_sums[i] = round(prefix[right] - prefix[left], columnar.AMOUNT_DECIMALS)
+        if result.k_values is not None:
+            result.k_values = self.compounding.window_values(self.plan.k_index, epochs, remanents)
+        return result
+
+
+def filter_rows(transactions_sorted, plan: RulePlan):
+    """
+    This function applies the ceiling, Q and P rules to transactions sorted by date and flags K period membership.
+    It returns plain (date, amount, ceiling, remanent, inKPeriod) tuples, dropping the transactions left with a zero remanent.
+    """
+    stages = [name for name in FILTER_STAGES if name != "validate"]
+    return TransactionPipeline(stages, plan).run(transactions_sorted).filter_rows()
+
+
+def filtered_transaction_models(rows):
+    """
+    This function turns filter_rows tuples into FilteredTransactionResponse models.
+    """
+    return [
+        FilteredTransactionResponse(date=date, amount=amount, ceiling=ceiling, remanent=remanent, inKPeriod=in_k_period)
+        for date, amount, ceiling, remanent, in_k_period in rows
+    ]
+
+
+NPS_RATE = 0.0711
+INDEX_RATE = 0.1449
+
+
+def mode_rate(mode: str) -> float:
+    return NPS_RATE if mode == "nps" else INDEX_RATE
+
+
+# bytes of the factor tables kept across requests, per kind of table
+FACTOR_TABLE_CACHE_BYTES = 64 * 1024 * 1024
+# a python float in a tuple: the object and the pointer to it
+PYTHON_FLOAT_BYTES = 32
+SECONDS_PER_DAY = 86400
+DAYS_PER_YEAR = 365.25
+# day factor tables are sized in blocks of days, so requests with close horizons share one table
+DAY_TABLE_BLOCK = 4096
+# longest day factor table (about 180 years, 512 KB); older transactions have their factor computed directly
+DAY_TABLE_MAX_DAYS = 16 * DAY_TABLE_BLOCK
+
+
+class FactorCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    entries: int
+    bytes: int
+
 
+def _table_nbytes(table) -> int:
+    if hasattr(table, "nbytes"):
+        return table.nbytes
+    # a tuple of python floats, or of tables
+    return sum(_table_nbytes(item) if isinstance(item, tuple) or hasattr(item, "nbytes") else PYTHON_FLOAT_BYTES for item in table)
+
+
+class FactorTableCache:
+    """
+    LRU cache of a factor table function, bounded by the bytes of the tables like the ResultCache rather than by
+    their number: the keys (rates, inflations, horizons) come from the requests, so a count cap alone lets a few
+    large tables pin a lot of memory. A table larger than max_bytes is computed and returned, but not kept.
+    Same cache_info / cache_clear interface as functools.lru_cache.
+    """
+
+    def __init__(self, func, max_bytes: int):
+        update_wrapper(self, func)
+        self.func = func
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, *key):
+        with self._lock:
+            entry = self._tables.get(key)
+            if entry is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        table = self.func(*key)
+        size = _table_nbytes(table)
+        if size <= self.max_bytes:
+            with self._lock:
+                if key not in self._tables:
+                    self._tables[key] = (table, size)
+                    self.bytes += size
+                    while self.bytes > self.max_bytes:
+                        self.bytes -= self._tables.popitem(last=False)[1][1]
+        return table
+
+    def cache_info(self) -> FactorCacheInfo:
+        with self._lock:
+            return FactorCacheInfo(self.hits, self.misses, len(self._tables), self.bytes)
+
+    def cache_clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.hits = self.misses = self.bytes = 0
+
+
+def factor_table_cache(func):
+    """
+    Decorator caching a factor table function in a FactorTableCache of FACTOR_TABLE_CACHE_BYTES.
+    """
+    return FactorTableCache(func, FACTOR_TABLE_CACHE_BYTES)
+
+
+def daily_base(rate: float, inflation: float) -> float:
+    return (1 + rate) / (1 + inflation / 100)
+
+
+@factor_table_cache
+def daily_factor_table(rate: float, inflation: float, days: int):
+    """
+    This function returns the inflation adjusted growth factor ((1 + rate) / (1 + inflation / 100)) ** (n / 365.25)
+    of a contribution made n = 0 ... days - 1 days before retirement. Tables are cached, read only, across requests.
+    """
+    base = daily_base(rate, inflation)
+    if columnar.HAS_NUMPY:
+        table = base ** (columnar.np.arange(days, dtype=columnar.np.float64) / DAYS_PER_YEAR)
+        table.flags.writeable = False
+        return table
+    return tuple(base ** (n / DAYS_PER_YEAR) for n in range(days))
+
+
+def retirement_date(as_of: datetime, years: int) -> datetime:
+    try:
+        return as_of.replace(year=as_of.year + years)
+    except ValueError:
+        # 29 February
+        return as_of.replace(year=as_of.year + years, day=28)
+
+
+class DailyCompounding:
+    """
+    Compounding of every remanent from its own transaction date to retirement, instead of the same number of years
+    for a whole K period. The factor of a transaction is looked up in a day indexed daily_factor_table, and every K
+    window value is the difference of two prefix sums of remanent x factor, so a window still costs O(log n).
+    Transactions dated on or after retirement keep their amount. Tables stop at DAY_TABLE_MAX_DAYS, so an early
+    transaction or a far asOf does not size one; the factors past the table are computed directly.
+    """
+
+    def __init__(self, retirement_epoch: int, rate: float, inflation: float):
+        self.retirement_day = retirement_epoch // SECONDS_PER_DAY
+        self.rate = rate
+        self.inflation = inflation
+        self.base = daily_base(rate, inflation)
+
+    def _table(self, first_epoch: int):
+        days = min(max(self.retirement_day - first_epoch // SECONDS_PER_DAY + 1, 1), DAY_TABLE_MAX_DAYS)
+        return daily_factor_table(self.rate, self.inflation, -(-days // DAY_TABLE_BLOCK) * DAY_TABLE_BLOCK)
+
+    def window_values(self, k_index: KPeriodIndex, epochs, remanents):
+        """
+        The compounded K window values for sorted epoch and remanent lists.
+        """
+        if not epochs:
+            return [0] * len(k_index.k_periods)
+        table = self._table(epochs[0])
+        retirement_day = self.retirement_day
+        weighted = []
+        for epoch, remanent in zip(epochs, remanents):
+            days = max(retirement_day - epoch // SECONDS_PER_DAY, 0)
+            weighted.append(remanent * (table[days] if days < len(table) else self.base ** (days / DAYS_PER_YEAR)))
+        prefix = [0, *accumulate(weighted)]
+        values = []
+        for start, end in k_index.window_epochs:
+            left = bisect_left(epochs, start)
+            right = max(bisect_right(epochs, end), left)
+            values.append(prefix[right] - prefix[left])
+        return values
+
+    def window_values_columns(self, k_index: KPeriodIndex, epochs, remanents):
+        """
+        Vectorized window_values for sorted epoch and remanent arrays.
+        """
+        np = columnar.np
+        if len(epochs) == 0:
+            return [0] * len(k_index.k_periods)
+        table = self._table(int(epochs[0]))
+        days = np.maximum(self.retirement_day - epochs // SECONDS_PER_DAY, 0)
+        factors = table[np.minimum(days, len(table) - 1)]
+        far = days >= len(table)
+        if far.any():
+            factors[far] = self.base ** (days[far] / DAYS_PER_YEAR)
+        return columnar.k_window_sums(epochs, remanents * factors, k_index.window_columns).tolist()
+
+
+def transaction_compounding(payload, k_periods, mode: str):
+    """
+    This function returns the DailyCompounding of a returns payload asking for compounding per transaction date,
+    or None. Retirement is 60 - age years after asOf, which defaults to the end of the last K period.
+    """
+    if getattr(payload, "compounding", "period") != "transaction" or not k_periods or 60 - payload.age <= 0:
+        return None
+    as_of = payload.asOf if payload.asOf is not None else max(k.end for k in k_periods)
+    retirement = retirement_date(as_of, 60 - payload.age)
+    return DailyCompounding(to_epoch(retirement), mode_rate(mode), payload.inflation)
+
+
+def projection_pipeline(payload, plan: RulePlan = None, use_numpy: bool = None, mode: str = None) -> TransactionPipeline:
+    """
+    This function returns the pipeline computing the totals and the K period investments of a returns payload.
+    Every transaction counts, negative and duplicate ones included, so it has no validate stage.
+    plan defaults to the periods inlined in the payload. With the mode of a returns:nps / returns:index payload
+    asking for it, the pipeline also compounds every transaction from its own date (see DailyCompounding).
+    """
+    pipeline = TransactionPipeline(PROJECTION_STAGES, plan if plan is not None else rule_plan(payload), use_numpy)
+    if mode is not None:
+        pipeline.compounding = transaction_compounding(payload, pipeline.plan.k, mode)
+    return pipeline
+
+
+def investment_projection_engine(payload: dict, mode: str, plan: RulePlan = None):
+    """
+    cal the projection of investments based on the remanents and the rules provided in the payload.
+    calculates the future value of investments at the end of K periods, adjusted for inflation, and computes the profit and tax benefits (if applicable).
+    """
+    years = 60 - payload.age
     if years <= 0:
         return []
 
-    transactions = sorted(payload.transaction, key=lambda x: x.date)
+    pipeline = projection_pipeline(payload, plan, mode=mode)
+    result = pipeline.run(payload.transaction)
+    return build_projection_results(
+        pipeline.plan.k, result.k_sums, payload.wage, payload.inflation, years, mode, real_values=result.k_values
+    )
 
-    q_periods = payload.q if hasattr(payload, 'q') else []
-    p_periods = payload.p if hasattr(payload, 'p') else []
-    k_periods = payload.k if hasattr(payload, 'k') else []
 
-    # Step 1: base remanent
-    dates = []
-    remanents = []
+def projection_summary(payload, k_periods, result, mode: str):
+    """
+    This function lays out the returns:nps / returns:index response of a payload from its projection pipeline result.
+    """
+    years = 60 - payload.age
+    savings = []
+    if years > 0:
+        savings = build_projection_results(
+            k_periods, result.k_sums, payload.wage, payload.inflation, years, mode, real_values=result.k_values
+        )
+    return {"totalTransactionAmount": result.total_transaction_amount, "totalCeilingAmount": result.total_ceiling_amount, "savingsByDates": savings}
 
-    for txn in transactions:
-        dates.append(txn.date)
-        ceil_val = math.ceil(txn.amount / 100) * 100
-        remanents.append(ceil_val - txn.amount)
 
-    # Step 2: Q rule
-    remanents = apply_q_rule(transactions, remanents, q_periods)
+def k_period_investments(payload, plan: RulePlan = None):
+    """
+    This function returns the invested amount (sum of remanents after the Q and P rules) of every K period of the payload.
+    """
+    return projection_pipeline(payload, plan).run(payload.transaction).k_sums
 
-    # Step 3: P rule
-    remanents = apply_p_rule(transactions, remanents, p_periods)
 
-    # Step 4: K grouping + projection
-    if mode == "nps":
-        rate = 0.0711
-    else:
-        rate = 0.1449
+def build_projection_results(k_periods, invested_per_k, wage, inflation, years, mode: str, rate=None, real_values=None):
+    """
+    This function projects the invested amount of every K period to retirement, adjusted for inflation,
+    and computes the profit and the tax benefit (NPS only). The growth and inflation factors only depend on the
+    scenario, so they are computed once rather than per K period. rate defaults to the rate of the mode.
+    real_values, when given, are the inflation adjusted values at retirement already compounded per transaction
+    date (PipelineResult.k_values), used instead of compounding every K period for years.
+    """
+    if rate is None:
+        rate = mode_rate(mode)
+    growth = (1 + rate) ** years
+    discount = (1 + inflation / 100) ** years
     results = []
 
-    for k in k_periods:
-        l = bisect_left(dates, k.start)
-        r = bisect_right(dates, k.end)
-        invested = sum(remanents[l:r])
-
-        future_value = invested * ((1 + rate) ** years)
-        real_value = future_value / ((1 + inflation / 100) ** years)
+    # Tax benefit only for NPS; the tax on the wage itself is the same for every K period
+    if mode == "nps":
+        tax_before = calculate_tax(wage)
+        tax_after = calculate_tax_many([wage - min(invested, wage * 0.10, 200000) for invested in invested_per_k])
+
+    for i, (k, invested) in enumerate(zip(k_periods, invested_per_k)):
+        if real_values is not None:
+            real_value = real_values[i]
+        else:
+            future_value = invested * growth
+            real_value = future_value / discount
         profit = real_value - invested
 
-        # Tax benefit only for NPS
         tax_benefit = 0
         if mode == "nps":
-            eligible = min(invested, wage * 0.10, 200000)
-            tax_before = calculate_tax(wage)
-            tax_after = calculate_tax(wage - eligible)
-            tax_benefit = tax_before - tax_after
+            tax_benefit = tax_before - tax_after[i]
 
         results.append(ReturnNpsIndexResponse(
             start=k.start,
@@ -153,4 +850,109 @@ def investment_projection_engine(payload: dict, mode: str):
             amount=invested
         ))
 
-    return results
\ No newline at end of file
+    return results
+
+
+def investment_projection_batch(payload, invested_per_k, k_periods=None):
+    """
+    This function evaluates every scenario of a ReturnBatchRequest against the same K period investments,
+    so the sorting, Q/P rules and K window sums are only done once for all scenarios.
+    k_periods defaults to the K periods of the payload.
+    """
+    if k_periods is None:
+        k_periods = payload.k
+    projections = []
+    for scenario in payload.scenarios:
+        rate = mode_rate(scenario.mode) if scenario.rate is None else scenario.rate
+        years = 60 - scenario.age
+        savings = []
+        if years > 0:
+            savings = build_projection_results(
+                k_periods, invested_per_k, payload.wage, scenario.inflation, years, scenario.mode, rate
+            )
+        projections.append(ReturnScenarioResponse(
+            mode=scenario.mode,
+            age=scenario.age,
+            inflation=scenario.inflation,
+            rate=rate,
+            savingsByDates=savings
+        ))
+    return projections
+
+
+# trajectory steps per year
+TRAJECTORY_STEPS = {"year": 1, "month": 12}
+
+
+@factor_table_cache
+def trajectory_factor_table(rate: float, inflation: float, years: int, step: str):
+    """
+    This function returns the growth and inflation factors of every step of a trajectory (see
+    columnar.trajectory_factors). A month is a twelfth of a year of compounding, so the last step is the factor of
+    build_projection_results. Tables are cached, read only, since every request of the same scenario shares them.
+    """
+    steps_per_year = TRAJECTORY_STEPS[step]
+    if columnar.HAS_NUMPY:
+        growth, discount = columnar.trajectory_factors(rate, inflation, years, steps_per_year)
+        growth.flags.writeable = False
+        discount.flags.writeable = False
+        return growth, discount
+    times = [t / steps_per_year for t in range(1, years * steps_per_year + 1)]
+    return tuple((1 + rate) ** t for t in times), tuple((1 + inflation / 100) ** t for t in times)
+
+
+def investment_trajectory(invested_per_k, rate: float, inflation: float, years: int, step: str):
+    """
+    This function returns the nominal and inflation adjusted value of every K period investment at every step up to
+    retirement, as (K, T) row lists.
+    """
+    growth, discount = trajectory_factor_table(rate, inflation, years, step)
+    if columnar.HAS_NUMPY:
+        nominal, real = columnar.trajectory_matrix(invested_per_k, growth, discount)
+        return nominal.tolist(), real.tolist()
+    nominal = [[invested * g for g in growth] for invested in invested_per_k]
+    real = [[round(value / d, 2) for value, d in zip(row, discount)] for row in nominal]
+    return [[round(value, 2) for value in row] for row in nominal], real
+
+
+def investment_projection_sweep(payload, invested_per_k):
+    """
+    This function evaluates the grid modes x ages x inflations x wages of a ReturnSweepRequest against the same
+    K period investments. It returns the scenarios as (mode, age, inflation, wage) tuples and the profit and tax
+    benefit matrices with one row per scenario (None when the age leaves no years to retirement).
+    """
+    wages = payload.wages if payload.wages is not None else [payload.wage]
+    scenarios = list(product(payload.modes, payload.ages, payload.inflations, wages))
+    active = [i for i, scenario in enumerate(scenarios) if 60 - scenario[1] > 0]
+    profit_rows = [None] * len(scenarios)
+    tax_rows = [None] * len(scenarios)
+
+    if columnar.HAS_NUMPY and active:
+        profit, tax_benefit = columnar.sweep_matrix(
+            invested_per_k,
+            [scenarios[i][0] == "nps" for i in active],
+            [mode_rate(scenarios[i][0]) for i in active],
+            [60 - scenarios[i][1] for i in active],
+            [scenarios[i][2] for i in active],
+            [scenarios[i][3] for i in active],
+            TAX_SLABS,
+        )
+        for row, i in enumerate(active):
+            profit_rows[i] = profit[row].tolist()
+            tax_rows[i] = tax_benefit[row].tolist()
+        return scenarios, profit_rows, tax_rows
+
+    for i in active:
+        mode, age, inflation, wage = scenarios[i]
+        years = 60 - age
+        factor = (1 + mode_rate(mode)) ** years / (1 + inflation / 100) ** years
+        profit_rows[i] = [round(invested * factor - invested, 2) for invested in invested_per_k]
+        if mode == "nps":
+            tax_before = calculate_tax(wage)
+            tax_rows[i] = [
+                round(tax_before - calculate_tax(wage - min(invested, wage * 0.10, 200000)), 2)
+                for invested in invested_per_k
+            ]
+        else:
+            tax_rows[i] = [0.0] * len(invested_per_k)
+    return scenarios, profit_rows, tax_rows
@@ -0,0 +1,46 @@
+"""
+Micro benchmark of the per row date handling: strptime/strftime against the fast
+parser (cold and cached) and the isoformat based formatter.
+
+    python -m benchmarks.bench_dates
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from app.dates import DATE_FORMAT, format_datetime, parse_datetime
+
+ROWS = 100000
+
+
+def make_values(rows, unique):
+    rng = random.Random(0)
+    base = datetime(2026, 1, 1)
+    pool = [(base + timedelta(seconds=rng.randint(0, 365 * 86400))).strftime(DATE_FORMAT) for _ in range(unique)]
+    return [rng.choice(pool) for _ in range(rows)]
+
+
+def per_row_us(func, values):
+    seconds = min(timeit.repeat(lambda: [func(v) for v in values], number=1, repeat=3))
+    return seconds / len(values) * 1e6
+
+
+def main():
+    unique_values = make_values(ROWS, ROWS)
+    repeated_values = make_values(ROWS, 1000)
+    dates = [datetime.strptime(v, DATE_FORMAT) for v in unique_values]
+
+    def fast_uncached(value):
+        return parse_datetime.__wrapped__(value)
+
+    print(f"{'case':<40}{'us/row':>10}")
+    print(f"{'strptime':<40}{per_row_us(lambda v: datetime.strptime(v, DATE_FORMAT), unique_values):>10.3f}")
+    print(f"{'fast parse (no cache)':<40}{per_row_us(fast_uncached, unique_values):>10.3f}")
+    parse_datetime.cache_clear()
+    print(f"{'fast parse + cache (1k unique values)':<40}{per_row_us(parse_datetime, repeated_values):>10.3f}")
+    print(f"{'strftime':<40}{per_row_us(lambda d: d.strftime(DATE_FORMAT), dates):>10.3f}")
+    print(f"{'format_datetime':<40}{per_row_us(format_datetime, dates):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Synthetic data generators for the benchmarks. Transactions are generated straight into the columns of a
+TransactionBatch and periods with model_construct, so generating millions of rows does not pay for Pydantic
+validation or a model per row.
+"""
+import random
+from array import array
+from datetime import datetime, timedelta
+
+from app.batch import TransactionBatch
+from app.columnar import to_epoch
+from app.dates import format_datetime
+from app.models import (ReturnNpsIndexRequest, TransactionKPeriodRequest, TransactionPPeriodRequest,
+                        TransactionQPeriodRequest)
+
+BASE = datetime(2026, 1, 1)
+SPAN_SECONDS = 365 * 86400
+
+
+def make_transactions(count, seed=0, duplicate_ratio=0.0):
+    """
+    count transactions spread over one year, as a TransactionBatch (16 bytes per row, so 10M rows take 160 MB);
+    duplicate_ratio of them repeat the date and amount of an earlier one.
+    """
+    rng = random.Random(seed)
+    base = to_epoch(BASE)
+    epochs, amounts = array("q"), array("d")
+    for i in range(count):
+        if epochs and rng.random() < duplicate_ratio:
+            j = rng.randrange(len(epochs))
+            epochs.append(epochs[j])
+            amounts.append(amounts[j])
+            continue
+        epochs.append(base + rng.randrange(SPAN_SECONDS))
+        amounts.append(round(rng.uniform(1, 5000), 2))
+    return TransactionBatch(epochs, amounts)
+
+
+def make_periods(count, kind, seed=0, overlap=1.0):
+    """
+    count periods of the given kind ("q", "p" or "k"). overlap is the average number of periods covering
+    any instant, so 0.1 gives short mostly disjoint periods and 10 heavily overlapping ones.
+    """
+    rng = random.Random(f"{kind}-{seed}")
+    mean_length = SPAN_SECONDS * max(overlap, 0.001) / max(count, 1)
+    periods = []
+    for _ in range(count):
+        start = BASE + timedelta(seconds=rng.randrange(SPAN_SECONDS))
+        end = start + timedelta(seconds=int(rng.expovariate(1 / mean_length)))
+        if kind == "q":
+            periods.append(TransactionQPeriodRequest.model_construct(start=start, end=end, fixed=rng.choice([0, 10, 50])))
+        elif kind == "p":
+            periods.append(TransactionPPeriodRequest.model_construct(start=start, end=end, extra=rng.choice([5, 25, 100])))
+        else:
+            periods.append(TransactionKPeriodRequest.model_construct(start=start, end=end))
+    return periods
+
+
+def make_request(transactions, q=10, p=10, k=10, overlap=1.0, duplicate_ratio=0.0, seed=0):
+    """
+    A ReturnNpsIndexRequest (which is also a valid TransactionFilterRequest) with synthetic data.
+    """
+    return ReturnNpsIndexRequest.model_construct(
+        transaction=make_transactions(transactions, seed, duplicate_ratio),
+        q=make_periods(q, "q", seed, overlap),
+        p=make_periods(p, "p", seed, overlap),
+        k=make_periods(k, "k", seed, overlap),
+        wage=1200000,
+        age=30,
+        inflation=5.5,
+    )
+
+
+def to_json_payload(request):
+    """
+    The JSON body of a synthetic request, for the end to end benchmarks.
+    """
+    def period(item, extra=None):
+        data = {"start": format_datetime(item.start), "end": format_datetime(item.end)}
+        if extra:
+            data[extra] = getattr(item, extra)
+        return data
+
+    return {
+        "transaction": [{"date": format_datetime(t.date), "amount": t.amount} for t in request.transaction],
+        "q": [period(q, "fixed") for q in request.q],
+        "p": [period(p, "extra") for p in request.p],
+        "k": [period(k) for k in request.k],
+        "wage": request.wage,
+        "age": request.age,
+        "inflation": request.inflation,
+    }
@@ -0,0 +1,266 @@
+"""
+Benchmark suite for the engine functions and the HTTP endpoints.
+
+    python -m benchmarks.run --sizes 1000 10000 100000 --output bench.json
+    python -m benchmarks.run --sizes 1000 10000 100000 --baseline bench.json
+
+Every case is timed --repeat times (min and median are reported, throughput uses the median) and
+run once more under tracemalloc for the peak memory. With --baseline the medians are compared with a
+previous --output file and the exit code is 1 when a case got slower than --tolerance allows.
+The result cache is cleared before every timed endpoint call, so the endpoint cases measure the engine;
+the "(cache hit)" cases measure a response served from the cache.
+The memory held by a validated transaction list, as Pydantic models and as a TransactionBatch, is
+reported per million rows.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+from pydantic import TypeAdapter
+
+from app import columnar
+from app.batch import TransactionBatch
+from app.cache import result_cache
+from app.dates import parse_datetime
+from app.main import app
+from app.models import TransactionParseRequest
+from app.uploads import encode_columnar
+from app.utils import (FILTER_STAGES, TransactionPipeline, apply_p_rule, apply_q_rule, calculate_tax_many,
+                       compute_remanents, filter_rows, projection_pipeline, rule_plan, split_valid_invalid)
+from benchmarks.data import make_request, to_json_payload
+
+API = "/api/blackrock/challenge/v1"
+
+
+def projection(request, use_numpy, plan=None):
+    return projection_pipeline(request, plan, use_numpy).run(request.transaction)
+
+
+def engine_cases(request):
+    """
+    (name, setup) pairs; setup returns the function to time with its fresh arguments.
+    """
+    transactions = sorted(request.transaction, key=lambda t: t.date)
+    base_remanents = [(-(-t.amount // 100)) * 100 - t.amount for t in transactions]
+    wages = [t.amount * 400 for t in transactions]
+    plan = rule_plan(request)
+
+    cases = [
+        ("split_valid_invalid", lambda: (split_valid_invalid, (request.transaction,))),
+        ("apply_q_rule", lambda: (apply_q_rule, (transactions, list(base_remanents), request.q))),
+        ("apply_p_rule", lambda: (apply_p_rule, (transactions, list(base_remanents), request.p))),
+        ("compute_remanents", lambda: (compute_remanents, (transactions, request.q, request.p))),
+        ("rule_plan", lambda: (rule_plan, (request,))),
+        ("filter_rows", lambda: (lambda: filter_rows(transactions, rule_plan(request)), ())),
+        ("filter_rows (plan)", lambda: (filter_rows, (transactions, plan))),
+        ("calculate_tax_many", lambda: (calculate_tax_many, (wages,))),
+        ("filter_pipeline", lambda: (TransactionPipeline(FILTER_STAGES, plan).run, (request.transaction,))),
+        ("projection_python", lambda: (projection, (request, False))),
+    ]
+    if columnar.HAS_NUMPY:
+        cases.append(("projection_columnar", lambda: (projection, (request, True))))
+        cases.append(("projection_columnar (plan)", lambda: (projection, (request, True, plan))))
+    return cases
+
+
+def cold(case):
+    """
+    Clears the result cache before the call of an endpoint case, so it computes the response.
+    """
+    def setup():
+        if result_cache is not None:
+            result_cache.clear()
+        return case()
+    return setup
+
+
+def warm(case):
+    """
+    Makes the call of an endpoint case once before it is timed, so it is served from the result cache.
+    """
+    def setup():
+        func, args, kwargs = case()
+        func(*args, **kwargs)
+        return func, args, kwargs
+    return setup
+
+
+def endpoint_cases(request):
+    client = TestClient(app)
+    payload = to_json_payload(request)
+    filter_payload = {key: value for key, value in payload.items() if key not in ("age", "inflation")}
+    periods = json.dumps({key: value for key, value in filter_payload.items() if key != "transaction"})
+    csv_file = "".join(f"{t['date']},{t['amount']}\n" for t in payload["transaction"])
+    columnar_file = encode_columnar(request.transaction)
+    # the same transactions as 100 portfolios of one bulk request
+    share = -(-len(payload["transaction"]) // 100)
+    bulk_body = "\n".join(
+        json.dumps({**payload, "transaction": payload["transaction"][start:start + share], "id": start})
+        for start in range(0, len(payload["transaction"]), share)
+    )
+    nps = lambda: (client.post, (f"{API}/returns:nps", ), {"json": payload})
+    cases = [
+        ("POST :parse", lambda: (client.post, (f"{API}/transactions:parse", ), {"json": payload["transaction"]})),
+        ("POST :parse?fast", lambda: (client.post, (f"{API}/transactions:parse?fast=true", ), {"json": payload["transaction"]})),
+        ("POST :filter", lambda: (client.post, (f"{API}/transactions:filter", ), {"json": filter_payload})),
+        ("POST :filterUpload (csv)", lambda: (client.post, (f"{API}/transactions:filterUpload", ),
+                                              {"files": {"file": ("t.csv", csv_file)}, "data": {"periods": periods}})),
+        ("POST :filterUpload (columnar)", lambda: (client.post, (f"{API}/transactions:filterUpload", ),
+                                                   {"files": {"file": ("t.blkt", columnar_file)}, "data": {"periods": periods}})),
+        ("POST returns:nps", nps),
+        ("POST returns:bulk (100 items)", lambda: (client.post, (f"{API}/returns:bulk", ), {"content": bulk_body})),
+    ]
+    cases = [(name, cold(case)) for name, case in cases]
+    if result_cache is not None:
+        cases.append(("POST returns:nps (cache hit)", warm(nps)))
+    return cases
+
+
+def measure(setup, repeat):
+    timings = []
+    for _ in range(repeat):
+        func, args, *rest = setup()
+        kwargs = rest[0] if rest else {}
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    func, args, *rest = setup()
+    kwargs = rest[0] if rest else {}
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timings, peak
+
+
+def retained_bytes(build):
+    """
+    Bytes still allocated once build() returned, while its result is alive. The date parse cache is
+    emptied first, so only what the result itself references is counted.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    parse_datetime.cache_clear()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del value
+    return retained
+
+
+def memory_report(rows):
+    """
+    Memory held per million rows by a validated transaction list: per-row Pydantic models against a TransactionBatch.
+    """
+    payload = to_json_payload(make_request(rows, q=0, p=0, k=0))["transaction"]
+    scale = 1_000_000 / rows
+    models_adapter = TypeAdapter(list[TransactionParseRequest])
+    batch_adapter = TypeAdapter(TransactionBatch)
+    models = retained_bytes(lambda: models_adapter.validate_python(payload)) * scale
+    batch = retained_bytes(lambda: batch_adapter.validate_python(payload)) * scale
+    print(f"\n{'memory per 1M rows':<32}{'models':>10}{models / (1024 * 1024):>12.1f} MB"
+          f"{'batch':>10}{batch / (1024 * 1024):>10.1f} MB{'saved':>8}{1 - batch / models:>7.0%}\n", flush=True)
+    return {"rows": rows, "models_mb_per_million": models / (1024 * 1024), "batch_mb_per_million": batch / (1024 * 1024)}
+
+
+def run(sizes, repeat, q, p, k, overlap, duplicate_ratio, endpoint_max_rows, only=None):
+    results = []
+    for size in sizes:
+        request = make_request(size, q=q, p=p, k=k, overlap=overlap, duplicate_ratio=duplicate_ratio)
+        cases = engine_cases(request)
+        if size <= endpoint_max_rows:
+            cases += endpoint_cases(request)
+        for name, setup in cases:
+            if only and not any(pattern in name for pattern in only):
+                continue
+            timings, peak = measure(setup, repeat)
+            median = statistics.median(timings)
+            result = {
+                "case": name,
+                "rows": size,
+                "min_s": min(timings),
+                "median_s": median,
+                "rows_per_s": size / median if median else None,
+                "peak_mb": peak / (1024 * 1024),
+            }
+            results.append(result)
+            print(f"{name:<32}{size:>10}{median * 1000:>12.2f} ms{result['rows_per_s'] or 0:>14,.0f} rows/s"
+                  f"{result['peak_mb']:>10.1f} MB", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the median ratio of every case also present in the baseline; returns the regressed cases.
+    """
+    previous = {(r["case"], r["rows"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\n{'case':<32}{'rows':>10}{'baseline ms':>14}{'now ms':>10}{'ratio':>8}")
+    for result in results:
+        old = previous.get((result["case"], result["rows"]))
+        if old is None:
+            continue
+        ratio = result["median_s"] / old["median_s"] if old["median_s"] else 1.0
+        flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+        print(f"{result['case']:<32}{result['rows']:>10}{old['median_s'] * 1000:>14.2f}"
+              f"{result['median_s'] * 1000:>10.2f}{ratio:>8.2f}{flag}")
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="transaction counts, from 1k up to 10M")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--q", type=int, default=100, help="number of q periods")
+    parser.add_argument("--p", type=int, default=100, help="number of p periods")
+    parser.add_argument("--k", type=int, default=100, help="number of k periods")
+    parser.add_argument("--overlap", type=float, default=1.0, help="average number of periods covering an instant")
+    parser.add_argument("--duplicates", type=float, default=0.01, help="ratio of duplicate transactions")
+    parser.add_argument("--endpoint-max-rows", type=int, default=100000,
+                        help="largest size also benchmarked end to end through the HTTP endpoints")
+    parser.add_argument("--only", nargs="*", help="only run the cases whose name contains one of these")
+    parser.add_argument("--memory-rows", type=int, default=100000,
+                        help="rows validated for the per million rows memory report, 0 to skip it")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    memory = memory_report(args.memory_rows) if args.memory_rows else None
+    results = run(args.sizes, args.repeat, args.q, args.p, args.k, args.overlap, args.duplicates,
+                  args.endpoint_max_rows, args.only)
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": columnar.np.__version__ if columnar.HAS_NUMPY else None,
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        },
+        "memory": memory,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import pytest
+
+from app.cache import result_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_result_cache():
+    # identical payloads across tests would otherwise be answered from the result cache
+    if result_cache is not None:
+        result_cache.clear()
+    yield
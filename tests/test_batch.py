@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import TypeAdapter, ValidationError
+
+from app.batch import TransactionBatch, TransactionRow
+from app.main import app
+from app.models import TransactionParseRequest
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+adapter = TypeAdapter(TransactionBatch)
+
+
+def test_batch_validates_json_rows_into_columns():
+    batch = adapter.validate_json(
+        '[{"date": "2023-10-12 20:15:30", "amount": 250}, {"date": "2023-02-28 15:49:20", "amount": "375.5"}]'
+    )
+
+    assert len(batch) == 2
+    assert batch.nbytes == 32
+    assert list(batch) == [
+        TransactionRow(datetime(2023, 10, 12, 20, 15, 30), 250.0),
+        TransactionRow(datetime(2023, 2, 28, 15, 49, 20), 375.5),
+    ]
+    assert adapter.dump_python(batch) == [
+        {"date": "2023-10-12 20:15:30", "amount": 250.0},
+        {"date": "2023-02-28 15:49:20", "amount": 375.5},
+    ]
+
+
+def test_batch_errors_point_at_the_row():
+    with pytest.raises(ValidationError) as error:
+        adapter.validate_python([{"date": "2023-10-12 20:15:30", "amount": 1}, {"date": "12/10/2023", "amount": 1}])
+
+    [detail] = error.value.errors()
+    assert detail["loc"] == (1, "date")
+    assert "YYYY-MM-DD HH:mm:ss" in detail["msg"]
+
+
+def test_batch_packs_models_and_sorts_stably():
+    batch = TransactionBatch.validate([
+        TransactionParseRequest(date="2023-03-01 00:00:00", amount=3),
+        TransactionParseRequest(date="2023-01-01 00:00:00", amount=1),
+        TransactionParseRequest(date="2023-03-01 00:00:00", amount=2),
+    ])
+
+    assert [row.amount for row in batch.sorted()] == [1, 3, 2]
+    assert batch.canonical_bytes(sort=True) == batch.sorted().canonical_bytes(sort=True)
+
+
+def test_batch_split_valid_invalid_keeps_arrival_order():
+    batch = TransactionBatch.validate([
+        {"date": "2023-03-01 00:00:00", "amount": 3},
+        {"date": "2023-01-01 00:00:00", "amount": -1},
+        {"date": "2023-03-01 00:00:00", "amount": 3},
+        {"date": "2023-02-01 00:00:00", "amount": 2},
+    ])
+
+    valid, invalid = batch.split_valid_invalid()
+
+    assert [row.amount for row in valid] == [3, 2]
+    assert [t.message for t in invalid] == ["negative amounts are not allowed", "Duplicate transactions"]
+
+
+def test_filter_rejects_bad_rows_with_their_index():
+    response = client.post(f"{API}/transactions:filter", json={
+        "q": [], "p": [], "k": [], "wage": 50000,
+        "transaction": [{"date": "2023-10-12 20:15:30", "amount": 250}, {"date": "2023-10-12", "amount": 250}],
+    })
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "transaction", 1, "date"]
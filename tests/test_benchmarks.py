@@ -0,0 +1,34 @@
+import json
+
+from benchmarks.data import make_periods, make_transactions
+from benchmarks.run import compare, main
+
+
+def test_make_transactions_duplicate_ratio():
+    transactions = make_transactions(2000, seed=1, duplicate_ratio=0.25)
+    unique = {(t.date, t.amount) for t in transactions}
+
+    assert len(transactions) == 2000
+    assert 1300 < len(unique) < 1700
+
+
+def test_make_periods_kinds():
+    assert all(hasattr(q, "fixed") for q in make_periods(5, "q"))
+    assert all(hasattr(p, "extra") for p in make_periods(5, "p"))
+    assert all(k.start <= k.end for k in make_periods(5, "k"))
+
+
+def test_benchmark_run_writes_results_and_compares(tmp_path):
+    output = tmp_path / "bench.json"
+
+    assert main(["--sizes", "200", "--repeat", "1", "--q", "5", "--p", "5", "--k", "5",
+                 "--memory-rows", "2000", "--output", str(output)]) == 0
+
+    report = json.loads(output.read_text())
+    cases = {r["case"] for r in report["results"]}
+    assert {"apply_q_rule", "apply_p_rule", "projection_python", "POST :filter"} <= cases
+    assert report["memory"]["batch_mb_per_million"] < report["memory"]["models_mb_per_million"]
+
+    slower = {"results": [{**r, "median_s": r["median_s"] / 10} for r in report["results"]]}
+    assert compare(report["results"], slower, tolerance=0.2) == report["results"]
+    assert compare(report["results"], report, tolerance=0.2) == []
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import bulk
+from app.executor import compute_pool
+from app.main import app
+from benchmarks.data import make_request, to_json_payload
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+@pytest.fixture
+def portfolios():
+    return [to_json_payload(make_request(120, q=4, p=4, k=3, overlap=2.0, seed=seed)) for seed in range(12)]
+
+
+def bulk_lines(portfolios, mode="nps"):
+    body = "\n".join(json.dumps({**payload, "id": f"customer-{i}"}) for i, payload in enumerate(portfolios))
+    response = client.post(f"{API}/returns:bulk?mode={mode}", content=body)
+    assert response.status_code == 200
+    return {line["line"]: line for line in map(json.loads, response.text.splitlines())}
+
+
+@pytest.mark.parametrize("mode", ["nps", "index"])
+def test_bulk_matches_single_portfolio_endpoint(portfolios, mode):
+    lines = bulk_lines(portfolios, mode)
+
+    assert sorted(lines) == list(range(1, len(portfolios) + 1))
+    for i, payload in enumerate(portfolios):
+        line = lines[i + 1]
+        assert line.pop("id") == f"customer-{i}"
+        assert line.pop("line") == i + 1
+        assert line == client.post(f"{API}/returns:{mode}", json=payload).json()
+
+
+def test_bulk_in_process_pool_matches_thread(portfolios, monkeypatch):
+    expected = bulk_lines(portfolios)
+    monkeypatch.setattr(bulk, "BULK_GROUP_SIZE", 5)
+    monkeypatch.setattr(compute_pool, "workers", 2)
+    try:
+        assert bulk_lines(portfolios) == expected
+    finally:
+        compute_pool.shutdown()
+
+
+def test_bulk_reports_errors_per_portfolio(portfolios):
+    plan_id = client.post(f"{API}/plans", json={name: portfolios[0][name] for name in ("q", "p", "k")}).json()["planId"]
+    with_plan = {**{key: value for key, value in portfolios[0].items() if key not in ("q", "p", "k")}, "planId": plan_id}
+    body = "\n".join([
+        json.dumps({**portfolios[0], "age": "old", "id": 7}),
+        "{not json",
+        json.dumps({**with_plan, "planId": "unknown"}),
+        json.dumps(with_plan),
+    ])
+
+    lines = {line["line"]: line for line in map(json.loads, client.post(f"{API}/returns:bulk", content=body).text.splitlines())}
+
+    assert (lines[1]["status"], lines[1]["id"], lines[1]["error"][0]["loc"]) == (422, 7, ["age"])
+    assert lines[2]["status"] == 422
+    assert lines[3]["status"] == 404
+    assert lines[4]["savingsByDates"] == client.post(f"{API}/returns:nps", json=portfolios[0]).json()["savingsByDates"]
+
+
+def test_bulk_sends_plan_bodies_to_the_process_pool(portfolios, monkeypatch):
+    plan_id = client.post(f"{API}/plans", json={name: portfolios[0][name] for name in ("q", "p", "k")}).json()["planId"]
+    with_plan = {**{key: value for key, value in portfolios[0].items() if key not in ("q", "p", "k")}, "planId": plan_id}
+    lines = [(i + 1, json.dumps(with_plan).encode()) for i in range(4)]
+
+    (group, plans), = bulk.iter_groups(lines, 10)
+    assert isinstance(plans[plan_id], bytes)
+
+    monkeypatch.setattr(bulk, "BULK_GROUP_SIZE", 2)
+    monkeypatch.setattr(compute_pool, "workers", 2)
+    try:
+        output = client.post(f"{API}/returns:bulk", content=b"\n".join(line for _, line in lines)).text
+    finally:
+        compute_pool.shutdown()
+    expected = client.post(f"{API}/returns:nps", json=portfolios[0]).json()["savingsByDates"]
+    assert [json.loads(line)["savingsByDates"] for line in output.splitlines()] == [expected] * 4
+
+
+def test_bulk_groups_rejected_by_a_saturated_pool_answer_429(portfolios, monkeypatch):
+    monkeypatch.setattr(bulk, "BULK_GROUP_SIZE", 5)
+    monkeypatch.setattr(compute_pool, "workers", 2)
+    monkeypatch.setattr(compute_pool, "queue_depth", 0)
+
+    lines = bulk_lines(portfolios)
+
+    assert sorted(lines) == list(range(1, len(portfolios) + 1))
+    for number, line in lines.items():
+        assert (line["status"], line["id"]) == (429, f"customer-{number - 1}")
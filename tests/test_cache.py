@@ -0,0 +1,121 @@
+from fastapi.testclient import TestClient
+
+from app import cache
+from app.cache import ResultCache
+from app.main import app
+
+client = TestClient(app)
+
+
+def returns_payload():
+    return {
+        "q": [], "p": [], "wage": 0, "age": 30, "inflation": 5,
+        "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}],
+        "transaction": [
+            {"date": "2026-02-21 06:04:11", "amount": 150},
+            {"date": "2026-02-23 06:04:11", "amount": 275},
+        ],
+    }
+
+
+def test_result_cache_lru_and_byte_cap():
+    result_cache = ResultCache(max_entries=2, max_bytes=10, ttl_seconds=60)
+    result_cache.put("a", b"1111")
+    result_cache.put("b", b"2222")
+    assert result_cache.get("a") == b"1111"
+
+    result_cache.put("c", b"3333")
+    assert result_cache.get("b") is None
+    assert result_cache.get("a") == b"1111"
+
+    result_cache.put("d", b"4444444")
+    assert result_cache.stats()["bytes"] <= 10
+    assert result_cache.stats()["evictions"] >= 2
+
+
+def test_result_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    result_cache = ResultCache(max_entries=10, max_bytes=100, ttl_seconds=5)
+    result_cache.put("a", b"1")
+
+    now[0] += 4
+    assert result_cache.get("a") == b"1"
+    now[0] += 2
+    assert result_cache.get("a") is None
+    assert result_cache.stats()["misses"] == 1
+
+
+def test_result_cache_sqlite_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    ResultCache(max_entries=10, max_bytes=100, ttl_seconds=60, path=path).put("a", b"payload")
+
+    restarted = ResultCache(max_entries=10, max_bytes=100, ttl_seconds=60, path=path)
+    assert restarted.get("a") == b"payload"
+    assert restarted.stats()["hits"] == 1
+
+
+def test_returns_served_from_cache():
+    first = client.post("/api/blackrock/challenge/v1/returns:nps", json=returns_payload())
+    payload = returns_payload()
+    payload["transaction"].reverse()
+    second = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload)
+
+    assert first.headers["X-Cache"] == "miss"
+    assert second.headers["X-Cache"] == "hit"
+    assert second.content == first.content
+
+    other_mode = client.post("/api/blackrock/challenge/v1/returns:index", json=returns_payload())
+    assert other_mode.headers["X-Cache"] == "miss"
+
+
+def test_filter_cache_key_keeps_transaction_order():
+    a = {"date": "2026-02-21 06:04:11", "amount": 150}
+    b = {"date": "2026-02-21 06:04:11", "amount": 250}
+    first = client.post("/api/blackrock/challenge/v1/transactions:filter", json={**returns_payload(), "transaction": [a, b, a]})
+    payload = {**returns_payload(), "transaction": [b, a, a]}
+    second = client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload)
+
+    assert second.headers["X-Cache"] == "miss"
+    assert client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload).headers["X-Cache"] == "hit"
+    # the later copy is the duplicate, and valid transactions on the same date keep their arrival order
+    assert len(first.json()["invalid"]) == len(second.json()["invalid"]) == 1
+    assert [t["amount"] for t in first.json()["valid"]] == [150, 250]
+    assert [t["amount"] for t in second.json()["valid"]] == [250, 150]
+
+
+def test_filter_cache_keeps_fast_and_model_serializations_apart():
+    payload = {**returns_payload(), "wage": 1}
+    model = client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload)
+    fast = client.post("/api/blackrock/challenge/v1/transactions:filter?fast=true", json=payload)
+
+    assert model.headers["X-Cache"] == fast.headers["X-Cache"] == "miss"
+    assert fast.content == model.content
+
+
+def test_sqlite_cache_runs_off_the_event_loop(tmp_path, monkeypatch):
+    calls = []
+    run_in_threadpool = cache.run_in_threadpool
+
+    async def recording_run_in_threadpool(func, *args):
+        calls.append(getattr(func, "__name__", None))
+        return await run_in_threadpool(func, *args)
+
+    path = str(tmp_path / "cache.sqlite")
+    monkeypatch.setattr(cache, "result_cache", ResultCache(max_entries=10, max_bytes=10000, ttl_seconds=60, path=path))
+    monkeypatch.setattr(cache, "run_in_threadpool", recording_run_in_threadpool)
+    first = client.post("/api/blackrock/challenge/v1/returns:nps", json=returns_payload())
+    second = client.post("/api/blackrock/challenge/v1/returns:nps", json=returns_payload())
+
+    assert first.headers["X-Cache"] == "miss" and second.headers["X-Cache"] == "hit"
+    assert calls.count("get") == 2 and calls.count("put") == 1
+
+
+def test_cache_stats_in_performance():
+    client.post("/api/blackrock/challenge/v1/returns:nps", json=returns_payload())
+    client.post("/api/blackrock/challenge/v1/returns:nps", json=returns_payload())
+
+    data = client.get("/api/blackrock/challenge/v1/performance", params={"detailed": True}).json()
+
+    assert data["cache"]["hits"] >= 1
+    assert data["cache"]["entries"] >= 1
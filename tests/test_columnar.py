@@ -0,0 +1,123 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import columnar
+from app.models import ReturnNpsIndexRequest
+from app.utils import (FILTER_STAGES, QPeriodMap, TransactionPipeline, apply_q_rule, compute_remanents,
+                       investment_projection_engine, k_period_investments, k_period_membership, projection_pipeline,
+                       rule_plan)
+from benchmarks.data import make_periods, make_transactions
+
+pytestmark = pytest.mark.skipif(not columnar.HAS_NUMPY, reason="numpy is not installed")
+
+BASE = datetime(2026, 1, 1)
+
+
+def fmt(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def random_period(rng):
+    start = BASE + timedelta(days=rng.randint(0, 330), seconds=rng.randint(0, 86399))
+    end = start + timedelta(days=rng.randint(0, 60), seconds=rng.randint(0, 86399))
+    return start, end
+
+
+def random_request(seed, n=300):
+    rng = random.Random(seed)
+    transactions = []
+    for _ in range(n):
+        date = BASE + timedelta(days=rng.randint(0, 364), seconds=rng.randint(0, 86399))
+        transactions.append({"date": fmt(date), "amount": round(rng.uniform(-50, 5000), 2)})
+    # boundary hits on purpose
+    q, p, k = [], [], []
+    for _ in range(8):
+        start, end = random_period(rng)
+        q.append({"start": fmt(start), "end": fmt(end), "fixed": rng.choice([0, 10, 50.5])})
+        transactions.append({"date": fmt(start), "amount": 120})
+    for _ in range(8):
+        start, end = random_period(rng)
+        p.append({"start": fmt(start), "end": fmt(end), "extra": rng.choice([5, 25, 12.5])})
+        transactions.append({"date": fmt(end), "amount": 330})
+    for _ in range(12):
+        start, end = random_period(rng)
+        k.append({"start": fmt(start), "end": fmt(end)})
+        transactions.append({"date": fmt(end), "amount": 77})
+    return ReturnNpsIndexRequest(q=q, p=p, k=k, wage=1500000, age=29, inflation=5.5, transaction=transactions)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("mode", ["nps", "index"])
+def test_projection_parity(seed, mode, monkeypatch):
+    request = random_request(seed)
+
+    expected = projection_pipeline(request, use_numpy=False).run(request.transaction)
+    actual = projection_pipeline(request, use_numpy=True).run(request.transaction)
+
+    assert actual.k_sums == pytest.approx(expected.k_sums, abs=1e-6)
+    assert actual.total_transaction_amount == pytest.approx(expected.total_transaction_amount)
+    assert actual.total_ceiling_amount == expected.total_ceiling_amount
+
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+    python_results = investment_projection_engine(request, mode)
+    monkeypatch.undo()
+    for a, e in zip(investment_projection_engine(request, mode), python_results, strict=True):
+        assert a.start == e.start and a.end == e.end
+        assert a.amount == pytest.approx(e.amount, abs=1e-6)
+        assert a.profit == pytest.approx(e.profit, abs=0.02)
+        assert a.taxBenefit == pytest.approx(e.taxBenefit, abs=0.02)
+
+
+@pytest.mark.parametrize("seed", [4, 5])
+def test_remanent_and_membership_parity(seed, monkeypatch):
+    request = random_request(seed)
+    transactions = sorted(request.transaction, key=lambda t: t.date)
+
+    ceilings, remanents = compute_remanents(transactions, request.q, request.p)
+    membership = k_period_membership(transactions, request.k)
+
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+    expected_ceilings, expected_remanents = compute_remanents(transactions, request.q, request.p)
+    expected_membership = k_period_membership(transactions, request.k)
+
+    assert ceilings == expected_ceilings
+    assert remanents == pytest.approx(expected_remanents, abs=1e-9)
+    assert membership == expected_membership
+
+
+def test_projection_without_k_periods():
+    request = random_request(6)
+    request.k = []
+
+    assert k_period_investments(request) == []
+
+
+@pytest.mark.parametrize("seed", [7, 8])
+def test_filter_pipeline_parity(seed):
+    request = random_request(seed)
+    # duplicates and negatives for the validate stage
+    transactions = list(request.transaction)
+    transactions += transactions[:20]
+    plan = rule_plan(request)
+
+    expected = TransactionPipeline(FILTER_STAGES, plan, use_numpy=False).run(transactions)
+    actual = TransactionPipeline(FILTER_STAGES, plan, use_numpy=True).run(transactions)
+
+    assert actual.invalid == expected.invalid
+    assert actual.transactions == expected.transactions
+    assert actual.ceilings == expected.ceilings
+    assert actual.remanents == pytest.approx(expected.remanents, abs=1e-9)
+    assert actual.in_k_periods == expected.in_k_periods
+
+
+def test_q_rule_parity_on_100k_overlapping_windows():
+    transactions = sorted(make_transactions(5000, seed=5), key=lambda t: t.date)
+    q_periods = make_periods(100000, "q", seed=5, overlap=20.0)
+    base = [float(i % 97) for i in range(len(transactions))]
+
+    epochs, _ = columnar.to_columns(transactions)
+    vectorized = columnar.apply_q_rule(epochs, columnar.np.array(base), QPeriodMap(q_periods).columns)
+
+    assert vectorized.tolist() == apply_q_rule(transactions, list(base), q_periods)
@@ -0,0 +1,100 @@
+import random
+from array import array
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import columnar, dedup
+from app.dedup import DEDUP_MAX_CAPACITY, BoundedDedupState, DedupState, key_hashes, transaction_keys
+from app.main import app
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+def parsed(date, amount):
+    return {"date": date, "amount": amount, "ceiling": 0, "remanent": 0}
+
+
+def random_chunks(seed, chunks=5, rows=400):
+    rng = random.Random(seed)
+    epochs = [1700000000 + rng.randrange(50) * 3600 for _ in range(chunks * rows)]
+    amounts = [float(rng.choice([0.0, -0.0, 10.5, 250, 99.99])) for _ in range(chunks * rows)]
+    return [
+        (array("q", epochs[i:i + rows]), array("d", amounts[i:i + rows])) for i in range(0, chunks * rows, rows)
+    ]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_bounded_state_is_exact(use_numpy, monkeypatch):
+    monkeypatch.setattr(columnar, "HAS_NUMPY", use_numpy and columnar.np is not None)
+    exact = DedupState()
+    # a tiny Bloom filter (many false positives) and spill set (most keys on disk)
+    bounded = BoundedDedupState(capacity=16, memory_keys=8)
+
+    for epochs, amounts in random_chunks(3):
+        assert bounded.check(epochs, amounts) == exact.check(epochs, amounts)
+    assert bounded.count == exact.count
+    assert bounded.spill._db is not None
+    bounded.close()
+
+
+def test_key_hashes_match_without_numpy(monkeypatch):
+    if columnar.np is None:
+        pytest.skip("numpy is not installed")
+    epochs, amounts = random_chunks(5, chunks=1)[0]
+    with_numpy = key_hashes(epochs, amounts).tolist()
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+
+    assert key_hashes(epochs, amounts) == with_numpy
+
+
+def test_zero_and_negative_zero_are_the_same_amount():
+    assert transaction_keys(array("q", [1, 1]), array("d", [0.0, -0.0])) == [1 << 64, 1 << 64]
+
+
+def test_duplicates_are_any_earlier_transaction_with_the_same_date_and_amount():
+    transactions = [parsed("2023-10-12 20:15:30", amount) for amount in (250, 100, 250, -250)]
+
+    response = client.post(f"{API}/transactions:validate", json={"wage": 50000, "transaction": transactions})
+
+    assert [t["amount"] for t in response.json()["valid"]] == [250, 100]
+    assert [t["message"] for t in response.json()["invalid"]] == ["Duplicate transactions", "negative amounts are not allowed"]
+
+
+@pytest.mark.parametrize("bounded", [False, True])
+def test_dedup_state_is_shared_across_requests(bounded):
+    dedup = client.post(f"{API}/dedup", json={"bounded": bounded, "capacity": 1000}).json()
+    first = [parsed("2023-10-12 20:15:30", 250), parsed("2023-10-13 20:15:30", 10)]
+    second = [{"date": "2023-10-13 20:15:30", "amount": 10}, {"date": "2023-10-14 20:15:30", "amount": 10}]
+    periods = {"q": [], "p": [], "k": [], "wage": 50000}
+
+    client.post(f"{API}/transactions:validate", params={"dedupId": dedup["dedupId"]},
+                json={"wage": 50000, "transaction": first})
+    response = client.post(f"{API}/transactions:filter", params={"dedupId": dedup["dedupId"]},
+                           json={**periods, "transaction": second})
+
+    assert [t["date"] for t in response.json()["valid"]] == ["2023-10-14 20:15:30"]
+    assert [t["message"] for t in response.json()["invalid"]] == ["Duplicate transactions"]
+    assert client.get(f"{API}/dedup/{dedup['dedupId']}").json()["transactionCount"] == 3
+    assert client.delete(f"{API}/dedup/{dedup['dedupId']}").status_code == 204
+    assert client.post(f"{API}/transactions:filter", params={"dedupId": dedup["dedupId"]},
+                       json={**periods, "transaction": second}).status_code == 404
+
+
+def test_dedup_capacity_is_bounded():
+    for capacity in (DEDUP_MAX_CAPACITY + 1, 10 ** 15):
+        response = client.post(f"{API}/dedup", json={"bounded": True, "capacity": capacity})
+        assert response.status_code == 422
+
+
+def test_dedup_creation_error_is_400(monkeypatch):
+    def fail(bounded, capacity):
+        raise OSError("no space left on device")
+
+    monkeypatch.setattr(dedup.dedup_registry, "create", fail)
+    response = client.post(f"{API}/dedup", json={"bounded": True})
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "no space left on device"
@@ -0,0 +1,121 @@
+import json
+import random
+from array import array
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import columnar, external
+from app.batch import TransactionBatch
+from app.external import ExternalSorter, project_chunks
+from app.main import app
+from app.utils import projection_pipeline, rule_plan
+from benchmarks.data import make_request, to_json_payload
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+def chunks_of(batch, size):
+    for start in range(0, len(batch), size):
+        yield TransactionBatch(batch.epochs[start:start + size], batch.amounts[start:start + size])
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("run_rows", [500, 3000, 100000])
+def test_external_sort_is_stable(use_numpy, run_rows, monkeypatch):
+    monkeypatch.setattr(columnar, "HAS_NUMPY", use_numpy and columnar.np is not None)
+    rng = random.Random(3)
+    # few distinct dates, so most rows tie; the amount records the arrival order
+    batch = TransactionBatch(array("q", [rng.randrange(300) for _ in range(20000)]), array("d", range(20000)))
+
+    with ExternalSorter(run_rows) as sorter:
+        for chunk in chunks_of(batch, 1700):
+            sorter.add(chunk)
+        merged = TransactionBatch()
+        for chunk in sorter.merged(chunk_rows=2048):
+            assert len(chunk) > 0
+            merged.epochs.extend(chunk.epochs)
+            merged.amounts.extend(chunk.amounts)
+        assert (len(sorter.runs) > 1) == (run_rows < 20000)
+
+    assert merged == batch.sorted()
+
+
+def test_project_chunks_matches_single_pass():
+    request = make_request(3000, q=10, p=10, k=8, overlap=3.0, duplicate_ratio=0.05, seed=6)
+    pipeline = projection_pipeline(request)
+
+    expected = pipeline.run(request.transaction)
+    actual = project_chunks(pipeline, chunks_of(request.transaction, 700))
+
+    assert actual.total_transaction_amount == pytest.approx(expected.total_transaction_amount)
+    assert actual.total_ceiling_amount == expected.total_ceiling_amount
+    assert actual.k_sums == pytest.approx(expected.k_sums)
+    assert project_chunks(projection_pipeline(request, rule_plan(request)), []).k_sums == [0] * 8
+
+
+def rounded(value):
+    # chunked sums may differ from a single pass in the last bits
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, list):
+        return [rounded(item) for item in value]
+    if isinstance(value, dict):
+        return {key: rounded(item) for key, item in value.items()}
+    return value
+
+
+@pytest.fixture
+def upload(monkeypatch):
+    monkeypatch.setattr(external, "EXTERNAL_RUN_ROWS", 400)
+    payload = to_json_payload(make_request(2500, q=6, p=6, k=5, overlap=2.0, duplicate_ratio=0.05, seed=9))
+    payload["transaction"][3]["amount"] = -12.5
+    csv_file = "".join(f"{t['date']},{t['amount']}\n" for t in payload["transaction"])
+    return payload, csv_file
+
+
+def test_out_of_core_filter_matches_json_endpoint(upload):
+    payload, csv_file = upload
+    periods = {key: value for key, value in payload.items() if key not in ("transaction", "age", "inflation")}
+    expected = client.post(f"{API}/transactions:filter", json={**periods, "transaction": payload["transaction"]}).json()
+
+    response = client.post(f"{API}/transactions:filterUpload?outOfCore=true", files={"file": ("t.csv", csv_file)},
+                           data={"periods": json.dumps(periods)})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert [line["invalid"] for line in lines if "invalid" in line] == expected["invalid"]
+    assert [line["valid"] for line in lines if "valid" in line] == expected["valid"]
+
+
+@pytest.mark.parametrize("mode, extra", [
+    ("nps", {}),
+    ("index", {}),
+    ("batch", {"scenarios": [{"mode": "nps", "age": 30, "inflation": 5.5}, {"mode": "index", "age": 45, "inflation": 3}]}),
+    ("sweep", {"modes": ["nps", "index"], "ages": [25, 40], "inflations": [4, 6]}),
+])
+def test_out_of_core_returns_match_in_memory(upload, mode, extra):
+    payload, csv_file = upload
+    periods = json.dumps({**{key: value for key, value in payload.items() if key != "transaction"}, **extra})
+
+    in_memory = client.post(f"{API}/returns:{mode}Upload", files={"file": ("t.csv", csv_file)}, data={"periods": periods})
+    out_of_core = client.post(f"{API}/returns:{mode}Upload?outOfCore=true", files={"file": ("t.csv", csv_file)},
+                              data={"periods": periods})
+
+    assert in_memory.status_code == out_of_core.status_code == 200
+    assert rounded(out_of_core.json()) == rounded(in_memory.json())
+
+
+def test_out_of_core_format_errors(upload):
+    payload, _ = upload
+    periods = {key: value for key, value in payload.items() if key != "transaction"}
+
+    returns = client.post(f"{API}/returns:npsUpload?outOfCore=true", files={"file": ("t.csv", "2023-01-01,5\n")},
+                          data={"periods": json.dumps(periods)})
+    filtered = client.post(f"{API}/transactions:filterUpload?outOfCore=true", files={"file": ("t.csv", "2023-01-01,5\n")},
+                           data={"periods": json.dumps({"q": [], "p": [], "k": [], "wage": 1})})
+
+    assert returns.status_code == 422
+    assert returns.json()["detail"][0]["loc"] == ["body", "file", 1]
+    assert json.loads(filtered.text.splitlines()[-1])["row"] == 1
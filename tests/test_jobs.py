@@ -0,0 +1,160 @@
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic_core import to_json
+
+from app import jobs, models
+from app.jobs import JobQueue, JobStore, job_queue
+from app.main import app
+from app.models import ReturnNpsIndexRequest
+from app.plans import plan_registry
+from benchmarks.data import make_request, to_json_payload
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+@pytest.fixture
+def payload():
+    return to_json_payload(make_request(300, q=6, p=6, k=4, overlap=2.0, duplicate_ratio=0.05, seed=9))
+
+
+@pytest.fixture(autouse=True)
+def clear_jobs():
+    job_queue.store.clear()
+    yield
+    job_queue.store.clear()
+
+
+def run_job(kind, payload, tenant="default"):
+    submitted = client.post(f"{API}/jobs/{kind}", json=payload, headers={"X-Tenant-Id": tenant})
+    assert submitted.status_code == 202
+    status = client.get(f"{API}/jobs/{submitted.json()['jobId']}?wait=10", headers={"X-Tenant-Id": tenant}).json()
+    assert status["status"] in ("done", "failed")
+    return status
+
+
+@pytest.mark.parametrize("kind, endpoint", [("filter", "transactions:filter"), ("nps", "returns:nps"), ("index", "returns:index")])
+def test_job_result_matches_endpoint(payload, kind, endpoint):
+    if kind == "filter":
+        payload = {key: value for key, value in payload.items() if key not in ("age", "inflation")}
+
+    status = run_job(kind, payload)
+    result = client.get(f"{API}/jobs/{status['jobId']}/result")
+
+    assert status["status"] == "done"
+    assert result.json() == client.post(f"{API}/{endpoint}", json=payload).json()
+
+
+def test_same_payload_is_the_same_job_per_tenant(payload):
+    first = run_job("nps", payload)
+    again = client.post(f"{API}/jobs/nps", json=payload)
+    other_tenant = run_job("nps", payload, tenant="acme")
+
+    assert again.status_code == 200
+    assert again.json()["jobId"] == first["jobId"] and again.json()["status"] == "done"
+    assert other_tenant["jobId"] != first["jobId"]
+    assert client.get(f"{API}/jobs/{first['jobId']}", headers={"X-Tenant-Id": "acme"}).status_code == 404
+
+
+def test_failed_job_reports_the_endpoint_status(payload, monkeypatch):
+    # the grid size of a planId sweep is only known once the plan is resolved
+    monkeypatch.setattr(models, "MAX_SWEEP_CELLS", 1)
+    plan_id = client.post(f"{API}/plans", json={name: payload[name] for name in ("q", "p", "k")}).json()["planId"]
+    with_plan = {key: value for key, value in payload.items() if key not in ("q", "p", "k")}
+
+    status = run_job("sweep", {**with_plan, "planId": plan_id, "ages": [30], "inflations": [5]})
+
+    assert (status["status"], status["statusCode"]) == ("failed", 400)
+    assert client.get(f"{API}/jobs/{status['jobId']}/result").status_code == 400
+    assert client.post(f"{API}/jobs/nps", json={"wage": 1}).status_code == 422
+
+
+def test_job_submission_error_is_400(payload, monkeypatch):
+    def fail(*args):
+        raise ValueError("job store unavailable")
+
+    monkeypatch.setattr(job_queue, "submit", fail)
+    response = client.post(f"{API}/jobs/nps", json=payload)
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "job store unavailable"
+
+
+def test_plan_is_resolved_at_submission_and_stored_with_the_job(payload, monkeypatch):
+    with_plan = {key: value for key, value in payload.items() if key not in ("q", "p", "k")}
+    assert client.post(f"{API}/jobs/nps", json={**with_plan, "planId": "unknown"}).status_code == 404
+
+    plan_id = client.post(f"{API}/plans", json={name: payload[name] for name in ("q", "p", "k")}).json()["planId"]
+    expected = client.post(f"{API}/returns:nps", json=payload).json()
+    # without workers the job stays queued until the plan is gone from the registry
+    job_queue.shutdown()
+    workers = job_queue.workers
+    monkeypatch.setattr(job_queue, "workers", 0)
+    submitted = client.post(f"{API}/jobs/nps", json={**with_plan, "planId": plan_id}).json()
+    assert submitted["rowsTotal"] == len(payload["transaction"]) and submitted["rowsDone"] == 0
+    plan_registry.clear()
+    monkeypatch.setattr(job_queue, "workers", workers)
+    job_queue.start()
+    status = client.get(f"{API}/jobs/{submitted['jobId']}?wait=10").json()
+
+    assert status["status"] == "done" and status["rowsDone"] == status["rowsTotal"] == len(payload["transaction"])
+    assert client.get(f"{API}/jobs/{submitted['jobId']}/result").json() == expected
+
+
+def test_running_job_reports_progress(payload, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_CHUNK_ROWS", 100)
+    done = []
+    request = ReturnNpsIndexRequest.model_validate(payload)
+
+    body = jobs.job_body("nps", request, done.append)
+
+    body = json.loads(to_json(body))
+    expected = client.post(f"{API}/returns:nps", json=payload).json()
+    assert done == [100, 200, 300]
+    # the total is added up chunk by chunk, the last bits may differ
+    assert body.pop("totalTransactionAmount") == pytest.approx(expected.pop("totalTransactionAmount"))
+    assert body == expected
+
+
+def test_tenant_job_limit(payload, monkeypatch):
+    # without workers the jobs stay queued
+    monkeypatch.setattr(job_queue, "tenant_max_jobs", 1)
+    job_queue.shutdown()
+    monkeypatch.setattr(job_queue, "workers", 0)
+
+    queued = client.post(f"{API}/jobs/nps", json=payload)
+    rejected = client.post(f"{API}/jobs/index", json=payload)
+    other_tenant = client.post(f"{API}/jobs/index", json=payload, headers={"X-Tenant-Id": "acme"})
+
+    assert queued.json()["status"] == "queued"
+    assert rejected.status_code == 429
+    assert other_tenant.status_code == 202
+    assert client.get(f"{API}/jobs/{queued.json()['jobId']}/result").status_code == 409
+    assert client.delete(f"{API}/jobs/{queued.json()['jobId']}").status_code == 204
+    assert client.post(f"{API}/jobs/index", json=payload).status_code == 202
+
+
+def test_jobs_survive_a_restart(payload, tmp_path):
+    path = str(tmp_path / "jobs.db")
+    request = ReturnNpsIndexRequest.model_validate(payload)
+    key, _ = JobQueue(JobStore(path), 0, 1, 10).submit("default", "nps", request, json.dumps(payload).encode())
+    store = JobStore(path)
+    assert store.claim(1, 0)[0] == key
+    # the process that claimed the job is gone
+    store._db.execute("UPDATE jobs SET owner = ?", (2 ** 31 - 1,))
+
+    restarted = JobQueue(JobStore(path), 1, 1, 10)
+    restarted.start()
+    try:
+        for _ in range(200):
+            if restarted.store.get(key, "default")["status"] == "done":
+                break
+            time.sleep(0.05)
+    finally:
+        restarted.shutdown()
+
+    assert restarted.store.get(key, "default")["status"] == "done"
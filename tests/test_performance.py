@@ -1,5 +1,9 @@
+import pytest
 from fastapi.testclient import TestClient
+from app import columnar
+from app.cache import result_cache
 from app.main import app
+from app.metrics import STAGES, Histogram, registry
 
 client = TestClient(app)
 
@@ -37,4 +41,55 @@ def test_performance_response_structure():
         "response_time_ms",
         "memory_usage_mb",
         "thread_count"
-    }
\ No newline at end of file
+    }
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_performance_detailed_records_routes_and_stages(numpy, monkeypatch):
+    monkeypatch.setattr(columnar, "HAS_NUMPY", numpy and columnar.HAS_NUMPY)
+    monkeypatch.setattr(registry, "stages", {})
+    monkeypatch.setattr(registry, "routes", {})
+    result_cache.clear()
+    payload = {
+        "transaction": [
+            {"date": "2024-01-01 12:07:00", "amount": 150},
+            {"date": "2024-01-02 13:15:00", "amount": 275},
+        ],
+        "q": [], "p": [], "k": [{"start": "2024-01-01 00:00:00", "end": "2024-01-31 00:00:00"}], "wage": 0,
+    }
+    client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload)
+
+    response = client.get("/api/blackrock/challenge/v1/performance", params={"detailed": True})
+    assert response.status_code == 200
+    data = response.json()
+
+    route = data["routes"]["POST /api/blackrock/challenge/v1/transactions:filter"]
+    assert route["count"] == 1
+    assert route["rows"] == route["max_rows"] == 2
+    assert route["request_bytes"] > 0
+    assert route["response_bytes"] > 0
+    assert route["p50_ms"] <= route["p95_ms"] <= route["p99_ms"]
+    for name in ("parse", "validate", "ceiling", "q_rule", "p_rule", "k_aggregation", "serialization"):
+        assert data["stages"][name]["count"] >= 1
+    assert list(data["stages"]) == [name for name in STAGES if name in data["stages"]]
+
+
+def test_prometheus_metrics():
+    client.get("/api/blackrock/challenge/v1/performance")
+
+    response = client.get("/api/blackrock/challenge/v1/performance/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+    text = response.text
+    assert 'blk_request_duration_seconds_count{route="GET /api/blackrock/challenge/v1/performance"}' in text
+    assert "blk_process_resident_memory_bytes" in text
+
+
+def test_histogram_percentiles():
+    histogram = Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(value)
+
+    assert histogram.percentile(0.25) == 1.0
+    assert histogram.percentile(0.75) == 2.0
+    assert 2.0 < histogram.percentile(0.99) <= 4.0
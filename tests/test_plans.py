@@ -0,0 +1,123 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.plans import plan_registry
+from app.utils import PExtraSteps, apply_p_rule
+from benchmarks.data import make_request, to_json_payload
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+@pytest.fixture
+def payload():
+    return to_json_payload(make_request(300, q=20, p=20, k=15, overlap=2.0, duplicate_ratio=0.05, seed=4))
+
+
+def register(payload):
+    response = client.post(f"{API}/plans", json={name: payload[name] for name in ("q", "p", "k")})
+    assert response.status_code == 200
+    return response.json()
+
+
+def with_plan(payload, plan_id):
+    return {**{name: value for name, value in payload.items() if name not in ("q", "p", "k")}, "planId": plan_id}
+
+
+def test_register_plan_is_content_addressed(payload):
+    first = register(payload)
+    second = register(payload)
+
+    assert first == second
+    assert first["q"] == 20 and first["p"] == 20 and first["k"] == 15
+    assert client.get(f"{API}/plans/{first['planId']}").json() == first
+
+
+def test_filter_with_plan_matches_inline_periods(payload):
+    plan_id = register(payload)["planId"]
+    filter_payload = {name: value for name, value in payload.items() if name not in ("age", "inflation")}
+
+    inline = client.post(f"{API}/transactions:filter", json=filter_payload)
+    planned = client.post(f"{API}/transactions:filter", json=with_plan(filter_payload, plan_id))
+
+    assert planned.status_code == 200
+    assert planned.json() == inline.json()
+
+
+@pytest.mark.parametrize("route", ["returns:nps", "returns:index"])
+def test_returns_with_plan_matches_inline_periods(payload, route):
+    plan_id = register(payload)["planId"]
+
+    inline = client.post(f"{API}/{route}", json=payload)
+    planned = client.post(f"{API}/{route}", json=with_plan(payload, plan_id))
+
+    assert planned.status_code == 200
+    assert planned.json() == inline.json()
+
+
+def test_batch_with_plan_matches_inline_periods(payload):
+    plan_id = register(payload)["planId"]
+    batch = {**payload, "scenarios": [{"mode": "nps", "age": 30, "inflation": 5.5}, {"mode": "index", "age": 40, "inflation": 3}]}
+    del batch["age"], batch["inflation"]
+
+    inline = client.post(f"{API}/returns:batch", json=batch)
+    planned = client.post(f"{API}/returns:batch", json=with_plan(batch, plan_id))
+
+    assert planned.json() == inline.json()
+
+
+def test_unknown_plan_is_404(payload):
+    response = client.post(f"{API}/returns:nps", json=with_plan(payload, "missing"))
+
+    assert response.status_code == 404
+    assert client.get(f"{API}/plans/missing").status_code == 404
+
+
+def test_plan_registration_error_is_400(payload, monkeypatch):
+    def fail(request):
+        raise ValueError("plan store unavailable")
+
+    monkeypatch.setattr(plan_registry, "register", fail)
+    response = client.post(f"{API}/plans", json={name: payload[name] for name in ("q", "p", "k")})
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "plan store unavailable"
+
+
+def test_evicted_plan_is_404(payload):
+    plan_id = register(payload)["planId"]
+    plan_registry.clear()
+
+    assert client.post(f"{API}/returns:nps", json=with_plan(payload, plan_id)).status_code == 404
+
+
+def test_plan_and_inline_periods_are_exclusive(payload):
+    plan_id = register(payload)["planId"]
+
+    assert client.post(f"{API}/returns:nps", json={**payload, "planId": plan_id}).status_code == 422
+    assert client.post(f"{API}/returns:nps", json=with_plan(payload, None)).status_code == 422
+
+
+def reference_p_rule(transactions, remanents, p_periods):
+    # event sweep over the raw periods, as the P rule was computed before plans
+    events = sorted([(p.start, p.extra) for p in p_periods] + [(p.end, -p.extra) for p in p_periods], key=lambda x: x[0])
+    running_extra = 0
+    event_index = 0
+    for i, txn in enumerate(transactions):
+        while event_index < len(events) and events[event_index][0] <= txn.date:
+            running_extra += events[event_index][1]
+            event_index += 1
+        remanents[i] += running_extra
+    return remanents
+
+
+def test_p_extra_steps_match_event_sweep():
+    request = make_request(500, q=0, p=40, k=0, overlap=3.0, seed=9)
+    transactions = sorted(request.transaction, key=lambda t: t.date)
+    base = [float(i % 7) for i in range(len(transactions))]
+
+    expected = reference_p_rule(transactions, list(base), request.p)
+
+    assert apply_p_rule(transactions, list(base), PExtraSteps(request.p)) == expected
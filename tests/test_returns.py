@@ -1,4 +1,12 @@
+import json
+from datetime import date
+
+import pytest
 from fastapi.testclient import TestClient
+
+from app import columnar, models
+from app.cache import result_cache
+from app.executor import compute_pool
 from app.main import app
 
 client = TestClient(app)
@@ -90,4 +98,348 @@ def test_all_negative_transactions():
     data = response.json()
 
     assert data["totalTransactionAmount"] == 0
-    assert data["totalCeilingAmount"] == 0
\ No newline at end of file
+    assert data["totalCeilingAmount"] == 0
+
+
+def test_nps_offloaded_to_process_pool_matches_inline(monkeypatch):
+    payload = sample_payload()
+    payload["k"] = [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}]
+    inline = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+
+    monkeypatch.setattr(compute_pool, "threshold", 1)
+    result_cache.clear()
+    try:
+        offloaded = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+    finally:
+        compute_pool.shutdown()
+
+    assert offloaded == inline
+
+
+@pytest.mark.skipif(not columnar.HAS_NUMPY, reason="only the numpy engine is offloaded to the process pool")
+def test_returns_saturated_pool_returns_429(monkeypatch):
+    monkeypatch.setattr(compute_pool, "threshold", 1)
+    monkeypatch.setattr(compute_pool, "queue_depth", 0)
+
+    response = client.post("/api/blackrock/challenge/v1/returns:index", json=sample_payload())
+
+    assert response.status_code == 429
+
+
+def test_batch_matches_single_mode_endpoints():
+    payload = sample_payload()
+    payload["k"] = [
+        {"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"},
+        {"start": "2026-02-22 00:00:00", "end": "2026-02-28 00:00:00"},
+    ]
+    batch_payload = {**payload, "scenarios": [
+        {"mode": "nps", "age": 30, "inflation": 5},
+        {"mode": "index", "age": 30, "inflation": 5},
+        {"mode": "index", "age": 65, "inflation": 5},
+    ]}
+
+    response = client.post("/api/blackrock/challenge/v1/returns:batch", json=batch_payload)
+    assert response.status_code == 200
+    data = response.json()
+
+    nps = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+    index = client.post("/api/blackrock/challenge/v1/returns:index", json=payload).json()
+
+    assert data["totalTransactionAmount"] == nps["totalTransactionAmount"]
+    assert data["totalCeilingAmount"] == nps["totalCeilingAmount"]
+    assert data["projections"][0]["savingsByDates"] == nps["savingsByDates"]
+    assert data["projections"][1]["savingsByDates"] == index["savingsByDates"]
+    assert data["projections"][1]["rate"] == 0.1449
+    assert data["projections"][2]["savingsByDates"] == []
+
+
+def test_batch_custom_rate():
+    payload = {**sample_payload(), "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}]}
+    payload["scenarios"] = [{"mode": "index", "age": 59, "inflation": 0, "rate": 0.5}]
+
+    data = client.post("/api/blackrock/challenge/v1/returns:batch", json=payload).json()
+    saving = data["projections"][0]["savingsByDates"][0]
+
+    assert saving["profit"] == round(saving["amount"] * 0.5, 2)
+
+
+def sweep_payload():
+    payload = sample_payload()
+    payload["wage"] = 1800000
+    payload["k"] = [
+        {"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"},
+        {"start": "2026-02-22 00:00:00", "end": "2026-02-28 00:00:00"},
+    ]
+    payload["modes"] = ["nps", "index"]
+    payload["ages"] = [25, 45, 60]
+    payload["inflations"] = [0, 5.5]
+    payload["wages"] = [600000, 1800000]
+    return payload
+
+
+def test_sweep_matches_nps_and_index():
+    response = client.post("/api/blackrock/challenge/v1/returns:sweep", json=sweep_payload())
+    assert response.status_code == 200
+    data = response.json()
+
+    assert len(data["scenarios"]) == 2 * 3 * 2 * 2
+    assert len(data["periods"]) == 2
+
+    base = sample_payload()
+    base["k"] = sweep_payload()["k"]
+    for i, scenario in enumerate(data["scenarios"]):
+        single = {**base, "age": scenario["age"], "inflation": scenario["inflation"], "wage": scenario["wage"]}
+        expected = client.post(f"/api/blackrock/challenge/v1/returns:{scenario['mode']}", json=single).json()
+        if scenario["age"] >= 60:
+            assert data["profit"][i] is None
+            continue
+        for j, saving in enumerate(expected["savingsByDates"]):
+            assert data["periods"][j]["amount"] == saving["amount"]
+            assert data["profit"][i][j] == pytest.approx(saving["profit"], abs=0.011)
+            assert data["taxBenefit"][i][j] == pytest.approx(saving["taxBenefit"], abs=0.011)
+
+
+def test_sweep_python_fallback_matches_numpy(monkeypatch):
+    expected = client.post("/api/blackrock/challenge/v1/returns:sweep", json=sweep_payload()).json()
+
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+    data = client.post("/api/blackrock/challenge/v1/returns:sweep", json=sweep_payload()).json()
+
+    assert data["scenarios"] == expected["scenarios"]
+    for row, expected_row in zip(data["profit"], expected["profit"]):
+        assert row == (None if expected_row is None else pytest.approx(expected_row, abs=0.011))
+    assert data["taxBenefit"] == expected["taxBenefit"]
+
+
+def test_sweep_rejects_oversized_grid(monkeypatch):
+    monkeypatch.setattr(models, "MAX_SWEEP_CELLS", 10)
+
+    response = client.post("/api/blackrock/challenge/v1/returns:sweep", json=sweep_payload())
+
+    assert response.status_code == 422
+
+
+def trajectory_payload(**extra):
+    payload = sample_payload()
+    payload["k"] = sweep_payload()["k"]
+    return {**payload, **extra}
+
+
+@pytest.mark.parametrize("mode, step", [("nps", "year"), ("index", "month")])
+def test_trajectory_ends_at_the_projection(mode, step):
+    data = client.post("/api/blackrock/challenge/v1/returns:trajectory", json=trajectory_payload(mode=mode, step=step)).json()
+    expected = client.post(f"/api/blackrock/challenge/v1/returns:{mode}", json=trajectory_payload()).json()
+
+    steps = 30 * (12 if step == "month" else 1)
+    assert data["times"][0] == pytest.approx(1 / (steps // 30)) and data["times"][-1] == 30
+    assert [len(row) for row in data["nominal"] + data["real"]] == [steps] * 4
+    for period, real, saving in zip(data["periods"], data["real"], expected["savingsByDates"]):
+        assert period["amount"] == saving["amount"]
+        assert real[-1] - period["amount"] == pytest.approx(saving["profit"], abs=0.011)
+
+
+def test_trajectory_factor_tables_are_cached_and_match_python(monkeypatch):
+    from app.utils import trajectory_factor_table
+
+    trajectory_factor_table.cache_clear()
+    expected = client.post("/api/blackrock/challenge/v1/returns:trajectory", json=trajectory_payload(step="month")).json()
+    client.post("/api/blackrock/challenge/v1/returns:trajectory", json=trajectory_payload(step="month", wage=1))
+    assert trajectory_factor_table.cache_info().hits == 1
+
+    trajectory_factor_table.cache_clear()
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+    data = client.post("/api/blackrock/challenge/v1/returns:trajectory", json=trajectory_payload(step="month")).json()
+    trajectory_factor_table.cache_clear()
+
+    for key in ("nominal", "real"):
+        for row, expected_row in zip(data[key], expected[key]):
+            assert row == pytest.approx(expected_row, abs=0.011)
+
+
+def test_returns_reject_ages_out_of_bounds():
+    for age in (-1000000, models.MAX_AGE + 1):
+        for endpoint in ("nps", "trajectory"):
+            response = client.post(f"/api/blackrock/challenge/v1/returns:{endpoint}", json=trajectory_payload(age=age))
+            assert response.status_code == 422
+
+
+def test_trajectory_rejects_oversized_matrix(monkeypatch):
+    monkeypatch.setattr(models, "MAX_TRAJECTORY_CELLS", 10)
+
+    response = client.post("/api/blackrock/challenge/v1/returns:trajectory", json=trajectory_payload())
+
+    assert response.status_code == 422
+
+
+def test_transaction_compounding_compounds_each_remanent_from_its_date():
+    payload = {**sample_payload(), "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}],
+               "compounding": "transaction", "asOf": "2026-12-31 00:00:00"}
+
+    data = client.post("/api/blackrock/challenge/v1/returns:index", json=payload).json()
+
+    # retirement on 2056-12-31: the remanents of 50 (150), 50 (-50) and 25 (275)
+    real = 1.1449 / 1.05
+    days = [(date(2056, 12, 31) - date(2026, 2, day)).days for day in (21, 22, 23)]
+    expected = sum(remanent * real ** (n / 365.25) for remanent, n in zip([50, 50, 25], days))
+    assert data["savingsByDates"][0]["amount"] == 125
+    assert data["savingsByDates"][0]["profit"] == pytest.approx(round(expected - 125, 2), abs=0.011)
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_transaction_compounding_past_the_day_table_is_computed_directly(monkeypatch, use_numpy):
+    from app.utils import DAY_TABLE_MAX_DAYS, daily_factor_table
+
+    if use_numpy and not columnar.HAS_NUMPY:
+        pytest.skip("numpy not installed")
+    monkeypatch.setattr(columnar, "HAS_NUMPY", use_numpy)
+    result_cache.clear()
+    daily_factor_table.cache_clear()
+    # retirement on 2401-01-01, about 137000 days after the transactions
+    payload = {**sample_payload(), "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}],
+               "compounding": "transaction", "asOf": "2400-01-01 00:00:00", "age": 59}
+
+    data = client.post("/api/blackrock/challenge/v1/returns:index", json=payload).json()
+
+    real = 1.1449 / 1.05
+    days = [(date(2401, 1, 1) - date(2026, 2, day)).days for day in (21, 22, 23)]
+    expected = sum(remanent * real ** (n / 365.25) for remanent, n in zip([50, 50, 25], days))
+    assert data["savingsByDates"][0]["profit"] == pytest.approx(expected - 125, rel=1e-9)
+    assert daily_factor_table.cache_info().bytes <= DAY_TABLE_MAX_DAYS * 32
+    daily_factor_table.cache_clear()
+
+
+def test_transaction_compounding_on_the_as_of_date_matches_period_compounding():
+    payload = {**sample_payload(), "k": [{"start": "2026-01-01 00:00:00", "end": "2026-02-21 06:04:11"}]}
+    period = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+
+    # a single transaction, on the end of the K period (the default asOf): 30 years in both modes, within a day
+    exact = client.post("/api/blackrock/challenge/v1/returns:nps", json={**payload, "compounding": "transaction"}).json()
+
+    assert exact["savingsByDates"][0]["profit"] == pytest.approx(period["savingsByDates"][0]["profit"], rel=1e-4)
+    assert exact["savingsByDates"][0]["taxBenefit"] == period["savingsByDates"][0]["taxBenefit"]
+
+
+def test_transaction_compounding_python_and_out_of_core_match_numpy(monkeypatch):
+    from app.utils import daily_factor_table
+
+    payload = {**trajectory_payload(), "compounding": "transaction"}
+    expected = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+    csv = "".join(f"{t['date']},{t['amount']}\n" for t in payload["transaction"])
+    periods = {key: value for key, value in payload.items() if key != "transaction"}
+    out_of_core = client.post("/api/blackrock/challenge/v1/returns:npsUpload?outOfCore=true",
+                              files={"file": ("t.csv", csv)}, data={"periods": json.dumps(periods)}).json()
+
+    daily_factor_table.cache_clear()
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+    result_cache.clear()
+    python = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+    daily_factor_table.cache_clear()
+
+    for data in (python, out_of_core):
+        for saving, expected_saving in zip(data["savingsByDates"], expected["savingsByDates"]):
+            assert saving["profit"] == pytest.approx(expected_saving["profit"], abs=0.011)
+
+
+def test_simulation_without_volatility_is_the_projection():
+    payload = {**trajectory_payload(wage=600000), "volatility": 0, "paths": 100}
+    data = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json()
+    expected = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+
+    assert data["percentiles"] == [5, 25, 50, 75, 95] and data["mean"] == 0.0711
+    for profit, saving in zip(data["profit"], expected["savingsByDates"]):
+        assert profit == pytest.approx([saving["profit"]] * 5, abs=0.011)
+    assert data["taxBenefit"] == [saving["taxBenefit"] for saving in expected["savingsByDates"]]
+    assert data["lossProbability"] == 0
+
+
+def test_simulation_is_seeded_and_sharding_does_not_change_the_paths(monkeypatch):
+    from app import simulation
+
+    payload = {**trajectory_payload(mode="index"), "paths": 20000, "seed": 42}
+    data = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json()
+    assert client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json() == data
+    for row in data["realValue"]:
+        assert row == sorted(row)
+
+    monkeypatch.setattr(simulation, "SIMULATION_SHARD_PATHS", simulation.SIMULATION_BLOCK_PATHS)
+    monkeypatch.setattr(compute_pool, "workers", 2)
+    try:
+        sharded = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json()
+    finally:
+        compute_pool.shutdown()
+    assert sharded == data
+
+    unseeded = client.post("/api/blackrock/challenge/v1/returns:simulate", json={**payload, "seed": None}).json()
+    assert isinstance(unseeded["seed"], int)
+
+
+def test_simulation_on_a_saturated_pool_is_429(monkeypatch):
+    from app import simulation
+
+    monkeypatch.setattr(simulation, "SIMULATION_SHARD_PATHS", simulation.SIMULATION_BLOCK_PATHS)
+    monkeypatch.setattr(compute_pool, "workers", 2)
+    monkeypatch.setattr(compute_pool, "queue_depth", 0)
+    payload = {**trajectory_payload(), "paths": 20000, "seed": 42}
+
+    response = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload)
+
+    assert response.status_code == 429
+
+
+def test_simulation_python_matches_numpy_in_distribution(monkeypatch):
+    payload = {**trajectory_payload(), "paths": 4000, "seed": 7}
+    expected = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json()
+
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+    data = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json()
+
+    for row, expected_row in zip(data["realValue"], expected["realValue"]):
+        assert row == pytest.approx(expected_row, rel=0.05)
+    assert data["lossProbability"] == pytest.approx(expected["lossProbability"], abs=0.03)
+
+
+def test_simulation_rejects_transaction_compounding_and_bad_percentiles():
+    for extra in ({"compounding": "transaction"}, {"percentiles": [50, 101]}, {"paths": 0}):
+        response = client.post("/api/blackrock/challenge/v1/returns:simulate", json={**trajectory_payload(), **extra})
+        assert response.status_code == 422
+
+
+@pytest.mark.parametrize("age", [60, 75])
+def test_simulation_at_retirement_age_projects_nothing_like_nps(age):
+    payload = {**trajectory_payload(age=age), "paths": 100, "seed": 1}
+    data = client.post("/api/blackrock/challenge/v1/returns:simulate", json=payload).json()
+    expected = client.post("/api/blackrock/challenge/v1/returns:nps", json=payload).json()
+
+    assert expected["savingsByDates"] == []
+    assert data["periods"] == data["realValue"] == data["profit"] == data["expectedRealValue"] == data["taxBenefit"] == []
+    assert data["totalTransactionAmount"] == expected["totalTransactionAmount"]
+    assert data["lossProbability"] == 0
+
+
+def test_simulation_block_draws_one_year_at_a_time():
+    if not columnar.HAS_NUMPY:
+        pytest.skip("numpy not installed")
+    np = columnar.np
+
+    growth = columnar.lognormal_growth(3, 0, 1000, 40, 0.05, 0.1)
+    rng = np.random.default_rng(np.random.SeedSequence(3, spawn_key=(0,)))
+    expected = np.exp(sum(rng.normal(0.05, 0.1, size=1000) for _ in range(40)))
+    assert growth.shape == (1000,)
+    assert np.allclose(growth, expected)
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_k_amount_has_no_prefix_sum_cancellation_error(numpy, monkeypatch):
+    monkeypatch.setattr(columnar, "HAS_NUMPY", numpy and columnar.HAS_NUMPY)
+    result_cache.clear()
+    payload = {**sample_payload(), "k": [{"start": "2026-02-01 00:00:00", "end": "2026-02-28 23:59:59"}], "transaction": [
+        {"date": "2026-01-10 10:00:00", "amount": 12.3},
+        {"date": "2026-02-10 10:00:00", "amount": 10.1},
+        {"date": "2026-02-11 10:00:00", "amount": 89.9},
+    ]}
+
+    data = client.post("/api/blackrock/challenge/v1/returns:index", json=payload).json()
+
+    # remanents 89.9 + 10.1 after 87.7: the prefix sum difference alone gives 100.00000000000001
+    assert data["savingsByDates"][0]["amount"] == 100
+    assert repr(data["savingsByDates"][0]["amount"]) == "100.0"
@@ -0,0 +1,129 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.models import ReturnNpsIndexRequest, TransactionParseRequest
+from app.sessions import FenwickTree, SessionStore
+from benchmarks.data import make_request, to_json_payload
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+def sample_payload():
+    return {
+        "q": [{"fixed": 0, "start": "2023-07-01 00:00:00", "end": "2023-07-31 23:59:59"}],
+        "p": [{"extra": 25, "start": "2023-10-01 08:00:00", "end": "2023-12-31 19:59:59"}],
+        "k": [
+            {"start": "2023-03-01 00:00:00", "end": "2023-11-30 23:59:59"},
+            {"start": "2023-01-01 00:00:00", "end": "2023-12-31 23:59:59"},
+            {"start": "2023-12-31 00:00:00", "end": "2023-01-01 00:00:00"}
+        ],
+        "wage": 50000,
+        "age": 29,
+        "inflation": 5.5,
+        "transaction": [
+            {"date": "2023-10-12 20:15:30", "amount": 250},
+            {"date": "2023-02-28 15:49:20", "amount": 375},
+            {"date": "2023-07-01 21:59:00", "amount": 620},
+            {"date": "2023-12-17 08:09:45", "amount": -480}
+        ]
+    }
+
+
+def test_fenwick_tree_prefix_sums():
+    tree = FenwickTree(5)
+    for index, value in enumerate([3, 1, 4, 1, 5]):
+        tree.add(index, value)
+    tree.add(2, 10)
+
+    assert [tree.prefix_sum(count) for count in range(6)] == [0, 3, 4, 18, 19, 24]
+
+
+@pytest.mark.parametrize("mode", ["nps", "index"])
+def test_session_matches_returns_endpoint(mode):
+    payload = sample_payload()
+    transactions = payload["transaction"]
+
+    created = client.post(f"{API}/sessions", json={**payload, "transaction": transactions[:1]})
+    assert created.status_code == 200
+    session_id = created.json()["id"]
+
+    appended = client.post(f"{API}/sessions/{session_id}/transactions", json=transactions[1:])
+    assert appended.json() == {"id": session_id, "transactionCount": 4}
+
+    session = client.get(f"{API}/sessions/{session_id}/returns", params={"mode": mode}).json()
+    expected = client.post(f"{API}/returns:{mode}", json=payload).json()
+    assert session == expected
+
+
+def test_session_matches_returns_endpoint_with_overlapping_periods():
+    request = make_request(2000, q=30, p=30, k=30, overlap=3.0, duplicate_ratio=0.05, seed=3)
+    payload = to_json_payload(request)
+
+    session_id = client.post(f"{API}/sessions", json={**payload, "transaction": []}).json()["id"]
+    for start in range(0, 2000, 500):
+        client.post(f"{API}/sessions/{session_id}/transactions", json=payload["transaction"][start:start + 500])
+
+    session = client.get(f"{API}/sessions/{session_id}/returns").json()
+    expected = client.post(f"{API}/returns:nps", json=payload).json()
+    assert session["totalTransactionAmount"] == pytest.approx(expected["totalTransactionAmount"])
+    for got, want in zip(session["savingsByDates"], expected["savingsByDates"], strict=True):
+        assert got["amount"] == pytest.approx(want["amount"])
+        assert got["profit"] == pytest.approx(want["profit"], abs=0.011)
+        assert got["taxBenefit"] == pytest.approx(want["taxBenefit"], abs=0.011)
+
+
+def test_unknown_session_is_404():
+    assert client.get(f"{API}/sessions/missing/returns").status_code == 404
+    assert client.post(f"{API}/sessions/missing/transactions", json=[]).status_code == 404
+    assert client.delete(f"{API}/sessions/missing").status_code == 404
+
+
+def test_deleted_session_is_gone():
+    session_id = client.post(f"{API}/sessions", json=sample_payload()).json()["id"]
+
+    assert client.delete(f"{API}/sessions/{session_id}").status_code == 204
+    assert client.get(f"{API}/sessions/{session_id}/returns").status_code == 404
+
+
+def test_session_store_reloads_from_sqlite(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    request = ReturnNpsIndexRequest.model_validate(sample_payload())
+    store = SessionStore(path)
+    session = store.create(request)
+    store.add_transactions(session, [TransactionParseRequest(date="2023-11-01 10:00:00", amount=199)])
+
+    restarted = SessionStore(path)
+    reloaded = restarted.get(session.id)
+
+    assert reloaded is not None
+    assert reloaded.transaction_count == 5
+    assert reloaded.k_period_investments() == session.k_period_investments()
+    assert reloaded.returns("nps") == session.returns("nps")
+
+
+def test_session_keeps_no_transactions():
+    request = ReturnNpsIndexRequest.model_validate(sample_payload())
+    session = SessionStore().create(request)
+
+    assert len(session.request.transaction) == 0
+    assert session.transaction_count == 4
+
+
+def test_session_store_is_an_lru_reloading_from_sqlite(tmp_path):
+    request = ReturnNpsIndexRequest.model_validate(sample_payload())
+    in_memory = SessionStore(max_entries=2)
+    first, second, third = (in_memory.create(request) for _ in range(3))
+
+    assert in_memory.get(first.id) is None
+    assert in_memory.get(second.id) is second and in_memory.get(third.id) is third
+
+    store = SessionStore(str(tmp_path / "sessions.db"), max_entries=2)
+    first, second, third = (store.create(request) for _ in range(3))
+    reloaded = store.get(first.id)
+
+    assert reloaded is not first and reloaded.returns("nps") == first.returns("nps")
+    assert store.get(third.id) is third
+    assert store.get(second.id) is not second
@@ -1,5 +1,11 @@
+import json
+import math
+
 import pytest
 from fastapi.testclient import TestClient
+from app import streaming
+from app.cache import result_cache
+from app.executor import compute_pool
 from app.main import app
 
 client = TestClient(app)
@@ -198,3 +204,176 @@ def test_filter_transactions_empty():
     data = response.json()
     assert data["valid"] == []
     assert data["invalid"] == []
+
+
+# ============================
+# 4️⃣ TEST NDJSON streaming
+# ============================
+
+
+def ndjson(items):
+    return "\n".join(json.dumps(item) for item in items) + "\n"
+
+
+def read_ndjson(response):
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+
+def test_parse_transactions_stream():
+    payload = [
+        {"date": "2024-01-01 12:07:00", "amount": 150},
+        {"date": "2024-01-02 13:15:00", "amount": 275},
+    ]
+
+    response = client.post(
+        "/api/blackrock/challenge/v1/transactions:parseStream",
+        content=ndjson(payload),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    expected = client.post("/api/blackrock/challenge/v1/transactions:parse", json=payload).json()
+    assert read_ndjson(response) == expected
+
+
+def test_validate_transactions_stream_duplicates_across_chunks(monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_CHUNK_SIZE", 1)
+
+    payload = [
+        {"date": "2024-01-01 12:07:00", "amount": 1010},
+        {"date": "2024-01-01 12:07:00", "amount": 1010},
+        {"date": "2024-01-02 13:15:00", "amount": -50},
+    ]
+
+    response = client.post("/api/blackrock/challenge/v1/transactions:validateStream", content=ndjson(payload))
+    lines = read_ndjson(response)
+
+    parsed = [{**t, "ceiling": math.ceil(t["amount"] / 100) * 100} for t in payload]
+    parsed = [{**t, "remanent": t["ceiling"] - t["amount"]} for t in parsed]
+    expected = client.post("/api/blackrock/challenge/v1/transactions:validate", json={"wage": 0, "transaction": parsed}).json()
+    assert [line["valid"] for line in lines if "valid" in line] == expected["valid"]
+    assert expected["valid"][0]["date"] == "2024-01-01 12:07:00"
+    invalid = [line["invalid"] for line in lines if "invalid" in line]
+    assert [i["message"] for i in invalid] == ["Duplicate transactions", "negative amounts are not allowed"]
+
+
+def test_filter_transactions_stream_matches_filter(monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_CHUNK_SIZE", 2)
+
+    periods = {
+        "wage": 50000,
+        "q": [{"fixed": 0, "start": "2026-07-01 00:00:00", "end": "2026-07-31 23:59:59"}],
+        "p": [{"extra": 25, "start": "2026-10-01 08:00:00", "end": "2026-12-31 19:59:59"}],
+        "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}],
+    }
+    transactions = [
+        {"date": "2026-02-28 15:49:20", "amount": 375},
+        {"date": "2026-07-15 10:30:00", "amount": 620},
+        {"date": "2026-10-12 20:15:30", "amount": 250},
+        {"date": "2026-10-12 20:15:30", "amount": 250},
+        {"date": "2026-12-17 08:09:45", "amount": -480},
+    ]
+
+    response = client.post(
+        "/api/blackrock/challenge/v1/transactions:filterStream",
+        content=ndjson([periods] + transactions),
+    )
+    lines = read_ndjson(response)
+    expected = client.post(
+        "/api/blackrock/challenge/v1/transactions:filter",
+        json={**periods, "transaction": transactions},
+    ).json()
+
+    assert [line["valid"] for line in lines if "valid" in line] == expected["valid"]
+    assert [line["invalid"] for line in lines if "invalid" in line] == expected["invalid"]
+
+
+def test_filter_transactions_stream_requires_sorted_input():
+    periods = {"wage": 0, "q": [], "p": [], "k": []}
+    transactions = [
+        {"date": "2026-02-28 15:49:20", "amount": 375},
+        {"date": "2026-01-15 10:30:00", "amount": 620},
+    ]
+
+    response = client.post(
+        "/api/blackrock/challenge/v1/transactions:filterStream",
+        content=ndjson([periods] + transactions),
+    )
+    lines = read_ndjson(response)
+
+    assert "error" in lines[-1]
+
+
+def test_parse_transactions_stream_invalid_line():
+    response = client.post(
+        "/api/blackrock/challenge/v1/transactions:parseStream",
+        content='{"date": "2024-01-01 12:07:00", "amount": 150}\n{"date": "2024-01-01 12:09:55"}\n',
+    )
+    lines = read_ndjson(response)
+
+    assert lines[-1]["line"] == 2
+
+
+# ============================
+# 5️⃣ TEST fast response path
+# ============================
+
+
+def test_parse_transactions_fast_matches_default():
+    payload = [
+        {"date": "2024-01-01 12:07:00", "amount": 150},
+        {"date": "2024-01-02 13:15:00", "amount": 275.5},
+        {"date": "2024-01-03 09:00:00", "amount": 300},
+    ]
+
+    default = client.post("/api/blackrock/challenge/v1/transactions:parse", json=payload)
+    fast = client.post("/api/blackrock/challenge/v1/transactions:parse?fast=true", json=payload)
+
+    assert fast.status_code == 200
+    assert fast.json() == default.json()
+
+
+def test_filter_transactions_fast_matches_default():
+    payload = {
+        "wage": 50000,
+        "q": [{"fixed": 0, "start": "2026-07-01 00:00:00", "end": "2026-07-31 23:59:59"}],
+        "p": [{"extra": 25, "start": "2026-10-01 08:00:00", "end": "2026-12-31 19:59:59"}],
+        "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}],
+        "transaction": [
+            {"date": "2026-02-28 15:49:20", "amount": 375},
+            {"date": "2026-07-15 10:30:00", "amount": 620},
+            {"date": "2026-10-12 20:15:30", "amount": 250},
+            {"date": "2026-10-12 20:15:30", "amount": 250},
+            {"date": "2026-12-17 08:09:45", "amount": -480},
+        ],
+    }
+
+    default = client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload)
+    fast = client.post("/api/blackrock/challenge/v1/transactions:filter", params={"fast": True}, json=payload)
+
+    assert fast.status_code == 200
+    assert fast.json() == default.json()
+
+
+def test_filter_transactions_offloaded_matches_inline(monkeypatch):
+    payload = {
+        "wage": 50000,
+        "q": [{"fixed": 0, "start": "2026-07-01 00:00:00", "end": "2026-07-31 23:59:59"}],
+        "p": [{"extra": 25, "start": "2026-10-01 08:00:00", "end": "2026-12-31 19:59:59"}],
+        "k": [{"start": "2026-01-01 00:00:00", "end": "2026-12-31 23:59:59"}],
+        "transaction": [
+            {"date": "2026-02-28 15:49:20", "amount": 375},
+            {"date": "2026-10-12 20:15:30", "amount": 250},
+        ],
+    }
+    inline = client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload).json()
+
+    monkeypatch.setattr(compute_pool, "threshold", 1)
+    result_cache.clear()
+    try:
+        offloaded = client.post("/api/blackrock/challenge/v1/transactions:filter", json=payload).json()
+    finally:
+        compute_pool.shutdown()
+
+    assert offloaded == inline
@@ -0,0 +1,122 @@
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import columnar
+from app.main import app
+from app.uploads import UploadFormatError, encode_columnar, read_transactions
+from benchmarks.data import make_request, to_json_payload
+
+client = TestClient(app)
+
+API = "/api/blackrock/challenge/v1"
+
+
+@pytest.fixture
+def request_data():
+    request = make_request(400, q=8, p=8, k=6, overlap=2.0, duplicate_ratio=0.05, seed=11)
+    return request, to_json_payload(request)
+
+
+def to_csv(transactions, header="date,amount\n"):
+    return header + "".join(f"{t['date']},{t['amount']}\n" for t in transactions)
+
+
+def periods_of(payload, *exclude):
+    return json.dumps({key: value for key, value in payload.items() if key not in ("transaction", *exclude)})
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_csv_and_columnar_read_the_same_batch(request_data, use_numpy, monkeypatch):
+    monkeypatch.setattr(columnar, "HAS_NUMPY", use_numpy and columnar.np is not None)
+    request, payload = request_data
+
+    from_csv = read_transactions(io.BytesIO(to_csv(payload["transaction"]).encode()))
+    from_columnar = read_transactions(io.BytesIO(encode_columnar(request.transaction)))
+
+    assert from_csv == request.transaction
+    assert from_columnar == request.transaction
+
+
+def test_csv_header_names_the_columns():
+    batch = read_transactions(io.BytesIO(b"\xef\xbb\xbfid,amount,date\r\n1,250,2023-10-12 20:15:30\r\n\r\n2,10.5,2023-01-01 00:00:00\r\n"))
+
+    assert [(row.date.year, row.amount) for row in batch] == [(2023, 250.0), (2023, 10.5)]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("line, message", [
+    ("2023-10-12,1", "YYYY-MM-DD HH:mm:ss"),
+    ("0000-01-01 00:00:00,1", "YYYY-MM-DD HH:mm:ss"),
+    ("2023-02-29 00:00:00,1", "YYYY-MM-DD HH:mm:ss"),
+    ("2023-10-12 20:15:30,abc", "number"),
+    ("2023-10-12 20:15:30,nan", "finite"),
+    ("2023-10-12 20:15:30", "expected a date and an amount"),
+])
+def test_csv_errors_point_at_the_line(line, message, use_numpy, monkeypatch):
+    monkeypatch.setattr(columnar, "HAS_NUMPY", use_numpy and columnar.np is not None)
+    body = f"2023-10-12 20:15:30,1\n{line}\n".encode()
+
+    with pytest.raises(UploadFormatError, match=message) as error:
+        read_transactions(io.BytesIO(body))
+    assert error.value.row == 2
+
+
+def test_truncated_columnar_file_is_rejected(request_data):
+    request, _ = request_data
+
+    with pytest.raises(UploadFormatError, match="truncated"):
+        read_transactions(io.BytesIO(encode_columnar(request.transaction)[:-3]))
+    with pytest.raises(UploadFormatError, match="unexpected data"):
+        read_transactions(io.BytesIO(encode_columnar(request.transaction) + b"\0"))
+
+
+def test_filter_upload_matches_json_endpoint(request_data):
+    request, payload = request_data
+    filter_payload = {key: value for key, value in payload.items() if key not in ("age", "inflation")}
+    expected = client.post(f"{API}/transactions:filter", json=filter_payload).json()
+
+    for file in (to_csv(payload["transaction"]), encode_columnar(request.transaction)):
+        response = client.post(f"{API}/transactions:filterUpload", files={"file": ("transactions", file)},
+                               data={"periods": periods_of(payload, "age", "inflation")})
+        assert response.status_code == 200
+        assert response.json() == expected
+
+
+@pytest.mark.parametrize("mode", ["nps", "index"])
+def test_returns_upload_matches_json_endpoint(request_data, mode):
+    _, payload = request_data
+    expected = client.post(f"{API}/returns:{mode}", json=payload).json()
+
+    response = client.post(f"{API}/returns:{mode}Upload", files={"file": ("t.csv", to_csv(payload["transaction"]))},
+                           data={"periods": periods_of(payload)})
+
+    assert response.status_code == 200
+    assert response.json() == expected
+
+
+def test_parse_upload_matches_json_endpoint(request_data):
+    _, payload = request_data
+    expected = client.post(f"{API}/transactions:parse", json=payload["transaction"]).json()
+
+    response = client.post(f"{API}/transactions:parseUpload", files={"file": ("t.csv", to_csv(payload["transaction"], ""))})
+
+    assert response.json() == expected
+
+
+def test_upload_errors_are_422(request_data):
+    _, payload = request_data
+
+    bad_file = client.post(f"{API}/transactions:parseUpload", files={"file": ("t.csv", "date,amount\n2023-10-12,1\n")})
+    bad_periods = client.post(f"{API}/transactions:filterUpload", files={"file": ("t.csv", "")},
+                              data={"periods": json.dumps({"q": [], "p": [], "wage": 1})})
+    with_transactions = client.post(f"{API}/transactions:filterUpload", files={"file": ("t.csv", "")},
+                                    data={"periods": json.dumps({"transaction": [], "q": [], "p": [], "k": [], "wage": 1})})
+
+    assert bad_file.status_code == 422
+    assert bad_file.json()["detail"][0]["loc"] == ["body", "file", 2]
+    assert bad_periods.status_code == 422
+    assert bad_periods.json()["detail"][0]["loc"][:2] == ["body", "periods"]
+    assert with_transactions.status_code == 422
@@ -0,0 +1,196 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import columnar
+from app.dates import DATE_FORMAT, format_datetime, parse_datetime
+from app.models import TransactionKPeriodRequest, TransactionParseRequest, TransactionQPeriodRequest
+from app.utils import FactorTableCache, KPeriodIndex, QPeriodMap, apply_q_rule, calculate_tax, calculate_tax_many
+
+BASE = datetime(2026, 1, 1)
+
+
+def random_k_periods(rng, count):
+    periods = []
+    for _ in range(count):
+        start = BASE + timedelta(minutes=rng.randint(0, 500000))
+        end = start + timedelta(minutes=rng.randint(-100, 3000))
+        periods.append(TransactionKPeriodRequest(start=start, end=end))
+    return periods
+
+
+def test_k_period_index_membership_matches_scan():
+    rng = random.Random(7)
+    k_periods = random_k_periods(rng, 2000)
+    dates = sorted(BASE + timedelta(minutes=rng.randint(0, 510000)) for _ in range(3000))
+    dates += [k.start for k in k_periods[:50]] + [k.end for k in k_periods[:50]]
+    dates.sort()
+
+    index = KPeriodIndex(k_periods)
+    expected = [any(k.start <= d <= k.end for k in k_periods) for d in dates]
+
+    assert index.membership(dates) == expected
+    assert [index.contains(d) for d in dates] == expected
+
+
+def test_k_period_index_window_sums_match_slices():
+    rng = random.Random(8)
+    k_periods = random_k_periods(rng, 300)
+    dates = sorted(BASE + timedelta(minutes=rng.randint(0, 510000)) for _ in range(2000))
+    values = [rng.randint(0, 100) for _ in dates]
+
+    sums = KPeriodIndex(k_periods).window_sums(dates, values)
+    expected = [sum(v for d, v in zip(dates, values) if k.start <= d <= k.end) for k in k_periods]
+
+    assert sums == expected
+
+
+def test_k_period_index_empty():
+    index = KPeriodIndex([])
+
+    assert index.membership([BASE]) == [False]
+    assert index.window_sums([BASE], [10]) == []
+
+
+@pytest.mark.parametrize("value", [
+    "2026-02-21 06:04:11",
+    "1999-12-31 23:59:59",
+    "2024-02-29 00:00:00",
+    "2024-1-2 3:04:05",
+])
+def test_parse_datetime_matches_strptime(value):
+    assert parse_datetime(value) == datetime.strptime(value, DATE_FORMAT)
+
+
+@pytest.mark.parametrize("value", [
+    "2023-02-29 00:00:00",
+    "2026-13-01 00:00:00",
+    "2026-02-21T06:04:11",
+    "2026-02-21 06:04:1x",
+    "2026-02-21",
+])
+def test_parse_datetime_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        parse_datetime(value)
+
+
+@pytest.mark.parametrize("value", [
+    datetime(2026, 2, 21, 6, 4, 11),
+    datetime(2026, 2, 21, 6, 4, 11, 999999),
+    datetime(999, 1, 1),
+])
+def test_format_datetime_matches_strftime(value):
+    assert format_datetime(value) == value.strftime(DATE_FORMAT)
+
+
+def reference_calculate_tax(income):
+    # the hard-coded if-chain calculate_tax used to be
+    tax = 0
+    if income <= 700000:
+        return 0
+    if income > 1500000:
+        tax += (income - 1500000) * 0.30
+        income = 1500000
+    if income > 1200000:
+        tax += (income - 1200000) * 0.20
+        income = 1200000
+    if income > 1000000:
+        tax += (income - 1000000) * 0.15
+        income = 1000000
+    if income > 700000:
+        tax += (income - 700000) * 0.10
+    return tax
+
+
+def tax_incomes():
+    rng = random.Random(9)
+    incomes = [0, -5, 700000, 700000.01, 1000000, 1200000, 1500000, 1500000.5, 99999999]
+    incomes += [rng.uniform(0, 3000000) for _ in range(5000)]
+    incomes += [float(rng.randint(600000, 1600000)) for _ in range(5000)]
+    return incomes
+
+
+def test_calculate_tax_matches_reference():
+    for income in tax_incomes():
+        assert calculate_tax(income) == reference_calculate_tax(income)
+
+
+def test_calculate_tax_many_matches_reference():
+    incomes = tax_incomes()
+
+    assert calculate_tax_many(incomes) == [reference_calculate_tax(income) for income in incomes]
+
+
+def test_calculate_tax_many_python_fallback(monkeypatch):
+    incomes = tax_incomes()[:100]
+    monkeypatch.setattr(columnar, "HAS_NUMPY", False)
+
+    assert calculate_tax_many(incomes) == [reference_calculate_tax(income) for income in incomes]
+
+
+def test_calculate_tax_custom_slabs():
+    slabs = ((100, 0.5), (200, 1.0))
+
+    assert calculate_tax(100, slabs) == 0
+    assert calculate_tax(150, slabs) == 25
+    assert calculate_tax(300, slabs) == 150
+    assert calculate_tax_many([150, 300], slabs) == [25, 150]
+
+
+def q_period(start, end, fixed):
+    return TransactionQPeriodRequest(start=start, end=end, fixed=fixed)
+
+
+def reference_fixed(q_periods, date):
+    # latest start wins, the one listed last among equal starts
+    best = None
+    for i, q in enumerate(q_periods):
+        if q.start <= date <= q.end and (best is None or (q.start, i) >= (q_periods[best].start, best)):
+            best = i
+    return None if best is None else q_periods[best].fixed
+
+
+def test_q_rule_falls_back_to_an_earlier_overlapping_period():
+    q_periods = [
+        q_period(datetime(2026, 1, 1), datetime(2026, 12, 31), 10),
+        q_period(datetime(2026, 3, 1), datetime(2026, 3, 31), 50),
+        q_period(datetime(2026, 3, 1), datetime(2026, 3, 15), 70),
+    ]
+    transactions = [
+        TransactionParseRequest(date=date, amount=250)
+        for date in (datetime(2025, 12, 31), datetime(2026, 3, 10), datetime(2026, 3, 20), datetime(2026, 4, 1))
+    ]
+
+    # 2026-04-01: the latest starting periods have ended, the year long one still applies
+    assert apply_q_rule(transactions, [50.0] * 4, q_periods) == [50.0, 70, 50, 10]
+
+
+def test_q_period_map_matches_scan_on_100k_overlapping_windows():
+    rng = random.Random(11)
+    q_periods = []
+    for _ in range(100000):
+        start = BASE + timedelta(seconds=rng.randint(0, 365 * 86400))
+        end = start + timedelta(seconds=rng.randint(-3600, 20 * 86400))
+        q_periods.append(q_period(start, end, rng.randint(0, 500)))
+    dates = [BASE + timedelta(seconds=rng.randint(-86400, 366 * 86400)) for _ in range(40)]
+    dates += [q.start for q in q_periods[:10]] + [q.end for q in q_periods[:10]]
+
+    q_map = QPeriodMap(q_periods)
+
+    assert [q_map.fixed_at(columnar.to_epoch(date)) for date in dates] == [reference_fixed(q_periods, date) for date in dates]
+
+
+def test_factor_table_cache_is_bounded_by_bytes():
+    cache = FactorTableCache(lambda size: tuple(1.0 for _ in range(size)), max_bytes=32 * 100)
+
+    cache(40)
+    cache(40)
+    cache(50)
+    assert cache.cache_info() == (1, 2, 2, 32 * 90)
+
+    # evicts the least recently used table, and does not keep a table above the cap at all
+    cache(30)
+    assert cache.cache_info().entries == 2 and cache.cache_info().bytes == 32 * 80
+    assert len(cache(101)) == 101
+    assert cache.cache_info().bytes == 32 * 80